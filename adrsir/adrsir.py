@@ -9,6 +9,12 @@ Usage
 ```
 adrsir = AdrsirCtrl()
 
+# Use the simulated board instead of /dev/i2c-1
+# adrsir = AdrsirCtrl("sim")
+
+# Board at 0x53 on /dev/i2c-3
+# adrsir = AdrsirCtrl(3, address=0x53)
+
 # Read the code from flash
 # n = <memory id>
 print(adrsir.read(n))
@@ -26,18 +32,63 @@ adrsir.write(n, code)
 # Transmit the code
 # code = <code string>
 adrsir.transmit(code)
+
+# Transmit the decoded code
+adrsir.transmit(bytes.fromhex(code))
+
+# Transmit the code written in the flash
+# n = <memory id>
+adrsir.transmit_slot(n)
+
+# Write the code to the flash unless it is already there
+# (True if written)
+adrsir.sync(n, code)
+
+# Transmit the code 5 times every 0.1 sec
+# (the code is uploaded once and the buffer is transmitted again)
+adrsir.transmit(code, repeat=5, interval=0.1)
+```
+
+Batch
+-----
+``-s FILE`` (``-`` for stdin) runs a script of operations over one open
+bus and prints one JSON result per operation with its time (sec).
+A line is a command or a JSON object:
+```
+# comment
+read 3
+write 3 5B0018002E00...
+transmit 5B0018002E00... [repeat] [interval]
+transmit_slot 3
+sleep 0.5
+dump
+restore slots.json
+{"op": "write", "mem_id": 3, "code": "5B0018002E00..."}
+```
+``dump`` reads all the slots and ``restore`` writes the codes of a dump
+result back to the slots which do not hold them yet:
+```
+$ echo dump | python adrsir.py -s - > slots.json
+$ echo restore slots.json | python adrsir.py -s -
 ```
 
 """
 
 import argparse
+import json
+import sys
+import time
 
-import smbus
+try:
+    from . import codec
+    from .transport import MEM_SLOTS, batch_unsupported, open_transport
+except ImportError:
+    import codec
+    from transport import MEM_SLOTS, batch_unsupported, open_transport
 
 
 class AdrsirCtrl:
-    # I2C Bus
-    BUS = smbus.SMBus(1)
+    # I2C Slave Address
     SLAVE_ADDRESS = 0x52
 
     """
@@ -55,63 +106,271 @@ class AdrsirCtrl:
     * TRANSMIT_START = 0x59
     """
 
+    def __init__(self, bus=None, reuse_buffer=True, address=None):
+        # bus: transport object, bus number or "sim"
+        # (default: ADRSIR_I2C_BUS or 1)
+        # address: I2C slave address (default: SLAVE_ADDRESS)
+        self.address = self.SLAVE_ADDRESS if address is None else address
+        if bus is None or isinstance(bus, (int, str)):
+            bus = open_transport(bus, address=self.address)
+        self.bus = bus
+        # Use combined I2C transfers if the transport supports them
+        self.batch = hasattr(bus, "write_i2c_block_batch")
+        # Skip the upload when the board buffer already holds the data
+        self.reuse_buffer = reuse_buffer
+        # Data in the board buffer (None: unknown)
+        self.loaded = None
+
     def read(self, mem_id=0):
         # Read the data written in the flash
-        mem_id = [mem_id]
-        # Set MEM_ID
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x15, mem_id)
+        # (the board buffer is left unknown: whether 0x15 loads it is
+        # unconfirmed)
+        data = self._read_data(mem_id, self.data_num(mem_id))
+        return codec.encode(data)
+
+    def data_num(self, mem_id):
+        # DATA_NUM (number of 4 bytes) of the data written in the flash
+        self.loaded = None
+        # Set MEM_ID (the board loads the flash to the buffer)
+        self.bus.write_i2c_block_data(self.address, 0x15, [mem_id])
         # Get DATA_NUM
-        data_numHL = self.BUS.read_i2c_block_data(self.SLAVE_ADDRESS, 0x25, 3)
-        data_num = data_numHL[1] * 256 + data_numHL[2]
-        # Read DATA
-        data = []
-        self.BUS.read_i2c_block_data(self.SLAVE_ADDRESS, 0x35, 1)
-        for i in range(data_num):
-            data.append(self.BUS.read_i2c_block_data(self.SLAVE_ADDRESS, 0x35, 4))
-        data = sum(data, [])
-        data_str = "".join([f"{x:02X}" for x in data])
-        return data_str
-
-    def write(self, mem_id, data_str):
+        data_numHL = self.bus.read_i2c_block_data(self.address, 0x25, 3)
+        return data_numHL[1] * 256 + data_numHL[2]
+
+    def peek(self, mem_id, units=2):
+        # DATA_NUM and the first units (4 bytes each) of the data written
+        # in the flash, to detect a change without reading it all
+        data_num = self.data_num(mem_id)
+        prefix = self._read_data(mem_id, min(units, data_num))
+        return data_num, prefix
+
+    def sync(self, mem_id, data_str):
+        # Write the data to the flash unless the flash already holds it
+        # DATA_NUM is compared first, and the data is read only if it
+        # matches. Return True if written.
+        data = bytes(codec.frame(codec.decode(data_str)))
+        data_num = self.data_num(mem_id)
+        if data_num == len(data) // codec.UNIT:
+            if self._read_data(mem_id, data_num) == data:
+                return False
+        self.write(mem_id, data)
+        return True
+
+    def write(self, mem_id, data_str, strict=False):
         # Write the data to the flash
+        # strict: ValueError if the data is not whole DATA units instead
+        # of dropping the trailing bytes
         mem_id = [mem_id]
-        data = []
-        for i in range(len(data_str) // 2):
-            data.append(int(data_str[2 * i : 2 * i + 2], 16))
-        data_num = len(data) // 4
+        view = codec.frame(codec.decode(data_str), strict)
         # Set MEM_ID
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x19, mem_id)
+        blocks = [(0x19, mem_id)]
         # Set DATA_NUM
-        data_numHL = [data_num // 256, data_num % 256]
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x29, data_numHL)
+        blocks.append((0x29, codec.data_num(view)))
         # Write DATA
-        for i in range(data_num):
-            self.BUS.write_i2c_block_data(
-                self.SLAVE_ADDRESS, 0x39, data[4 * i : 4 * i + 4]
-            )
+        blocks.extend((0x39, chunk) for chunk in codec.chunks(view))
         # Flash write
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x49, mem_id)
-
-    def transmit(self, data_str):
-        # Transmit the data
-        data = []
-        for i in range(len(data_str) // 2):
-            data.append(int(data_str[2 * i : 2 * i + 2], 16))
-        data_num = len(data) // 4
-        # Set DATA_NUM
-        data_numHL = [data_num // 256, data_num % 256]
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x29, data_numHL)
-        # Write DATA
-        for i in range(data_num):
-            self.BUS.write_i2c_block_data(
-                self.SLAVE_ADDRESS, 0x39, data[4 * i : 4 * i + 4]
-            )
-        self.BUS.write_i2c_block_data(self.SLAVE_ADDRESS, 0x59, [0x00])
+        blocks.append((0x49, mem_id))
+        self.loaded = None
+        self._write_blocks(blocks)
+        self.loaded = bytes(view)
+
+    def transmit(self, data_str, repeat=1, interval=0.0, strict=False):
+        # Transmit the data (code string or decoded bytes)
+        # repeat: number of transmits, interval: seconds between them
+        view = codec.frame(codec.decode(data_str), strict)
+        if self.is_loaded(view):
+            # The buffer already holds the data
+            self.trigger()
+        else:
+            # Set DATA_NUM
+            blocks = [(0x29, codec.data_num(view))]
+            # Write DATA
+            blocks.extend((0x39, chunk) for chunk in codec.chunks(view))
+            # Transmit
+            blocks.append((0x59, [0x00]))
+            self.loaded = None
+            self._write_blocks(blocks)
+            self.loaded = bytes(view)
+        self._repeat(repeat - 1, interval)
+
+    def transmit_slot(self, mem_id, repeat=1, interval=0.0):
+        # Transmit the data written in the flash
+        # NOTE: that TRANSMIT_START sends the buffer loaded by
+        # READ_SET_MEM_ID is unconfirmed on the real board, so the buffer
+        # is left unknown and only write() and transmit() set it
+        # Set MEM_ID (the board loads the flash to the buffer)
+        blocks = [(0x15, [mem_id])]
+        # Transmit
+        blocks.append((0x59, [0x00]))
+        self.loaded = None
+        self._write_blocks(blocks)
+        self._repeat(repeat - 1, interval)
+
+    def trigger(self):
+        # Transmit the data in the buffer again
+        self._write_blocks([(0x59, [0x00])])
+
+    def is_loaded(self, data):
+        # True if the buffer holds the data (decoded bytes)
+        return (
+            self.reuse_buffer
+            and self.loaded is not None
+            and self.loaded == codec.frame(data)
+        )
+
+    def _repeat(self, count, interval):
+        for i in range(count):
+            if interval:
+                time.sleep(interval)
+            self.trigger()
+
+    def _read_data(self, mem_id, data_num):
+        # Read DATA of the buffer loaded by data_num(mem_id)
+        self.bus.read_i2c_block_data(self.address, 0x35, 1)
+        if self.batch:
+            try:
+                data = self.bus.read_i2c_block_batch(self.address, 0x35, 4, data_num)
+            except (NotImplementedError, OSError) as e:
+                if not batch_unsupported(e):
+                    raise
+                # Start over with the per-chunk path (data_num rewinds the
+                # read pointer), reading the same number of units
+                self.batch = False
+                self.data_num(mem_id)
+                return self._read_data(mem_id, data_num)
+        else:
+            data = []
+            for i in range(data_num):
+                data.append(self.bus.read_i2c_block_data(self.address, 0x35, 4))
+        return codec.join(data)
+
+    def _write_blocks(self, blocks):
+        # Send the (cmd, data) blocks in combined transfers if possible,
+        # otherwise one write_i2c_block_data per block.
+        # An unsupported combined transfer fails on the first ioctl before
+        # anything is sent, so it is safe to start over per block.
+        if self.batch:
+            try:
+                self.bus.write_i2c_block_batch(self.address, blocks)
+                return
+            except (NotImplementedError, OSError) as e:
+                if not batch_unsupported(e):
+                    raise
+                self.batch = False
+        for cmd, data in blocks:
+            self.bus.write_i2c_block_data(self.address, cmd, data)
+
+
+# Arguments of the script commands
+SCRIPT_ARGS = {
+    "read": ["mem_id"],
+    "write": ["mem_id", "code"],
+    "transmit": ["code", "repeat", "interval"],
+    "transmit_slot": ["mem_id"],
+    "sleep": ["seconds"],
+    "dump": [],
+    "restore": ["path"],
+}
+
+
+def parse_op(line):
+    """
+    Parse a script line into an operation dict (None: blank or comment)
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        op = json.loads(line)
+    else:
+        words = line.split()
+        names = SCRIPT_ARGS.get(words[0])
+        if names is None or len(words) - 1 > len(names):
+            raise ValueError(f"Invalid command: {line}")
+        op = dict(zip(names, words[1:]), op=words[0])
+    if op.get("op") not in SCRIPT_ARGS:
+        raise ValueError(f"Unknown op: {op.get('op')}")
+    return op
+
+
+def _mem_id(op):
+    mem_id = int(op["mem_id"])
+    if not 0 <= mem_id < MEM_SLOTS:
+        raise ValueError(f"mem_id must be 0...{MEM_SLOTS - 1}")
+    return mem_id
+
+
+def run_op(adrsir, op):
+    """
+    Run the operation and return its result
+    """
+    name = op["op"]
+    if name == "read":
+        mem_id = _mem_id(op)
+        return {"mem_id": mem_id, "code": adrsir.read(mem_id)}
+    if name == "write":
+        mem_id = _mem_id(op)
+        adrsir.write(mem_id, op["code"])
+        return {"mem_id": mem_id}
+    if name == "transmit":
+        adrsir.transmit(
+            op["code"], int(op.get("repeat", 1)), float(op.get("interval", 0.0))
+        )
+        return {}
+    if name == "transmit_slot":
+        adrsir.transmit_slot(_mem_id(op))
+        return {"mem_id": _mem_id(op)}
+    if name == "sleep":
+        time.sleep(float(op["seconds"]))
+        return {}
+    if name == "dump":
+        return {"codes": [adrsir.read(mem_id) for mem_id in range(MEM_SLOTS)]}
+    # restore the codes of a dump result (the empty slots are skipped)
+    codes = op.get("codes")
+    if codes is None:
+        with open(op["path"]) as f:
+            codes = json.loads(f.read())["codes"]
+    written = []
+    for mem_id, code in enumerate(codes[:MEM_SLOTS]):
+        if code and adrsir.sync(mem_id, code):
+            written.append(mem_id)
+    return {"written": written}
+
+
+def run_script(adrsir, lines, out=sys.stdout):
+    """
+    Run the script lines and print the JSON results to out
+    Return the number of failed operations
+    """
+    failed = 0
+    for number, line in enumerate(lines, 1):
+        started = time.perf_counter()
+        try:
+            op = parse_op(line)
+            if op is None:
+                continue
+            result = dict(op=op["op"], **run_op(adrsir, op))
+        except Exception as e:
+            failed += 1
+            result = {"line": number, "error": repr(e)}
+        result["time"] = round(time.perf_counter() - started, 6)
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+    return failed
 
 
 if __name__ == "__main__":
-    adrsir = AdrsirCtrl()
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-b", "--bus", type=str, default=None, help="I2C bus number or sim"
+    )
+    parser.add_argument(
+        "-a",
+        "--address",
+        type=lambda x: int(x, 0),
+        default=None,
+        help="I2C slave address (default: 0x52)",
+    )
     parser.add_argument(
         "-r", "--read", type=int, help="read the code written in the flash"
     )
@@ -119,7 +378,18 @@ if __name__ == "__main__":
         "-w", "--write", nargs=2, type=str, help="write the code to the flash"
     )
     parser.add_argument("-t", "--transmit", type=str, help="transmit the code")
+    parser.add_argument(
+        "-s", "--script", type=str, help="run the script file (- for stdin)"
+    )
     args = parser.parse_args()
+    adrsir = AdrsirCtrl(args.bus, address=args.address)
+    if args.script:
+        if args.script == "-":
+            failed = run_script(adrsir, sys.stdin)
+        else:
+            with open(args.script) as f:
+                failed = run_script(adrsir, f)
+        sys.exit(1 if failed else 0)
     if args.read:
         if args.read >= 0 and args.read <= 9:
             print(adrsir.read(args.read))
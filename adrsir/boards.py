@@ -0,0 +1,248 @@
+"""
+Board Registry
+==============
+
+One API process can drive several ADRSIR boards, given by ADRSIR_BOARDS
+as a comma separated list of ``name=bus[:address][@mux/channel]``:
+```
+ADRSIR_BOARDS="living=1,bedroom=1:0x53,hall=3@0x70/0,porch=3@0x70/1"
+```
+* bus: I2C bus number, or ``sim`` for a simulated board
+* address: I2C slave address of the board (default: 0x52)
+* mux/channel: address and channel of the I2C multiplexer in front of
+  the board
+
+The first board is the default one, which is used by the devices
+without a board. Without ADRSIR_BOARDS there is a single board
+"default" on ADRSIR_I2C_BUS.
+
+The boards are grouped into lanes. A lane is a board, or all the boards
+behind one multiplexer, and has its own `HardwareWorker` and lock file,
+so the lanes transmit in parallel while the jobs of a lane run one by
+one.
+The buses are opened on first use (`LazyTransport`), in each process.
+
+Usage
+-----
+```
+boards = BoardRegistry("living=1,bedroom=1:0x53")
+for board in boards.resolve("living,bedroom"):
+    board.lane.worker.submit("transmit", board.ctrl.transmit, code)
+```
+
+"""
+
+from collections import OrderedDict
+
+from . import metrics, timing
+from .adrsir import AdrsirCtrl
+from .transport import LazyTransport, Mux, MuxTransport, open_transport
+from .worker import BusLock, HardwareWorker
+
+DEFAULT = "default"
+
+
+def parse_boards(spec):
+    """
+    Parse "living=1,hall=3:0x53@0x70/2" into
+    [("living", "1", 0x52, None, None), ("hall", "3", 0x53, 0x70, 2)]
+    """
+    boards = []
+    for item in spec.replace(" ", "").split(","):
+        if not item:
+            continue
+        try:
+            name, target = item.split("=")
+            mux = channel = None
+            if "@" in target:
+                target, mux_target = target.split("@")
+                mux, channel = mux_target.split("/")
+                mux, channel = int(mux, 0), int(channel)
+            bus, _, address = target.partition(":")
+            address = int(address, 0) if address else AdrsirCtrl.SLAVE_ADDRESS
+        except ValueError:
+            raise ValueError(f"Invalid board: {item}")
+        if not name or not (bus == "sim" or bus.isdigit()):
+            raise ValueError(f"Invalid board: {item}")
+        if channel is not None and not 0 <= channel <= 7:
+            raise ValueError(f"Invalid board: {item}")
+        boards.append((name, bus, address, mux, channel))
+    names = [board[0] for board in boards]
+    if len(set(names)) != len(names):
+        raise ValueError("Board names must be unique")
+    if len({board[1:] for board in boards}) != len(boards):
+        raise ValueError("Boards must be at different addresses")
+    return boards
+
+
+def _lazy_transport(bus, address=AdrsirCtrl.SLAVE_ADDRESS):
+    return LazyTransport(lambda: open_transport(bus, address=address))
+
+
+class Lane:
+    """
+    Boards sharing a hardware worker
+    """
+
+    def __init__(self, name, maxsize=16, lock_path=None, on_foreign=None):
+        self.name = name
+        self.boards = []
+        self.mux = None
+        self.on_foreign = on_foreign
+        lock = BusLock(lock_path, on_foreign=self.forget) if lock_path else None
+        self.worker = HardwareWorker(maxsize=maxsize, lock=lock)
+
+    def forget(self):
+        # Another process has used the boards of the lane
+        for board in self.boards:
+            board.ctrl.loaded = None
+        if self.mux:
+            self.mux.forget()
+        if self.on_foreign:
+            self.on_foreign(self)
+
+
+class Board:
+    """
+    ADRSIR board
+    """
+
+    def __init__(self, name, ctrl, lane, transport, bus=None, mux=None, channel=None):
+        self.name = name
+        self.ctrl = ctrl
+        self.lane = lane
+        # LazyTransport of the bus
+        self.transport = transport
+        self.bus = bus
+        self.mux = mux
+        self.channel = channel
+        # SlotManager of the flash slots (None: not managed)
+        self.slots = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "bus": self.bus,
+            "address": self.ctrl.address,
+            "mux": self.mux,
+            "channel": self.channel,
+            "lane": self.lane.name,
+        }
+
+
+class BoardRegistry:
+    """
+    Boards by name
+
+    spec: ADRSIR_BOARDS style board list (None: single default board)
+    lock_path: lock file of the bus, suffixed by the lane name if there
+               are several lanes (None: no lock)
+    on_foreign: called with the Lane when another process has used it
+    """
+
+    def __init__(
+        self,
+        spec=None,
+        reuse_buffer=True,
+        maxsize=16,
+        lock_path=None,
+        on_foreign=None,
+    ):
+        entries = parse_boards(spec) if spec else [(DEFAULT, None, None, None, None)]
+        keys = OrderedDict()
+        for name, bus, address, mux, channel in entries:
+            if bus is None:
+                key = DEFAULT
+            elif mux is not None:
+                key = f"{bus}-{mux:#04x}"
+            else:
+                key = f"{bus}-{address:#04x}"
+            keys.setdefault(key, []).append((name, bus, address, mux, channel))
+
+        self.boards = OrderedDict()
+        self.lanes = OrderedDict()
+        for key, lane_entries in keys.items():
+            path = lock_path
+            if lock_path and len(keys) > 1:
+                path = f"{lock_path}.{key}"
+            lane = Lane(key, maxsize=maxsize, lock_path=path, on_foreign=on_foreign)
+            self.lanes[key] = lane
+            for name, bus, address, mux, channel in lane_entries:
+                if mux is not None and bus != "sim":
+                    if lane.mux is None:
+                        lane.mux = Mux(_lazy_transport(bus), mux)
+                    lazy = lane.mux.transport
+                    transport = MuxTransport(lane.mux, channel)
+                else:
+                    lazy = transport = _lazy_transport(
+                        bus, address or AdrsirCtrl.SLAVE_ADDRESS
+                    )
+                ctrl = AdrsirCtrl(
+                    metrics.instrument_transport(
+                        timing.instrument_transport(transport)
+                    ),
+                    reuse_buffer=reuse_buffer,
+                    address=address,
+                )
+                board = Board(name, ctrl, lane, lazy, bus=bus, mux=mux, channel=channel)
+                lane.boards.append(board)
+                self.boards[name] = board
+        self.default = next(iter(self.boards.values()))
+
+    def get(self, name=None):
+        """
+        Get Board by name (None: the default board)
+        """
+        if name is None:
+            return self.default
+        return self.boards.get(name)
+
+    def resolve(self, names=None):
+        """
+        Get the Boards of a comma separated name list (None: the default
+        board), KeyError if a board does not exist
+        """
+        if not names:
+            return [self.default]
+        boards = []
+        for name in names.replace(" ", "").split(","):
+            if name and name not in self.boards:
+                raise KeyError(name)
+            if name and self.boards[name] not in boards:
+                boards.append(self.boards[name])
+        return boards or [self.default]
+
+    def check(self):
+        """
+        Open the buses of the boards and return {board name: error or
+        None}
+        """
+        errors = OrderedDict()
+        for name, board in self.boards.items():
+            try:
+                board.transport.open()
+            except (OSError, ImportError, ValueError) as e:
+                errors[name] = repr(e)
+            else:
+                errors[name] = None
+        return errors
+
+    def find_job(self, job_id):
+        for lane in self.lanes.values():
+            job = lane.worker.get(job_id)
+            if job is not None:
+                return job
+        return None
+
+    def find_hold(self, hold_id):
+        for lane in self.lanes.values():
+            hold = lane.worker.get_hold(hold_id)
+            if hold is not None:
+                return hold
+        return None
+
+    def to_dict(self):
+        return [
+            dict(board.to_dict(), jobs=board.lane.worker.stats())
+            for board in self.boards.values()
+        ]
@@ -0,0 +1,218 @@
+"""
+Bulk Import & Export
+====================
+
+Devices and codes are imported and exported as NDJSON, one record per
+line:
+```
+{"type": "device", "id": 1, "name": "TV", "group": "living", "board": null,
+ "desc": null}
+{"type": "code", "id": 1, "device_id": 1, "name": "power", "code": "5B00..."}
+```
+``id`` is optional on import. Codes may refer to the devices imported
+earlier in the same stream.
+Records are validated one by one, duplicated codes (same code hash) are
+skipped, and the
+codes are inserted in batched transactions.
+The export streams the rows from the database cursor.
+
+Usage
+-----
+```
+$ python -m adrsir.bulk export > backup.ndjson
+$ python -m adrsir.bulk import backup.ndjson
+```
+
+"""
+
+import argparse
+import json
+import sys
+
+from pydantic import ValidationError
+
+from . import crud, irpack, models, schemas
+
+# Max number of errors reported
+MAX_ERRORS = 100
+
+
+class Importer:
+    """
+    Incremental NDJSON importer
+
+    importer = Importer(db)
+    for line in lines:
+        importer.feed([line])
+    report = importer.finish()
+    """
+
+    def __init__(self, db, batch_size=500):
+        self.db = db
+        self.batch_size = batch_size
+        self.line_no = 0
+        self.devices = 0
+        self.codes = 0
+        self.duplicates = 0
+        self.errors = []
+        self._codes = []
+        self._device_ids = {row.id for row in db.query(models.Device.id)}
+        self._code_ids = {row.id for row in db.query(models.Code.id)}
+        self._code_hashes = {row.code_hash for row in db.query(models.Code.code_hash)}
+
+    def feed(self, lines):
+        """
+        Import the lines
+        """
+        for line in lines:
+            self.line_no += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Record must be an object")
+                record_type = record.pop("type", "code")
+                if record_type == "device":
+                    self._device(record)
+                elif record_type == "code":
+                    self._code(record)
+                else:
+                    raise ValueError(f"Unknown type: {record_type}")
+            except (ValueError, ValidationError) as e:
+                if len(self.errors) < MAX_ERRORS:
+                    self.errors.append({"line": self.line_no, "error": str(e)})
+        if len(self._codes) >= self.batch_size:
+            self._flush()
+
+    def finish(self):
+        """
+        Insert the remaining codes and return the report
+        """
+        self._flush()
+        return {
+            "lines": self.line_no,
+            "devices": self.devices,
+            "codes": self.codes,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+        }
+
+    def _device(self, record):
+        device_id = record.pop("id", None)
+        device = schemas.DeviceCreate(**record)
+        if device_id is not None and device_id in self._device_ids:
+            raise ValueError(f"Device {device_id} already exists")
+        db_device = models.Device(id=device_id, **device.dict())
+        self.db.add(db_device)
+        self.db.flush()
+        self._device_ids.add(db_device.id)
+        self.devices += 1
+
+    def _code(self, record):
+        code_id = record.pop("id", None)
+        code = schemas.CodeCreate(**record)
+        if code.device_id not in self._device_ids:
+            raise ValueError(f"Device {code.device_id} does NOT exist")
+        if code_id is not None and code_id in self._code_ids:
+            raise ValueError(f"Code {code_id} already exists")
+        data = crud.code_to_bytes(code.code)
+        code_hash = models.code_hash(data)
+        if code_hash in self._code_hashes:
+            self.duplicates += 1
+            return
+        self._code_hashes.add(code_hash)
+        if code_id is not None:
+            self._code_ids.add(code_id)
+        self._codes.append(
+            {
+                "id": code_id,
+                "name": code.name,
+                "device_id": code.device_id,
+                "data": irpack.pack(data),
+                "code_hash": code_hash,
+                "desc": code.desc,
+            }
+        )
+
+    def _flush(self):
+        if self._codes:
+            self.db.bulk_insert_mappings(models.Code, self._codes)
+            self.codes += len(self._codes)
+            self._codes = []
+        crud.bump_generation(self.db)
+        self.db.commit()
+
+
+def export_ndjson(db, chunk=500):
+    """
+    Yield the devices and codes as NDJSON lines
+    """
+    devices = (
+        db.query(models.Device)
+        .order_by(models.Device.id)
+        .execution_options(stream_results=True)
+        .yield_per(chunk)
+    )
+    for device in devices:
+        record = {
+            "type": "device",
+            "id": device.id,
+            "name": device.name,
+            "group": device.group,
+            "board": device.board,
+            "desc": device.desc,
+        }
+        yield json.dumps(record) + "\n"
+    codes = (
+        db.query(
+            models.Code.id,
+            models.Code.device_id,
+            models.Code.name,
+            models.Code.data,
+            models.Code.desc,
+        )
+        .order_by(models.Code.id)
+        .execution_options(stream_results=True)
+        .yield_per(chunk)
+    )
+    for row in codes:
+        record = {
+            "type": "code",
+            "id": row.id,
+            "device_id": row.device_id,
+            "name": row.name,
+            "code": irpack.unpack(row.data).hex().upper(),
+            "desc": row.desc,
+        }
+        yield json.dumps(record) + "\n"
+
+
+if __name__ == "__main__":
+    from . import migrations
+    from .database import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(prog="python -m adrsir.bulk")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("file", nargs="?", default="-", help="NDJSON file or -")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    migrations.migrate(engine)
+    db = SessionLocal()
+    try:
+        if args.command == "import":
+            f = sys.stdin if args.file == "-" else open(args.file)
+            with f:
+                importer = Importer(db, batch_size=args.batch_size)
+                for line in f:
+                    importer.feed([line])
+                report = importer.finish()
+            print(json.dumps(report, indent=2))
+        else:
+            f = sys.stdout if args.file == "-" else open(args.file, "w")
+            with f:
+                for line in export_ndjson(db):
+                    f.write(line)
+    finally:
+        db.close()
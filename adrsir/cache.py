@@ -0,0 +1,83 @@
+"""
+In-memory Caches
+================
+
+`payloads` maps a code id to ``(device_id, data, board)`` where data is
+the decoded binary payload of the code and board the boards of its
+device, so that a transmit by id goes from the cache straight to the
+bus.
+Entries are invalidated by `crud.update_code`, `crud.delete_code` and
+`crud.delete_device`, and the whole cache by `crud.update_device`.
+The bulk import only adds codes, so it has nothing to invalidate.
+
+With several gunicorn workers (ADRSIR_WORKERS > 1) another process may
+write to the database, so every lookup (`crud.get_code_payload`) reads
+the write generation first and the whole cache is cleared when it has
+changed. A single worker skips that query, and a hit costs no database
+access at all.
+The size is set by ADRSIR_PAYLOAD_CACHE_SIZE (default: 256).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Write generation of the entries
+        self.generation = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sync(self, generation):
+        """
+        Clear the entries if the generation has changed
+        """
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+
+    def __len__(self):
+        return len(self._data)
+
+
+payloads = LRUCache(int(os.environ.get("ADRSIR_PAYLOAD_CACHE_SIZE", "256")))
+# Other processes write to the database too
+SHARED = int(os.environ.get("ADRSIR_WORKERS", "1")) > 1
@@ -0,0 +1,285 @@
+"""
+Cluster
+=======
+
+A node with peers (ADRSIR_PEERS) works as the coordinator of a cluster
+of ADRSIR-API nodes, e.g. one Raspberry Pi per room, each with its own
+database.
+```
+ADRSIR_PEERS="living=http://10.0.0.2:8000,bedroom=http://10.0.0.3:8000"
+```
+* The devices of all the nodes are listed by ``GET /cluster/devices/``.
+* ``/devices/{device_id}/codes/{code_id}/transmit`` of a device which is
+  not local is forwarded to the node owning the device. The routing
+  table maps the device IDs to the nodes, so the device IDs should be
+  unique across the cluster. A device ID found on more than one peer is
+  a conflict (409), and is transmitted by
+  ``/cluster/{node}/devices/{device_id}/codes/{code_id}/transmit``.
+* ``/groups/{group}/transmit`` is sent to all the nodes at once.
+
+The peers are called over pooled keep-alive connections (http.client),
+and every call has a timeout (ADRSIR_PEER_TIMEOUT), so a slow or dead
+peer only drops its own part of the result.
+Forwarded requests carry the X-Adrsir-Forwarded header and are never
+forwarded again.
+
+Usage
+-----
+```
+cluster = Cluster("a=http://127.0.0.1:8001,b=http://127.0.0.1:8002")
+results = await cluster.gather(fetch_devices, time.monotonic() + 2.0)
+peer = await cluster.route(device_id)
+status, headers, body = peer.request("POST", path)
+```
+
+"""
+
+import asyncio
+import http.client
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+# Header of the requests forwarded by the coordinator
+FORWARDED = "X-Adrsir-Forwarded"
+
+# Device fields fetched from the peers
+DEVICE_FIELDS = "id,name,group,board,desc"
+
+
+class PeerError(Exception):
+    """
+    Raised when a peer does not answer properly
+    """
+
+
+def parse_peers(spec):
+    """
+    Parse "a=http://127.0.0.1:8001,b=http://127.0.0.1:8002" into
+    [("a", "http://127.0.0.1:8001"), ("b", "http://127.0.0.1:8002")]
+    """
+    peers = []
+    for item in spec.replace(" ", "").split(","):
+        if not item:
+            continue
+        name, _, url = item.partition("=")
+        parsed = urllib.parse.urlsplit(url)
+        if not name or parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"Invalid peer: {item}")
+        peers.append((name, url.rstrip("/")))
+    if len({name for name, _ in peers}) != len(peers):
+        raise ValueError("Peer names must be unique")
+    return peers
+
+
+class Peer:
+    """
+    Peer node with a pool of keep-alive connections
+    """
+
+    def __init__(self, name, url, timeout=2.0, pool_size=4):
+        parsed = urllib.parse.urlsplit(url)
+        self.name = name
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.https = parsed.scheme == "https"
+        self.base = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        self.total_time = 0.0
+        self._pool = queue.LifoQueue(pool_size)
+
+    def _connect(self, timeout):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _fail(self, error):
+        self.errors += 1
+        self.last_error = repr(error)
+        return PeerError(f"{self.name}: {error!r}")
+
+    def request(self, method, path, body=None, timeout=None):
+        """
+        Send the request and return (status, headers, body)
+
+        headers are lower-cased. A connection closed by the peer while
+        idle in the pool is retried once on a new connection.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        headers = {FORWARDED: "1"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        started = time.monotonic()
+        self.requests += 1
+        for attempt in range(2):
+            try:
+                conn = self._pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self._connect(timeout)
+                reused = False
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, self.base + path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise self._fail(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise self._fail(e)
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            self.total_time += time.monotonic() - started
+            return (
+                response.status,
+                {k.lower(): v for k, v in response.getheaders()},
+                data,
+            )
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def to_dict(self):
+        answered = self.requests - self.errors
+        return {
+            "name": self.name,
+            "url": self.url,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "mean_time": self.total_time / answered if answered else 0.0,
+            "idle_connections": self._pool.qsize(),
+        }
+
+
+def fetch_devices(peer, deadline):
+    """
+    Fetch all the devices of the peer (following the pages) before the
+    deadline (time.monotonic)
+    """
+    devices = []
+    query = {"fields": DEVICE_FIELDS, "limit": 500}
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise peer._fail(TimeoutError("device listing timed out"))
+        path = "/devices/?" + urllib.parse.urlencode(query)
+        status, headers, body = peer.request("GET", path, timeout=remaining)
+        if status != 200:
+            raise peer._fail(PeerError(f"HTTP {status}"))
+        devices.extend(json.loads(body))
+        if "x-next-cursor" not in headers:
+            return devices
+        query["after"] = headers["x-next-cursor"]
+
+
+class Cluster:
+    """
+    Peers and the routing table of the devices
+
+    route_ttl: seconds the routing table is trusted
+    """
+
+    def __init__(self, spec, timeout=2.0, route_ttl=30.0, pool_size=4):
+        self.timeout = timeout
+        self.route_ttl = route_ttl
+        self.peers = OrderedDict(
+            (name, Peer(name, url, timeout=timeout, pool_size=pool_size))
+            for name, url in parse_peers(spec)
+        )
+        # {device_id: peer name}
+        self.routes = {}
+        # Device IDs found on more than one peer
+        self.conflicts = set()
+        self.routed_at = None
+        self._lock = threading.Lock()
+
+    async def gather(self, fn, *args):
+        """
+        Run fn(peer, *args) for all the peers concurrently and return
+        {peer name: result or PeerError}
+        """
+        peers = list(self.peers.values())
+        results = await asyncio.gather(
+            *[run_in_threadpool(fn, peer, *args) for peer in peers],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, PeerError):
+                raise result
+        return OrderedDict(zip([peer.name for peer in peers], results))
+
+    async def list_devices(self):
+        """
+        Get {peer name: devices or PeerError} and update the routing table
+        """
+        results = await self.gather(fetch_devices, time.monotonic() + self.timeout)
+        self.update_routes(results)
+        return results
+
+    def update_routes(self, results):
+        routes = {}
+        conflicts = set()
+        for name, devices in results.items():
+            if isinstance(devices, PeerError):
+                # Keep the routes of the unreachable peer
+                devices = [
+                    {"id": device_id}
+                    for device_id, peer in self.routes.items()
+                    if peer == name
+                ]
+            for device in devices:
+                if device["id"] in routes:
+                    conflicts.add(device["id"])
+                else:
+                    routes[device["id"]] = name
+        with self._lock:
+            self.routes = routes
+            self.conflicts = conflicts
+            self.routed_at = time.monotonic()
+
+    async def route(self, device_id):
+        """
+        Get the Peer owning the device (None: unknown)
+
+        The routing table is refreshed when it is older than route_ttl,
+        or on a miss if it is older than 1 sec.
+        """
+        age = None if self.routed_at is None else time.monotonic() - self.routed_at
+        if age is None or age > self.route_ttl:
+            await self.list_devices()
+        elif device_id not in self.routes and age > 1.0:
+            await self.list_devices()
+        name = self.routes.get(device_id)
+        return self.peers[name] if name else None
+
+    def to_dict(self):
+        return {
+            "peers": [peer.to_dict() for peer in self.peers.values()],
+            "routes": len(self.routes),
+            "conflicts": sorted(self.conflicts),
+        }
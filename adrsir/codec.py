@@ -0,0 +1,82 @@
+"""
+IR Payload Codec
+================
+
+Conversions between the code strings (hex digits) and the payloads sent
+to the board, shared by `AdrsirCtrl.read`, `write` and `transmit`.
+
+The board works in DATA units of 4 bytes (DATA_NUM of them), so a
+payload is framed to a multiple of 4 bytes: the trailing bytes are
+dropped, or rejected with ``strict=True`` (the raw codes of /transmit/
+and /write/, while the stored codes are framed leniently).
+A framed payload is a memoryview, so the 4-byte chunks are sliced
+without copying the payload.
+
+Usage
+-----
+```
+data = decode("5B0018002E001800")   # b"\\x5b\\x00\\x18..."
+view = frame(data)                    # memoryview of 4n bytes
+for chunk in chunks(view):            # [0x5B, 0x00, 0x18, 0x00], ...
+    bus.write_i2c_block_data(address, 0x39, chunk)
+assert encode(join(blocks)) == "5B0018002E001800"
+```
+
+"""
+
+# Bytes of a DATA unit
+UNIT = 4
+
+
+def decode(code):
+    """
+    Decode the code string into bytes (bytes-like objects are copied
+    as they are)
+    ValueError if the code has an odd number of digits or a non hex digit
+    """
+    if isinstance(code, (bytes, bytearray, memoryview)):
+        return bytes(code)
+    if len(code) % 2:
+        raise ValueError("code must have an even number of hex digits")
+    return bytes.fromhex(code)
+
+
+def encode(data):
+    """
+    Encode bytes (or a list of ints) into the upper case code string
+    """
+    return bytes(data).hex().upper()
+
+
+def frame(data, strict=False):
+    """
+    memoryview of the DATA units of the payload (the trailing bytes which
+    do not fill a unit are dropped, or ValueError with strict)
+    """
+    view = memoryview(data)
+    extra = len(view) % UNIT
+    if extra and strict:
+        raise ValueError(f"payload must be a multiple of {UNIT} bytes")
+    return view[: len(view) - extra]
+
+
+def data_num(view):
+    """
+    DATA_NUM of the framed payload as [DATA_NUM_H, DATA_NUM_L]
+    """
+    count = len(view) // UNIT
+    return [count >> 8, count & 0xFF]
+
+
+def chunks(view):
+    """
+    The DATA units of the framed payload as lists of ints (I2C blocks)
+    """
+    return [view[i : i + UNIT].tolist() for i in range(0, len(view), UNIT)]
+
+
+def join(blocks):
+    """
+    Join the blocks read from the board into bytes
+    """
+    return b"".join(map(bytes, blocks))
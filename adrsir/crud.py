@@ -1,27 +1,145 @@
-from sqlalchemy import asc
-from sqlalchemy.orm import Session
+from typing import List
 
-from . import models, schemas
+from sqlalchemy import asc, text
+from sqlalchemy.orm import Session, selectinload
 
+from . import cache, irpack, models, schemas
 
-def get_device(db: Session, device_id: int):
+
+def code_to_bytes(code_str: str):
+    """
+    Decode code string to bytes (a trailing odd digit is ignored)
+    """
+    return bytes.fromhex(code_str[: len(code_str) // 2 * 2])
+
+
+def get_generation(db: Session):
+    """
+    Get the write generation (bumped by every write of devices, codes and
+    scenes)
+    """
+    db_meta = db.query(models.Meta).filter(models.Meta.key == "generation").first()
+    return db_meta.value if db_meta else 0
+
+
+def bump_generation(db: Session):
+    """
+    Bump the write generation in the current transaction
+    """
+    db.execute(
+        text(
+            "INSERT INTO meta (key, value) VALUES ('generation', 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+    )
+
+
+def get_cached_response(db: Session, key: str, generation: int):
+    """
+    Get the cached response of the generation
+    """
+    return (
+        db.query(models.CachedResponse)
+        .filter(models.CachedResponse.key == key)
+        .filter(models.CachedResponse.generation == generation)
+        .first()
+    )
+
+
+def set_cached_response(
+    db: Session,
+    key: str,
+    generation: int,
+    body: bytes,
+    media_type: str,
+    headers: str = None,
+):
+    """
+    Cache the response and drop the responses of the old generations
+    """
+    db.query(models.CachedResponse).filter(
+        models.CachedResponse.generation < generation
+    ).delete(synchronize_session=False)
+    # Another worker may have cached the same key since the lookup
+    db.execute(
+        text(
+            "INSERT OR REPLACE INTO response_cache "
+            "(key, generation, body, media_type, headers) "
+            "VALUES (:key, :generation, :body, :media_type, :headers)"
+        ),
+        {
+            "key": key,
+            "generation": generation,
+            "body": body,
+            "media_type": media_type,
+            "headers": headers,
+        },
+    )
+    db.commit()
+
+
+def _page(query, column, skip: int = 0, limit: int = None, after: int = None):
+    """
+    Rows ordered by column, after the cursor value (keyset pagination)
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    query = query.order_by(asc(column))
+    if skip:
+        query = query.offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def _devices(db: Session, include_codes: bool):
+    query = db.query(models.Device)
+    if include_codes:
+        # Load the codes of all devices in one query
+        query = query.options(selectinload(models.Device.codes))
+    return query
+
+
+def get_device(db: Session, device_id: int, include_codes: bool = False):
     """
     Get Device by ID
     """
-    return db.query(models.Device).filter(models.Device.id == device_id).first()
+    return _devices(db, include_codes).filter(models.Device.id == device_id).first()
 
 
-def get_devices(db: Session, skip: int = 0, limit: int = 100):
+def get_devices(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    include_codes: bool = True,
+    after: int = None,
+):
     """
     Get Device list (default: up to 100 devices)
     """
-    return (
-        db.query(models.Device)
-        .order_by(asc(models.Device.id))
-        .offset(skip)
-        .limit(limit)
-        .all()
+    return _page(_devices(db, include_codes), models.Device.id, skip, limit, after)
+
+
+def get_device_summaries(
+    db: Session,
+    group: str = None,
+    skip: int = 0,
+    limit: int = 100,
+    after: int = None,
+):
+    """
+    Get (id, name, group, board, desc) of Devices without their codes
+    """
+    query = db.query(
+        models.Device.id,
+        models.Device.name,
+        models.Device.group,
+        models.Device.board,
+        models.Device.desc,
     )
+    if group:
+        query = query.filter(models.Device.group == group)
+    return _page(query, models.Device.id, skip, limit, after)
 
 
 def get_devices_by_name(db: Session, name: str):
@@ -36,18 +154,19 @@ def get_devices_by_name(db: Session, name: str):
     )
 
 
-def get_devices_by_group(db: Session, group: str, skip: int = 0, limit: int = 100):
+def get_devices_by_group(
+    db: Session,
+    group: str,
+    skip: int = 0,
+    limit: int = 100,
+    include_codes: bool = True,
+    after: int = None,
+):
     """
     Get Devices by Group
     """
-    return (
-        db.query(models.Device)
-        .filter(models.Device.group == group)
-        .order_by(asc(models.Device.id))
-        .offset(skip)
-        .limit(limit)
-        .all()
-    )
+    query = _devices(db, include_codes).filter(models.Device.group == group)
+    return _page(query, models.Device.id, skip, limit, after)
 
 
 def get_groups(db: Session):
@@ -58,12 +177,28 @@ def get_groups(db: Session):
     return sorted(set(groups))
 
 
+def get_group_code_ids(db: Session, group: str, code_name: str):
+    """
+    Get IDs of the Codes named code_name of the Devices in the Group
+    """
+    rows = (
+        db.query(models.Code.id)
+        .join(models.Device, models.Device.id == models.Code.device_id)
+        .filter(models.Device.group == group)
+        .filter(models.Code.name == code_name)
+        .order_by(asc(models.Code.id))
+        .all()
+    )
+    return [row.id for row in rows]
+
+
 def create_device(db: Session, device: schemas.DeviceCreate):
     """
     Create Device
     """
     db_device = models.Device(**device.dict())
     db.add(db_device)
+    bump_generation(db)
     db.commit()
     db.refresh(db_device)
     return db_device
@@ -76,8 +211,12 @@ def update_device(db: Session, device_id: int, device: schemas.DeviceUpdate):
     db_device = db.query(models.Device).filter(models.Device.id == device_id).one()
     db_device.name = device.name
     db_device.group = device.group
+    db_device.board = device.board
     db_device.desc = device.desc
+    bump_generation(db)
     db.commit()
+    # The payloads hold the board of the device
+    cache.payloads.clear()
     return db.query(models.Device).filter(models.Device.id == device_id).first()
 
 
@@ -90,11 +229,15 @@ def delete_device(db: Session, device_id: int):
         db.query(models.Code).filter(models.Code.device_id == device_id).all()
     )
     for code in target_codes:
-        db.delete(target_codes)
-        db.commit()
+        db.delete(code)
+    bump_generation(db)
+    db.commit()
+    for code in target_codes:
+        cache.payloads.invalidate(code.id)
     # Delete Device
     target_device = db.query(models.Device).filter(models.Device.id == device_id).one()
     db.delete(target_device)
+    bump_generation(db)
     db.commit()
 
     return target_device
@@ -107,36 +250,89 @@ def get_code(db: Session, code_id: int):
     return db.query(models.Code).filter(models.Code.id == code_id).first()
 
 
+def _payloads(db: Session):
+    return db.query(
+        models.Code.id, models.Code.device_id, models.Code.data, models.Device.board
+    ).outerjoin(models.Device, models.Device.id == models.Code.device_id)
+
+
+def sync_payloads(db: Session):
+    """
+    Clear the payload cache if another process has written to the database
+    (only with several workers)
+    """
+    if cache.SHARED:
+        cache.payloads.sync(get_generation(db))
+
+
+def get_code_payload(db: Session, code_id: int):
+    """
+    Get (device_id, decoded code, board) of Code by ID through the payload
+    cache
+    """
+    sync_payloads(db)
+    payload = cache.payloads.get(code_id)
+    if payload is None:
+        row = _payloads(db).filter(models.Code.id == code_id).first()
+        if row is None:
+            return None
+        payload = (row.device_id, irpack.unpack(row.data), row.board)
+        cache.payloads.put(code_id, payload)
+    return payload
+
+
+def get_code_payloads(db: Session, code_ids: List[int]):
+    """
+    Get {code_id: (device_id, decoded code, board)} of Codes in one query
+    """
+    sync_payloads(db)
+    payloads = {}
+    missing = []
+    for code_id in set(code_ids):
+        payload = cache.payloads.get(code_id)
+        if payload is None:
+            missing.append(code_id)
+        else:
+            payloads[code_id] = payload
+    if missing:
+        rows = _payloads(db).filter(models.Code.id.in_(missing)).all()
+        for row in rows:
+            payloads[row.id] = (row.device_id, irpack.unpack(row.data), row.board)
+            cache.payloads.put(row.id, payloads[row.id])
+    return payloads
+
+
 def get_code_by_code_str(db: Session, code_str: str):
     """
     Get Code by code string
     """
-    return db.query(models.Code).filter(models.Code.code == code_str).first()
+    return get_code_by_hash(db, models.code_hash(code_to_bytes(code_str)))
 
 
-def get_codes(db: Session, skip: int = 0, limit: int = 1000):
+def get_code_by_hash(db: Session, code_hash: str):
     """
-    Get Codes list (default: up to 1000)
+    Get Code by code hash
     """
     return (
-        db.query(models.Code)
-        .order_by(asc(models.Code.id))
-        .offset(skip)
-        .limit(limit)
-        .all()
+        db.query(models.Code).filter(models.Code.code_hash == code_hash.lower()).first()
     )
 
 
-def get_codes_of_device(db: Session, device_id: int):
+def get_codes(db: Session, skip: int = 0, limit: int = 1000, after: int = None):
+    """
+    Get Codes list (default: up to 1000)
+    """
+    return _page(db.query(models.Code), models.Code.id, skip, limit, after)
+
+
+def get_codes_of_device(
+    db: Session, device_id: int, skip: int = 0, limit: int = None, after: int = None
+):
     """
-    Get Codes list of Device
+    Get Codes list of Device (default: all codes)
     """
-    return (
-        db.query(models.Code)
-        .filter(models.Code.device_id == device_id)
-        .order_by(asc(models.Code.id))
-        .all()
-    )
+    query = db.query(models.Code).filter(models.Code.device_id == device_id)
+    return _page(query, models.Code.id, skip, limit, after)
 
 
 def get_code_of_device(db: Session, device_id: int, code_id: int):
@@ -157,6 +353,7 @@ def create_code(db: Session, code: schemas.CodeCreate):
     """
     db_code = models.Code(**code.dict())
     db.add(db_code)
+    bump_generation(db)
     db.commit()
     db.refresh(db_code)
     return db_code
@@ -171,7 +368,9 @@ def update_code(db: Session, code_id: int, code: schemas.CodeUpdate):
     db_code.device_id = code.device_id
     db_code.code = code.code
     db_code.desc = code.desc
+    bump_generation(db)
     db.commit()
+    cache.payloads.invalidate(code_id)
     return db.query(models.Code).filter(models.Code.id == code_id).first()
 
 
@@ -181,7 +380,9 @@ def delete_code(db: Session, code_id: int):
     """
     target_code = db.query(models.Code).filter(models.Code.id == code_id).one()
     db.delete(target_code)
+    bump_generation(db)
     db.commit()
+    cache.payloads.invalidate(code_id)
     return target_code
 
 
@@ -196,5 +397,85 @@ def delete_code_of_device(db: Session, device_id: int, code_id: int):
         .one()
     )
     db.delete(target_code)
+    bump_generation(db)
     db.commit()
+    cache.payloads.invalidate(code_id)
     return target_code
+
+
+def get_slots(db: Session):
+    """
+    Get Flash Slots
+    """
+    return db.query(models.Slot).order_by(asc(models.Slot.mem_id)).all()
+
+
+def set_slot(db: Session, mem_id: int, code_id: int, data: bytes):
+    """
+    Set the Code resident in the Flash Slot (code_id=None to clear)
+    """
+    db_slot = db.query(models.Slot).filter(models.Slot.mem_id == mem_id).first()
+    if db_slot is None:
+        db_slot = models.Slot(mem_id=mem_id)
+        db.add(db_slot)
+    db_slot.code_id = code_id
+    db_slot.data = data
+    db.commit()
+    return db_slot
+
+
+def get_scene(db: Session, scene_id: int):
+    """
+    Get Scene by ID
+    """
+    return db.query(models.Scene).filter(models.Scene.id == scene_id).first()
+
+
+def get_scenes(db: Session, skip: int = 0, limit: int = 100, after: int = None):
+    """
+    Get Scene list (default: up to 100 scenes)
+    """
+    return _page(db.query(models.Scene), models.Scene.id, skip, limit, after)
+
+
+def _scene_steps(scene: schemas.SceneCreate):
+    return [
+        models.SceneStep(position=i, **step.dict())
+        for i, step in enumerate(scene.steps)
+    ]
+
+
+def create_scene(db: Session, scene: schemas.SceneCreate):
+    """
+    Create Scene
+    """
+    db_scene = models.Scene(name=scene.name, desc=scene.desc, steps=_scene_steps(scene))
+    db.add(db_scene)
+    bump_generation(db)
+    db.commit()
+    db.refresh(db_scene)
+    return db_scene
+
+
+def update_scene(db: Session, scene_id: int, scene: schemas.SceneUpdate):
+    """
+    Update Scene (the steps are replaced)
+    """
+    db_scene = db.query(models.Scene).filter(models.Scene.id == scene_id).one()
+    db_scene.name = scene.name
+    db_scene.desc = scene.desc
+    db_scene.steps = _scene_steps(scene)
+    bump_generation(db)
+    db.commit()
+    return db.query(models.Scene).filter(models.Scene.id == scene_id).first()
+
+
+def delete_scene(db: Session, scene_id: int):
+    """
+    Delete Scene and its steps
+    """
+    target_scene = db.query(models.Scene).filter(models.Scene.id == scene_id).one()
+    db.delete(target_scene)
+    bump_generation(db)
+    db.commit()
+    return target_scene
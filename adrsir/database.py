@@ -1,10 +1,83 @@
-from sqlalchemy import create_engine
+"""
+Database Engine
+===============
+
+The SQLite engine is tuned by a profile (ADRSIR_DB_PROFILE) so that
+several gunicorn workers can share the database file.
+
+* ``wal`` (default): WAL journal, so readers do not block the writer,
+  ``synchronous=NORMAL``, busy timeout and memory-mapped I/O
+* ``compat``: SQLite defaults (rollback journal), for file systems
+  without shared memory support (e.g. network file systems)
+
+Every pragma can be overridden by ADRSIR_DB_<PRAGMA>, e.g.
+ADRSIR_DB_BUSY_TIMEOUT=10000, and the connections are pooled
+(ADRSIR_DB_POOL_SIZE, ADRSIR_DB_MAX_OVERFLOW).
+"""
+
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL = os.environ.get("ADRSIR_DB_URL", "sqlite:///./database.sqlite3")
+
+PROFILES = {
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        # msec to wait for the lock held by another connection
+        "busy_timeout": "5000",
+        # bytes (256 MiB)
+        "mmap_size": "268435456",
+    },
+    "compat": {
+        "busy_timeout": "5000",
+    },
+}
+
+
+def get_pragmas(profile=None):
+    """
+    Pragmas of the profile with the ADRSIR_DB_<PRAGMA> overrides
+    """
+    profile = profile or os.environ.get("ADRSIR_DB_PROFILE", "wal")
+    if profile not in PROFILES:
+        raise ValueError(f"ADRSIR_DB_PROFILE must be one of {', '.join(PROFILES)}")
+    pragmas = dict(PROFILES[profile])
+    for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size"):
+        value = os.environ.get(f"ADRSIR_DB_{name.upper()}")
+        if value:
+            pragmas[name] = value
+    return pragmas
+
+
+def make_engine(url=DATABASE_URL, profile=None):
+    """
+    Create the SQLite engine of the profile
+    """
+    pragmas = get_pragmas(profile)
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=int(os.environ.get("ADRSIR_DB_POOL_SIZE", "5")),
+        max_overflow=int(os.environ.get("ADRSIR_DB_MAX_OVERFLOW", "10")),
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return engine
 
-DATABASE_URL = "sqlite:///./database.sqlite3"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = make_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -0,0 +1,179 @@
+"""
+Conditional GET Cache
+=====================
+
+The listings polled by the panels are cached in the database, so that
+all gunicorn workers share them.
+Every write of devices, codes and scenes bumps the write generation
+(`crud.bump_generation`), which makes the cached responses and ETags of
+the older generations stale at once.
+
+* ``If-None-Match`` with the current ETag gets ``304 Not Modified``
+* A cached body of the current generation is returned as it is
+* Otherwise the response is built and cached
+
+A response is cached by its path and the query params its endpoint
+takes, so the other params (e.g. a cache buster) share the entry.
+
+Usage
+-----
+```
+app.add_middleware(ConditionalGet, session_factory=SessionLocal)
+```
+
+"""
+
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.dependencies.utils import get_flat_dependant
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+from starlette.routing import Match
+
+from . import crud
+
+# Paths of the cached listings
+CACHED_PATHS = ("/devices/", "/codes/", "/groups/")
+
+
+# {endpoint: names of its query params}
+_query_names = {}
+
+
+def match_route(request):
+    """
+    (route, names of its query params) of the request (None: no route)
+    """
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match != Match.FULL:
+            continue
+        endpoint = getattr(route, "endpoint", None)
+        names = _query_names.get(endpoint)
+        if names is None:
+            dependant = getattr(route, "dependant", None)
+            params = get_flat_dependant(dependant).query_params if dependant else []
+            names = _query_names[endpoint] = frozenset(p.alias for p in params)
+        return route, names
+    return None
+
+
+def cache_key(request, names):
+    """
+    Path and the sorted query params known by the endpoint, so that
+    the other params (e.g. cache busters) do not make new entries
+    """
+    query = sorted(
+        (name, value)
+        for name, value in request.query_params.multi_items()
+        if name in names
+    )
+    return f"{request.url.path}?{urlencode(query)}"
+
+
+def make_etag(key, generation):
+    digest = hashlib.sha1(key.encode()).hexdigest()[:8]
+    return f'W/"g{generation}-{digest}"'
+
+
+def _lookup(session_factory, key):
+    db = session_factory()
+    try:
+        generation = crud.get_generation(db)
+        return generation, crud.get_cached_response(db, key, generation)
+    finally:
+        db.close()
+
+
+def _store(session_factory, key, generation, body, media_type, headers):
+    db = session_factory()
+    try:
+        crud.set_cached_response(
+            db, key, generation, body, media_type, json.dumps(headers)
+        )
+    finally:
+        db.close()
+
+
+def _not_modified(request, etag):
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+class ConditionalGet:
+    """
+    ASGI middleware serving the GET of CACHED_PATHS from the cache
+    (plain ASGI, since the call_next of the http middleware of starlette
+    0.13 fails on Python 3.11)
+    """
+
+    def __init__(self, app, session_factory):
+        self.app = app
+        self.session_factory = session_factory
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or not scope["path"].startswith(CACHED_PATHS)
+        ):
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        matched = match_route(request)
+        if matched is None:
+            await self.app(scope, receive, send)
+            return
+        route, names = matched
+        # Label the responses served from here by their route (metrics)
+        scope["endpoint"] = route.endpoint
+        key = cache_key(request, names)
+        generation, cached = await run_in_threadpool(_lookup, self.session_factory, key)
+        etag = make_etag(key, generation)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _not_modified(request, etag):
+            response = Response(status_code=304, headers=headers)
+        elif cached is not None:
+            headers.update(json.loads(cached.headers or "{}"))
+            response = Response(
+                cached.body, media_type=cached.media_type, headers=headers
+            )
+        else:
+            response = await self.build(scope, receive, send, key, generation, headers)
+            if response is None:
+                return
+        await response(scope, receive, send)
+
+    async def build(self, scope, receive, send, key, generation, headers):
+        """
+        Build the response and cache it if it is 200
+        (None: any other response, sent as it is)
+        """
+        messages = []
+
+        async def buffer(message):
+            messages.append(message)
+
+        await self.app(scope, receive, buffer)
+        if not messages or messages[0]["status"] != 200:
+            for message in messages:
+                await send(message)
+            return None
+        body = b"".join(message.get("body", b"") for message in messages[1:])
+        response_headers = Headers(raw=messages[0]["headers"])
+        media_type = response_headers.get("content-type")
+        # e.g. Link of the next page
+        extra = {
+            k: v
+            for k, v in response_headers.items()
+            if k not in ("content-length", "content-type")
+        }
+        await run_in_threadpool(
+            _store, self.session_factory, key, generation, body, media_type, extra
+        )
+        headers.update(extra)
+        return Response(body, status_code=200, media_type=media_type, headers=headers)
@@ -0,0 +1,114 @@
+"""
+Compact IR Code Format
+======================
+
+ADRSIR codes are sequences of 16-bit little-endian timings, and a frame
+(pulse, space) pair appears over and over again, often as a whole
+repeated frame.
+`pack` stores a code in the smallest of the following formats and
+`unpack` restores it byte for byte.
+
+* ``0x00`` raw: the code bytes as they are
+* ``0x01`` pairs: dictionary of the timings and run-length coded pairs
+* ``0x02`` pairs compressed with zlib (collapses repeated frames)
+
+Pairs format
+------------
+```
+n, timing[0], ..., timing[n-1]    # n <= 254, uint16 LE each
+p, s                              # one (pulse, space) pair as indexes
+0xFF, count, p, s                 # the pair repeated count times
+```
+Codes whose length is not a multiple of 4 bytes, or with more than 254
+distinct timings, are stored raw.
+
+Usage
+-----
+```
+blob = pack(bytes.fromhex(code))
+assert unpack(blob).hex().upper() == code.upper()
+```
+
+"""
+
+import struct
+import zlib
+
+RAW = 0x00
+PAIRS = 0x01
+PAIRS_ZLIB = 0x02
+
+RUN = 0xFF
+MAX_SYMBOLS = 0xFE
+MAX_RUN = 0xFF
+
+
+def _pack_pairs(data):
+    if len(data) % 4 or not data:
+        return None
+    timings = struct.unpack(f"<{len(data) // 2}H", data)
+    symbols = sorted(set(timings))
+    if len(symbols) > MAX_SYMBOLS:
+        return None
+    index = {t: i for i, t in enumerate(symbols)}
+    body = bytearray([len(symbols)])
+    body += struct.pack(f"<{len(symbols)}H", *symbols)
+    pairs = list(zip(timings[0::2], timings[1::2]))
+    i = 0
+    while i < len(pairs):
+        pair = pairs[i]
+        run = 1
+        while i + run < len(pairs) and pairs[i + run] == pair and run < MAX_RUN:
+            run += 1
+        if run > 2:
+            body += bytes([RUN, run, index[pair[0]], index[pair[1]]])
+        else:
+            body += bytes([index[pair[0]], index[pair[1]]]) * run
+        i += run
+    return bytes(body)
+
+
+def _unpack_pairs(body):
+    n = body[0]
+    symbols = struct.unpack_from(f"<{n}H", body, 1)
+    timings = []
+    i = 1 + 2 * n
+    while i < len(body):
+        if body[i] == RUN:
+            run, p, s = body[i + 1], body[i + 2], body[i + 3]
+            timings.extend((symbols[p], symbols[s]) * run)
+            i += 4
+        else:
+            timings.append(symbols[body[i]])
+            timings.append(symbols[body[i + 1]])
+            i += 2
+    return struct.pack(f"<{len(timings)}H", *timings)
+
+
+def pack(data):
+    """
+    Pack the code bytes into the smallest format
+    """
+    data = bytes(data)
+    candidates = [bytes([RAW]) + data]
+    body = _pack_pairs(data)
+    if body is not None:
+        candidates.append(bytes([PAIRS]) + body)
+        candidates.append(bytes([PAIRS_ZLIB]) + zlib.compress(body, 9))
+    return min(candidates, key=len)
+
+
+def unpack(blob):
+    """
+    Restore the code bytes
+    """
+    if not blob:
+        return bytes()
+    fmt = blob[0]
+    if fmt == RAW:
+        return bytes(blob[1:])
+    if fmt == PAIRS:
+        return _unpack_pairs(blob[1:])
+    if fmt == PAIRS_ZLIB:
+        return _unpack_pairs(zlib.decompress(blob[1:]))
+    raise ValueError(f"unknown code format: {fmt:#04x}")
@@ -1,16 +1,92 @@
-from typing import List, Optional
-
-from fastapi import Depends, FastAPI, HTTPException, Path, Query
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from fastapi import (
+    Body,
+    Depends,
+    FastAPI,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from . import adrsir, crud, models, schemas
+from . import bulk, crud, httpcache, metrics, migrations, schemas, slots, timing, worker
+from .boards import BoardRegistry
+from .cluster import FORWARDED, Cluster, PeerError
 from .database import SessionLocal, engine
 
-models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
-adrsir = adrsir.AdrsirCtrl()
+
+# Time the crud functions and count their queries (ADRSIR_METRICS=1)
+metrics.instrument_module(crud)
+metrics.instrument_engine(engine)
+# Server-Timing of the requests asking for it (ADRSIR_TIMING=1)
+timing.instrument_engine(engine)
+timing.instrument_routing()
+
+
+def forget_board_state(lane):
+    """
+    Called when another process (gunicorn worker) has used the boards
+    """
+    if boards.default in lane.boards:
+        load_slots(reset=True)
+
+
+# Lock file shared by the processes using the bus ("" to disable)
+HW_LOCK = os.environ.get("ADRSIR_HW_LOCK", "adrsir.lock")
+boards = BoardRegistry(
+    os.environ.get("ADRSIR_BOARDS"),
+    reuse_buffer=os.environ.get("ADRSIR_REUSE_BUFFER", "1") != "0",
+    maxsize=int(os.environ.get("ADRSIR_QUEUE_SIZE", "16")),
+    lock_path=HW_LOCK or None,
+    on_foreign=forget_board_state,
+)
+# The default board and its hardware worker
+adrsir = boards.default.ctrl
+hardware = boards.default.lane.worker
+# Seconds to wait for a hardware job
+HW_TIMEOUT = float(os.environ.get("ADRSIR_HW_TIMEOUT", "10"))
+
+# Name of this node in the cluster
+NODE = os.environ.get("ADRSIR_NODE", "local")
+# Peer nodes of the coordinator (None: not a coordinator)
+cluster = (
+    Cluster(
+        os.environ["ADRSIR_PEERS"],
+        timeout=float(os.environ.get("ADRSIR_PEER_TIMEOUT", "2")),
+    )
+    if os.environ.get("ADRSIR_PEERS")
+    else None
+)
+
+metrics.gauge(
+    "adrsir_hardware_queue_depth",
+    "Queued hardware jobs",
+    ["lane"],
+    lambda: {(name,): lane.worker.queue.qsize() for name, lane in boards.lanes.items()},
+)
+
+
+# ETag and shared cache of the listings (inside CORS)
+app.add_middleware(httpcache.ConditionalGet, session_factory=SessionLocal)
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +96,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# {endpoint: path template of the route}
+route_paths = {}
+
+
+def route_path(scope):
+    # The endpoint is set by the router, or by the cache for its hits
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if not route_paths:
+        route_paths.update(
+            (route.endpoint, route.path)
+            for route in app.routes
+            if hasattr(route, "endpoint")
+        )
+    return route_paths.get(endpoint, "unmatched")
+
+
+if metrics.ENABLED:
+    # Request latency by route (outside CORS)
+    app.add_middleware(metrics.RequestMetrics, route=route_path)
+
+
+if timing.ENABLED:
+    # Server-Timing and profile of the request (outermost)
+    app.add_middleware(timing.ServerTiming)
+
 
 def get_db():
     db = SessionLocal()
@@ -29,6 +132,141 @@ def get_db():
         db.close()
 
 
+def in_session(fn, *args, **kwargs):
+    """
+    Run fn(db, *args, **kwargs) in a session of its own, e.g. from an
+    endpoint which must not hold a pooled connection while it waits
+    """
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+def save_slot(mem_id: int, code_id: Optional[int], data: Optional[bytes]):
+    db = SessionLocal()
+    try:
+        crud.set_slot(db=db, mem_id=mem_id, code_id=code_id, data=data)
+    finally:
+        db.close()
+
+
+# The flash slots of the default board
+slot_manager = slots.SlotManager(
+    slots.parse_slots(os.environ.get("ADRSIR_CACHE_SLOTS", "")), on_change=save_slot
+)
+boards.default.slots = slot_manager
+
+
+def load_slots(reset: bool = False):
+    db = SessionLocal()
+    try:
+        slot_manager.load(
+            [(slot.mem_id, slot.code_id, slot.data) for slot in crud.get_slots(db=db)],
+            reset=reset,
+        )
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+def startup():
+    # Nothing to do if gunicorn has already migrated the database
+    migrations.migrate(engine)
+    load_slots()
+
+
+"""
+Health
+======
+GET /healthz --> the process is up
+GET /readyz  --> the database schema is current and the boards are open
+
+/readyz opens the buses which have not been used yet, and returns 503
+with the failed checks if not ready.
+"""
+
+
+@app.get("/healthz")
+async def read_health():
+    """
+    Liveness
+    """
+    return {"status": "ok", "pid": os.getpid()}
+
+
+@app.get("/readyz")
+def read_ready():
+    """
+    Readiness
+    """
+    try:
+        version = migrations.schema_version(engine)
+    except SQLAlchemyError as e:
+        database = repr(e)
+    else:
+        latest = len(migrations.MIGRATIONS)
+        database = None if version == latest else f"schema {version} of {latest}"
+    board_errors = boards.check()
+    ready = database is None and not any(board_errors.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ok" if ready else "unavailable",
+            "database": database or "ok",
+            "boards": {name: error or "ok" for name, error in board_errors.items()},
+        },
+    )
+
+
+"""
+Pagination
+==========
+The list endpoints take limit and after, the opaque cursor of the next
+page. A full page is answered with the cursor of the next page in the
+X-Next-Cursor and Link headers:
+
+Link: </codes/?limit=100&after=aWQ6MTAw>; rel="next"
+
+skip still works but gets slower as it goes deeper.
+"""
+
+
+def encode_cursor(last_id: int):
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+
+def page_cursor(after: Optional[str] = Query(None, description="next page cursor")):
+    """
+    Decode the after cursor
+    """
+    if after is None:
+        return None
+    try:
+        padded = after + "=" * (-len(after) % 4)
+        kind, value = base64.urlsafe_b64decode(padded).decode().split(":")
+        if kind != "id":
+            raise ValueError(kind)
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+
+
+def link_next_page(request: Request, response: Response, items, limit: int):
+    """
+    Set the cursor of the next page if the page is full
+    """
+    if not items or limit is None or len(items) < limit:
+        return response
+    cursor = encode_cursor(items[-1].id)
+    url = request.url.remove_query_params("skip").include_query_params(after=cursor)
+    response.headers["X-Next-Cursor"] = cursor
+    # Relative, as the response may be cached for any host
+    response.headers["Link"] = f'<{url.path}?{url.query}>; rel="next"'
+    return response
+
+
 """
 CRUD Device
 ===========
@@ -37,44 +275,101 @@ GET  /devices/            --> list devices
 GET  /devices/{device_id} --> show device info
 PUT  /devices/{device_id} --> update device
 DEL  /devices/{device_id} --> remove device and its codes
+
+GET takes fields=id,name,group to select the fields of the devices.
+Without "codes" the codes are not loaded at all.
+board is a comma separated list of the boards transmitting the codes of
+the device (default: the default board).
 """
 
+DEVICE_FIELDS = ["id", "name", "group", "board", "desc", "codes"]
+
+
+def device_fields(fields: Optional[str] = Query(None, example="id,name,group")):
+    """
+    Parse the fields query
+    """
+    if fields is None:
+        return DEVICE_FIELDS
+    selected = [f for f in fields.replace(" ", "").split(",") if f]
+    unknown = set(selected) - set(DEVICE_FIELDS)
+    if unknown or not selected:
+        raise HTTPException(
+            status_code=422,
+            detail=f"fields must be some of {','.join(DEVICE_FIELDS)}",
+        )
+    return selected
+
+
+def select_fields(db_devices, selected: List[str]):
+    """
+    Devices as dicts of the selected fields
+    """
+    if "codes" in selected:
+        return [
+            jsonable_encoder(schemas.Device.from_orm(db_device), include=set(selected))
+            for db_device in db_devices
+        ]
+    return [{f: getattr(row, f) for f in selected} for row in db_devices]
+
 
 @app.post("/devices/", response_model=schemas.Device)
 def create_device(device: schemas.DeviceCreate, db: Session = Depends(get_db)):
     """
     Create Device
     """
+    get_boards(device.board)
     return crud.create_device(db=db, device=device)
 
 
 @app.get("/devices/", response_model=List[schemas.Device])
 def read_devices(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    after: Optional[int] = Depends(page_cursor),
     group: Optional[str] = None,
+    fields: List[str] = Depends(device_fields),
     db: Session = Depends(get_db),
 ):
     """
     Get Devices
     """
-    if group:
-        db_devices = crud.get_devices_by_group(
-            db=db, group=group, skip=skip, limit=limit
+    page = {"skip": skip, "limit": limit, "after": after}
+    if "codes" not in fields:
+        db_devices = crud.get_device_summaries(db=db, group=group, **page)
+        return link_next_page(
+            request, JSONResponse(select_fields(db_devices, fields)), db_devices, limit
         )
+    if group:
+        db_devices = crud.get_devices_by_group(db=db, group=group, **page)
     else:
-        db_devices = crud.get_devices(db=db, skip=skip, limit=limit)
+        db_devices = crud.get_devices(db=db, **page)
+    if fields != DEVICE_FIELDS:
+        return link_next_page(
+            request, JSONResponse(select_fields(db_devices, fields)), db_devices, limit
+        )
+    link_next_page(request, response, db_devices, limit)
     return db_devices
 
 
 @app.get("/devices/{device_id}", response_model=schemas.Device)
-def read_device(device_id: int, db: Session = Depends(get_db)):
+def read_device(
+    device_id: int,
+    fields: List[str] = Depends(device_fields),
+    db: Session = Depends(get_db),
+):
     """
     Get Device by ID
     """
-    db_device = crud.get_device(db=db, device_id=device_id)
+    db_device = crud.get_device(
+        db=db, device_id=device_id, include_codes="codes" in fields
+    )
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    if fields != DEVICE_FIELDS:
+        return JSONResponse(select_fields([db_device], fields)[0])
     return db_device
 
 
@@ -88,6 +383,7 @@ def update_device(
     db_device = crud.get_device(db=db, device_id=device_id)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    get_boards(device.board)
     return crud.update_device(db=db, device_id=device_id, device=device)
 
 
@@ -122,15 +418,30 @@ POST /codes/                              --> add code
 POST /devices/{device_id}/codes/          --> add code
 GET  /codes/                              --> list codes
 GET  /codes/{code_id}                     --> show code info
+GET  /codes/by-hash/{code_hash}           --> show code info
 GET  /devices/{device_id}/codes           --> list codes
 GET  /devices/{device_id}/codes/{code_id} --> show code info
 PUT  /codes/{code_id}                     --> update code
 PUT  /devices/{device_id}/codes/{code_id} --> update code
 DEL  /codes/{code_id}                     --> remove code
 DEL  /devices/{device_id}/codes/{code_id} --> remove code
+
+code_hash is the SHA-256 of the lower-case hex of the code, and the
+same code can NOT be registered twice.
 """
 
 
+def save_code(fn, db: Session, **kwargs):
+    """
+    Create or update Code, 400 if the code has been registered meanwhile
+    """
+    try:
+        return fn(db=db, **kwargs)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Code already registered")
+
+
 @app.post("/codes/", response_model=schemas.Code)
 def create_code(code: schemas.CodeCreate, db: Session = Depends(get_db)):
     """
@@ -144,7 +455,7 @@ def create_code(code: schemas.CodeCreate, db: Session = Depends(get_db)):
     if db_code:
         raise HTTPException(status_code=400, detail="Code already registered")
 
-    return crud.create_code(db=db, code=code)
+    return save_code(crud.create_code, db=db, code=code)
 
 
 @app.post("/devices/{device_id}/codes", response_model=schemas.Code)
@@ -154,6 +465,10 @@ def create_device_code(
     """
     Create Code
     """
+    return add_device_code(db, device_id, code)
+
+
+def add_device_code(db: Session, device_id: int, code: schemas.CodeCreateDevice):
     db_device = crud.get_device(db=db, device_id=device_id)
     if db_device is None:
         raise HTTPException(status_code=400, detail="Device does NOT exist")
@@ -164,23 +479,28 @@ def create_device_code(
 
     code_dict = code.dict()
     code_dict.update({"device_id": device_id})
-    return crud.create_code(db=db, code=schemas.CodeCreate(**code_dict))
+    return save_code(crud.create_code, db=db, code=schemas.CodeCreate(**code_dict))
 
 
 @app.get("/codes/", response_model=List[schemas.Code])
 def read_codes(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 1000,
+    after: Optional[int] = Depends(page_cursor),
     device_id: Optional[int] = None,
     db: Session = Depends(get_db),
 ):
     """
     Get Codes
     """
-    if device_id:
-        db_codes = crud.get_codes_of_device(db=db, device_id=device_id)
+    page = {"skip": skip, "limit": limit, "after": after}
+    if device_id is not None:
+        db_codes = crud.get_codes_of_device(db=db, device_id=device_id, **page)
     else:
-        db_codes = crud.get_codes(db=db, skip=skip, limit=limit)
+        db_codes = crud.get_codes(db=db, **page)
+    link_next_page(request, response, db_codes, limit)
     return db_codes
 
 
@@ -198,12 +518,37 @@ def read_code(
     return db_code
 
 
+@app.get("/codes/by-hash/{code_hash}", response_model=schemas.Code)
+def read_code_by_hash(
+    code_hash: str = Path(..., regex=r"^[0-9A-Fa-f]{64}$"),
+    db: Session = Depends(get_db),
+):
+    """
+    Get Code by code hash
+    """
+    db_code = crud.get_code_by_hash(db=db, code_hash=code_hash)
+    if db_code is None:
+        raise HTTPException(status_code=404, detail="Code not found")
+    return db_code
+
+
 @app.get("/devices/{device_id}/codes", response_model=List[schemas.Code])
-def read_device_codes(device_id: int, db: Session = Depends(get_db)):
+def read_device_codes(
+    device_id: int,
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    after: Optional[int] = Depends(page_cursor),
+    db: Session = Depends(get_db),
+):
     """
     Get Codes
     """
-    db_codes = crud.get_codes_of_device(db=db, device_id=device_id)
+    db_codes = crud.get_codes_of_device(
+        db=db, device_id=device_id, skip=skip, limit=limit, after=after
+    )
+    link_next_page(request, response, db_codes, limit)
     return db_codes
 
 
@@ -236,7 +581,7 @@ def update_code(code_id: int, code: schemas.CodeUpdate, db: Session = Depends(ge
         if db_same_code.id != code_id:
             raise HTTPException(status_code=400, detail="Code already registered")
 
-    return crud.update_code(db=db, code_id=code_id, code=code)
+    return save_code(crud.update_code, db=db, code_id=code_id, code=code)
 
 
 @app.put("/devices/{device_id}/codes/{code_id}", response_model=schemas.Code)
@@ -261,8 +606,11 @@ def update_device_code(
     code_dict = code.dict()
     code_dict.update({"id": code_id, "device_id": device_id})
 
-    return crud.update_code(
-        db=db, code_id=code_id, code=schemas.CodeUpdate(**code_dict)
+    return save_code(
+        crud.update_code,
+        db=db,
+        code_id=code_id,
+        code=schemas.CodeUpdate(**code_dict),
     )
 
 
@@ -290,61 +638,1096 @@ def delete_device_code(device_id: int, code_id: int, db: Session = Depends(get_d
     return crud.delete_code(db=db, code_id=code_id)
 
 
+"""
+Bulk Import & Export
+====================
+POST /import/ --> import devices and codes from NDJSON
+GET  /export/ --> export devices and codes as NDJSON
+"""
+
+
+@app.post("/import/")
+async def import_ndjson(request: Request, db: Session = Depends(get_db)):
+    """
+    Import devices and codes from NDJSON
+    """
+    importer = await run_in_threadpool(bulk.Importer, db)
+    rest = b""
+    async for chunk in request.stream():
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        if lines:
+            await run_in_threadpool(
+                importer.feed, [line.decode("utf-8", "replace") for line in lines]
+            )
+    if rest:
+        await run_in_threadpool(importer.feed, [rest.decode("utf-8", "replace")])
+    return await run_in_threadpool(importer.finish)
+
+
+class NDJSONResponse(StreamingResponse):
+    """
+    StreamingResponse which stops streaming when the client disconnects,
+    with tasks (the bare coroutines of starlette 0.13 fail on Python 3.11)
+    """
+
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        tasks = [
+            asyncio.ensure_future(self.stream_response(send)),
+            asyncio.ensure_future(self.listen_for_disconnect(receive)),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+        if self.background is not None:
+            await self.background()
+
+
+@app.get("/export/")
+def export_ndjson():
+    """
+    Export devices and codes as NDJSON
+    """
+
+    def lines():
+        db = SessionLocal()
+        try:
+            yield from bulk.export_ndjson(db)
+        finally:
+            db.close()
+
+    return NDJSONResponse(lines())
+
+
 """
 Read & Transmit the Code
 ========================
 GET  /read/{mem_id}                              --> read the code
 POST /write/{mem_id}                             --> write the code to the memory
+POST /capture/{mem_id}                           --> wait for a code learned
 POST /transmit/                                  --> transmit the code
 POST /codes/{code_id}/transmit                   --> transmit the code
 POST /devices/{devie_id}/codes/{code_id}/trasmit --> transmit the code
+POST /groups/{group}/transmit                    --> transmit the code of the group
+POST /codes/{code_id}/hold                       --> start transmitting repeatedly
+POST /devices/{devie_id}/codes/{code_id}/hold    --> start transmitting repeatedly
+GET  /holds/{hold_id}                            --> show hold status
+DEL  /holds/{hold_id}                            --> stop transmitting
+
+All of them run on the hardware worker of the board one at a time.
+The stored codes are transmitted by the boards of their device, in
+parallel, and the others by the board given by board (default: the
+default board).
+With wait=false they return 202 and the job (the jobs for several
+boards), which can be polled.
+With repeat=n the code is uploaded once and transmitted n times.
+They return 503 with Retry-After when the hardware queue is full,
+and 504 when the job is not done within ADRSIR_HW_TIMEOUT seconds.
+
+On a coordinator, the transmit of a device of a peer is forwarded to the
+peer, and the transmit of a group is sent to all the peers too.
+
+/capture/{mem_id} returns as soon as the slot changes, e.g. after the
+learn button. The slot is polled by DATA_NUM and its first bytes, and
+read in full when they change, and at least every CAPTURE_FULL_READ
+seconds, since two buttons of a remote usually share the length and the
+leader. The fingerprint is DATA_NUM and the digest of the whole code.
+It returns 204 if nothing changed within timeout. With device_id and
+name the captured code is saved as a code of the device.
 """
 
 
+def get_boards(names: Optional[str], status_code: int = 400):
+    """
+    Get the Boards of a comma separated name list
+    """
+    try:
+        return boards.resolve(names)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=status_code, detail=f"Board {e.args[0]} does NOT exist"
+        )
+
+
+def board_query(board: Optional[str] = Query(None, description="board name")):
+    return get_boards(board, status_code=404)[0]
+
+
+def queue_full(hardware: worker.HardwareWorker):
+    return HTTPException(
+        status_code=503,
+        detail="Hardware queue is full",
+        headers={"Retry-After": str(hardware.retry_after())},
+    )
+
+
+async def run_parallel(name: str, wait: bool, calls, timeout: float = 0.0):
+    """
+    Run the calls [(board, fn, args)] on the workers of the boards in
+    parallel and return the list of the results, or 202 and the jobs if
+    wait is False
+    timeout: seconds added to ADRSIR_HW_TIMEOUT
+    """
+    timeout += HW_TIMEOUT
+    jobs = []
+    for board, fn, args in calls:
+        try:
+            jobs.append(
+                board.lane.worker.submit(name, timing.bind(fn), *args, timeout=timeout)
+            )
+        except worker.QueueFull:
+            for job in jobs:
+                job.future.cancel()
+            raise queue_full(board.lane.worker)
+    if not wait:
+        if len(jobs) == 1:
+            return JSONResponse(
+                status_code=202,
+                content=jobs[0].to_dict(),
+                headers={"Location": f"/jobs/{jobs[0].id}"},
+            )
+        return JSONResponse(
+            status_code=202, content={"jobs": [job.to_dict() for job in jobs]}
+        )
+    try:
+        return await asyncio.wait_for(
+            asyncio.gather(*[asyncio.wrap_future(job.future) for job in jobs]),
+            timeout,
+        )
+    except (asyncio.TimeoutError, worker.DeadlineExceeded):
+        raise HTTPException(status_code=504, detail="Hardware timeout")
+
+
+async def run_hardware(
+    name: str, wait: bool, fn, *args, timeout: float = 0.0, board=None
+):
+    """
+    Run fn(*args) on the hardware worker of the board (default: the
+    default board) and return its result, or 202 and the job if wait is
+    False
+    """
+    results = await run_parallel(
+        name, wait, [(board or boards.default, fn, args)], timeout=timeout
+    )
+    return results[0] if isinstance(results, list) else results
+
+
+async def code_payload(db: Session, code_id: int):
+    """
+    Get (device_id, decoded code, board) from the payload cache without
+    blocking
+    With several workers the write generation is checked on every lookup,
+    since another process may have changed or deleted the code.
+    """
+    return await run_in_threadpool(crud.get_code_payload, db=db, code_id=code_id)
+
+
+@metrics.timed("read")
+def hw_read(board, mem_id: int):
+    return {"mem_id": mem_id, "code": board.ctrl.read(mem_id)}
+
+
+@metrics.timed("write")
+def hw_write(board, mem_id: int, code: str):
+    if board.slots:
+        board.slots.release(mem_id)
+    board.ctrl.write(mem_id, code, strict=True)
+    return {"mem_id": mem_id, "code": code}
+
+
+@metrics.timed("transmit")
+def hw_transmit(board, data, repeat: int, interval: float, response: dict):
+    board.ctrl.transmit(data, repeat, interval, strict=True)
+    return response
+
+
+@metrics.timed("transmit")
+def transmit_stored(board, code_id: int, data: bytes, repeat=1, interval=0.0):
+    # Transmit the stored code from the board buffer or its flash slot
+    # if it is already there
+    ctrl = board.ctrl
+    manager = board.slots
+    mem_id = manager.lookup(code_id, data) if manager else None
+    if ctrl.is_loaded(data):
+        ctrl.transmit(data, repeat, interval)
+    elif mem_id is not None:
+        ctrl.transmit_slot(mem_id, repeat, interval)
+    else:
+        mem_id = manager.admit(code_id, data) if manager else None
+        if mem_id is not None:
+            try:
+                ctrl.write(mem_id, data)
+            except Exception:
+                manager.release(mem_id)
+                raise
+        ctrl.transmit(data, repeat, interval)
+
+
+def hw_transmit_code(
+    board, code_id: int, data: bytes, repeat: int, interval: float, response: dict
+):
+    transmit_stored(board, code_id, data, repeat, interval)
+    return response
+
+
+@metrics.timed("transmit")
+def hw_transmit_group(board, transmits, repeat: int, interval: float):
+    # transmits: [(code_id, data, response)] of the board, in one job
+    responses = []
+    for code_id, data, response in transmits:
+        transmit_stored(board, code_id, data, repeat, interval)
+        responses.append(response)
+    return responses
+
+
+async def transmit_payload(
+    code_id: int, payload, repeat: int, interval: float, wait: bool
+):
+    """
+    Transmit the stored code by the boards of its device in parallel
+    """
+    device_id, data, board_names = payload
+    targets = get_boards(board_names, status_code=409)
+    response = {"device_id": device_id, "code_id": code_id}
+    if len(targets) > 1:
+        response["boards"] = [board.name for board in targets]
+    calls = [
+        (board, hw_transmit_code, (board, code_id, data, repeat, interval, response))
+        for board in targets
+    ]
+    results = await run_parallel("transmit", wait, calls, timeout=repeat * interval)
+    return results[0] if isinstance(results, list) else results
+
+
 @app.get("/read/{mem_id}")
-def read_mem(mem_id: int = Path(..., ge=0, le=9)):
+async def read_mem(
+    mem_id: int = Path(..., ge=0, le=9),
+    wait: bool = True,
+    board=Depends(board_query),
+):
     """
     Read the code
     """
-    return {"mem_id": mem_id, "code": adrsir.read(mem_id)}
+    return await run_hardware("read", wait, hw_read, board, mem_id, board=board)
 
 
 @app.post("/write/{mem_id}")
-def write_mem(
+async def write_mem(
     mem_id: int = Path(..., ge=0, le=9),
-    code: str = Query(..., min_length=2, max_length=600, regex=r"^[0-9A-Fa-f]+$"),
+    code: str = Query(..., max_length=600, regex=r"^([0-9A-Fa-f]{8})+$"),
+    wait: bool = True,
+    board=Depends(board_query),
 ):
     """
     Write the code to the memory
     """
-    adrsir.write(mem_id, code)
-    return {"mem_id": mem_id, "code": code}
+    return await run_hardware("write", wait, hw_write, board, mem_id, code, board=board)
+
+
+# Seconds between the full reads of a slot whose first bytes are unchanged
+CAPTURE_FULL_READ = 1.0
+
+
+def code_fingerprint(code: str):
+    digest = hashlib.sha1(bytes.fromhex(code)).hexdigest()[:16].upper()
+    return f"{len(code) // 8:04X}:{digest}"
+
+
+def hw_peek(board, mem_id: int):
+    data_num, prefix = board.ctrl.peek(mem_id)
+    return f"{data_num:04X}:{prefix.hex().upper()}"
+
+
+def hw_fingerprint(board, mem_id: int):
+    # (peek, fingerprint) of the whole code
+    code = board.ctrl.read(mem_id)
+    return f"{len(code) // 8:04X}:{code[:16]}", code_fingerprint(code)
+
+
+def hw_capture(board, mem_id: int):
+    # The slot has been overwritten by the learn button
+    if board.slots:
+        board.slots.release(mem_id)
+    return hw_read(board, mem_id)
+
+
+@app.post("/capture/{mem_id}")
+async def capture_mem(
+    mem_id: int = Path(..., ge=0, le=9),
+    timeout: float = Query(30.0, gt=0.0, le=120.0),
+    interval: float = Query(0.2, ge=0.05, le=5.0),
+    since: Optional[str] = Query(
+        None, regex=r"^[0-9A-Fa-f]{4}:[0-9A-Fa-f]{16}$", description="fingerprint"
+    ),
+    device_id: Optional[int] = None,
+    name: Optional[str] = Query(None, min_length=1),
+    board=Depends(board_query),
+):
+    """
+    Wait for the code learned in the memory
+    """
+    # No session is held during the wait: the device is checked and the
+    # code is saved in sessions of their own
+    if device_id is not None:
+        if name is None:
+            raise HTTPException(status_code=400, detail="name is required")
+        db_device = await run_in_threadpool(
+            in_session, crud.get_device, device_id=device_id
+        )
+        if db_device is None:
+            raise HTTPException(status_code=400, detail="Device does NOT exist")
+
+    deadline = time.monotonic() + timeout
+    full_read_every = max(1, round(CAPTURE_FULL_READ / interval))
+    if since:
+        # Read in full on the first poll
+        peek, baseline = None, since.upper()
+    else:
+        peek, baseline = await run_hardware(
+            "fingerprint", True, hw_fingerprint, board, mem_id, board=board
+        )
+    polls = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return Response(status_code=204, headers={"X-Fingerprint": baseline})
+        await asyncio.sleep(min(interval, remaining))
+        polls += 1
+        last_peek = peek
+        peek = await run_hardware("peek", True, hw_peek, board, mem_id, board=board)
+        if peek == last_peek and polls % full_read_every:
+            continue
+        peek, fingerprint = await run_hardware(
+            "fingerprint", True, hw_fingerprint, board, mem_id, board=board
+        )
+        if fingerprint != baseline:
+            break
+
+    result = await run_hardware("capture", True, hw_capture, board, mem_id, board=board)
+    result["fingerprint"] = code_fingerprint(result["code"])
+    if device_id is not None and result["code"]:
+        code = schemas.CodeCreateDevice(name=name, code=result["code"])
+        result["code_id"] = await run_in_threadpool(
+            in_session, lambda db: add_device_code(db, device_id, code).id
+        )
+    return result
 
 
 @app.post("/transmit/")
-def transmit(code: str = Query(..., min_length=2, max_length=600)):
+async def transmit(
+    code: str = Query(..., max_length=600, regex=r"^([0-9A-Fa-f]{8})+$"),
+    repeat: int = Query(1, ge=1, le=50),
+    interval: float = Query(0.1, ge=0.0, le=10.0),
+    wait: bool = True,
+    board=Depends(board_query),
+):
     """
     Transmit the code
     """
-    adrsir.transmit(code)
-    return {"code": code}
+    return await run_hardware(
+        "transmit",
+        wait,
+        hw_transmit,
+        board,
+        code,
+        repeat,
+        interval,
+        {"code": code},
+        timeout=repeat * interval,
+        board=board,
+    )
 
 
 @app.post("/codes/{code_id}/transmit")
-def transmit_code(code_id: int, db: Session = Depends(get_db)):
+async def transmit_code(
+    code_id: int,
+    repeat: int = Query(1, ge=1, le=50),
+    interval: float = Query(0.1, ge=0.0, le=10.0),
+    wait: bool = True,
+    db: Session = Depends(get_db),
+):
     """
     Transmit the code
     """
-    code = crud.get_code(db=db, code_id=code_id)
-    adrsir.transmit(code.code)
-    return {"device_id": code.device_id, "code_id": code.id}
+    payload = await code_payload(db=db, code_id=code_id)
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Code not found")
+    return await transmit_payload(code_id, payload, repeat, interval, wait)
 
 
 @app.post("/devices/{device_id}/codes/{code_id}/transmit")
-def transmit_device_code(device_id: int, code_id: int, db: Session = Depends(get_db)):
+async def transmit_device_code(
+    device_id: int,
+    code_id: int,
+    request: Request,
+    repeat: int = Query(1, ge=1, le=50),
+    interval: float = Query(0.1, ge=0.0, le=10.0),
+    wait: bool = True,
+    db: Session = Depends(get_db),
+):
     """
     Transmit the code
     """
-    code = crud.get_code_of_device(db=db, device_id=device_id, code_id=code_id)
-    adrsir.transmit(code.code)
-    return {"device_id": device_id, "code_id": code_id}
+    payload = await code_payload(db=db, code_id=code_id)
+    if payload is not None and payload[0] == device_id:
+        return await transmit_payload(code_id, payload, repeat, interval, wait)
+    if cluster and FORWARDED not in request.headers:
+        device = await run_in_threadpool(crud.get_device, db=db, device_id=device_id)
+        if device is None:
+            return await forward_transmit(request, device_id)
+    raise HTTPException(status_code=404, detail="Code not found")
+
+
+async def forward_transmit(request: Request, device_id: int):
+    """
+    Forward the transmit to the peer owning the device
+    """
+    peer = await cluster.route(device_id)
+    if peer is None:
+        raise HTTPException(status_code=404, detail="Code not found")
+    if device_id in cluster.conflicts:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Device {device_id} is on more than one node, "
+            f"use /cluster/{{node}}{request.url.path}",
+        )
+    return await forward(peer, request.url.path, request.url.query)
+
+
+async def forward(peer, path: str, query: str):
+    """
+    Send the transmit to the peer and return its answer
+    """
+    if query:
+        path += "?" + query
+    try:
+        status, headers, body = await run_in_threadpool(
+            peer.request, "POST", path, timeout=HW_TIMEOUT + cluster.timeout
+        )
+    except PeerError:
+        raise HTTPException(status_code=502, detail=f"Peer {peer.name} unreachable")
+    return Response(
+        body,
+        status_code=status,
+        media_type=headers.get("content-type"),
+        headers={"X-Adrsir-Node": peer.name},
+    )
+
+
+@app.post("/groups/{group}/transmit")
+async def transmit_group(
+    group: str,
+    request: Request,
+    code_name: str = Query(..., min_length=1),
+    repeat: int = Query(1, ge=1, le=50),
+    interval: float = Query(0.1, ge=0.0, le=10.0),
+    db: Session = Depends(get_db),
+):
+    """
+    Transmit the code named code_name of every device in the group
+    """
+    fan_out = cluster is not None and FORWARDED not in request.headers
+    if fan_out:
+        path = request.url.path + "?" + request.url.query
+        peers = asyncio.ensure_future(
+            cluster.gather(
+                lambda peer: peer.request(
+                    "POST", path, timeout=HW_TIMEOUT + cluster.timeout
+                )
+            )
+        )
+    try:
+        code_ids = await run_in_threadpool(
+            crud.get_group_code_ids, db=db, group=group, code_name=code_name
+        )
+        payloads = await run_in_threadpool(
+            crud.get_code_payloads, db=db, code_ids=code_ids
+        )
+        # One job per board, so a large group does not fill the queue
+        board_transmits = OrderedDict()
+        for code_id in code_ids:
+            device_id, data, board_names = payloads[code_id]
+            response = {"device_id": device_id, "code_id": code_id}
+            for board in get_boards(board_names, status_code=409):
+                board_transmits.setdefault(board, []).append((code_id, data, response))
+        transmits = []
+        if board_transmits:
+            results = await run_parallel(
+                "transmit",
+                True,
+                [
+                    (board, hw_transmit_group, (board, items, repeat, interval))
+                    for board, items in board_transmits.items()
+                ],
+                timeout=max(len(items) for items in board_transmits.values())
+                * repeat
+                * interval,
+            )
+            transmits = [response for responses in results for response in responses]
+    except BaseException:
+        if fan_out:
+            peers.cancel()
+        raise
+    result = {"group": group, "code_name": code_name, "transmits": transmits}
+    if not fan_out:
+        if not transmits:
+            raise HTTPException(status_code=404, detail="Code not found")
+        return result
+
+    result = {"group": group, "code_name": code_name, "nodes": {NODE: result}}
+    for name, answer in (await peers).items():
+        if isinstance(answer, PeerError):
+            result["nodes"][name] = {"error": str(answer)}
+        else:
+            status, headers, body = answer
+            result["nodes"][name] = (
+                json.loads(body) if status == 200 else {"error": f"HTTP {status}"}
+            )
+    return result
+
+
+def start_holds(payload, interval: float, timeout: float):
+    """
+    Start holding the code on the boards of its device and return the
+    Holds
+    """
+    holds = []
+    for board in get_boards(payload[2], status_code=409):
+        try:
+            hold = board.lane.worker.hold(
+                "hold",
+                board.ctrl.transmit,
+                payload[1],
+                interval=interval,
+                timeout=timeout,
+            )
+        except worker.QueueFull:
+            for hold in holds:
+                hold.stop()
+            raise queue_full(board.lane.worker)
+        holds.append(hold)
+    return holds
+
+
+def start_hold(payload, interval: float, timeout: float):
+    holds = start_holds(payload, interval, timeout)
+    if len(holds) == 1:
+        return holds[0].to_dict()
+    return {"holds": [hold.to_dict() for hold in holds]}
+
+
+@app.post("/codes/{code_id}/hold")
+async def hold_code(
+    code_id: int,
+    interval: float = Query(0.1, ge=0.02, le=10.0),
+    timeout: float = Query(10.0, gt=0.0, le=60.0),
+    db: Session = Depends(get_db),
+):
+    """
+    Start transmitting the code every interval until stopped
+    """
+    payload = await code_payload(db=db, code_id=code_id)
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Code not found")
+    return start_hold(payload, interval, timeout)
+
+
+@app.post("/devices/{device_id}/codes/{code_id}/hold")
+async def hold_device_code(
+    device_id: int,
+    code_id: int,
+    interval: float = Query(0.1, ge=0.02, le=10.0),
+    timeout: float = Query(10.0, gt=0.0, le=60.0),
+    db: Session = Depends(get_db),
+):
+    """
+    Start transmitting the code every interval until stopped
+    """
+    payload = await code_payload(db=db, code_id=code_id)
+    if payload is None or payload[0] != device_id:
+        raise HTTPException(status_code=404, detail="Code not found")
+    return start_hold(payload, interval, timeout)
+
+
+@app.get("/holds/{hold_id}")
+def read_hold(hold_id: str):
+    """
+    Get Hold
+    """
+    hold = boards.find_hold(hold_id)
+    if hold is None:
+        raise HTTPException(status_code=404, detail="Hold not found")
+    return hold.to_dict()
+
+
+@app.delete("/holds/{hold_id}")
+def stop_hold(hold_id: str):
+    """
+    Stop transmitting
+    """
+    hold = boards.find_hold(hold_id)
+    if hold is None:
+        raise HTTPException(status_code=404, detail="Hold not found")
+    hold.stop()
+    return hold.to_dict()
+
+
+"""
+Remote Control
+==============
+WS /ws/ --> transmit and hold the stored codes over one connection
+
+A remote control sends one JSON message per button (ref is optional and
+echoed back):
+{"ref": 1, "code_id": 5, "repeat": 1, "interval": 0.1} --> transmit
+{"ref": 2, "hold": 7, "interval": 0.1, "timeout": 10}  --> start holding
+{"ref": 3, "stop": 7}                                  --> stop holding
+
+Every message is answered in order, when the hardware is done:
+{"ref": 1, "ok": true, "device_id": 1, "code_id": 5, "elapsed": 12.3,
+ "done_at": 1700000000.123}
+{"ref": 4, "ok": false, "status": 404, "detail": "Code not found"}
+
+elapsed is msec from the message to the completion. The codes are
+resolved from the payload cache and the holds of the connection are
+stopped when it closes.
+"""
+
+
+def control_value(message: dict, key: str, kind, default, low, high):
+    value = message.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise HTTPException(status_code=422, detail=f"Invalid {key}")
+    if not low <= value <= high:
+        raise HTTPException(status_code=422, detail=f"Invalid {key}")
+    return value
+
+
+async def control_message(db: Session, holds: dict, message: dict):
+    """
+    Handle a message of the control channel
+    holds: {code_id: [Hold]} started by the connection
+    """
+    number = (int, float)
+    if "stop" in message:
+        code_id = control_value(message, "stop", int, None, 0, 2**63)
+        stopped = holds.pop(code_id, [])
+        for hold in stopped:
+            hold.stop()
+        return {"stop": code_id, "count": sum(hold.count for hold in stopped)}
+
+    if "hold" in message:
+        code_id = control_value(message, "hold", int, None, 0, 2**63)
+        interval = control_value(message, "interval", number, 0.1, 0.02, 10.0)
+        timeout = control_value(message, "timeout", number, 10.0, 0.1, 60.0)
+        payload = await code_payload(db=db, code_id=code_id)
+        if payload is None:
+            raise HTTPException(status_code=404, detail="Code not found")
+        for hold in holds.pop(code_id, []):
+            hold.stop()
+        holds[code_id] = start_holds(payload, interval, timeout)
+        return {"hold": code_id, "holds": [hold.id for hold in holds[code_id]]}
+
+    if "code_id" in message:
+        code_id = control_value(message, "code_id", int, None, 0, 2**63)
+        repeat = control_value(message, "repeat", int, 1, 1, 50)
+        interval = control_value(message, "interval", number, 0.1, 0.0, 10.0)
+        payload = await code_payload(db=db, code_id=code_id)
+        if payload is None:
+            raise HTTPException(status_code=404, detail="Code not found")
+        result = await transmit_payload(code_id, payload, repeat, interval, True)
+        return dict(result)
+
+    raise HTTPException(status_code=400, detail="Unknown message")
+
+
+@app.websocket("/ws/")
+async def control(websocket: WebSocket):
+    """
+    Remote control channel
+    """
+    await websocket.accept()
+    holds = {}
+    try:
+        while True:
+            text = await websocket.receive_text()
+            received = time.perf_counter()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await websocket.send_json(
+                    {"ok": False, "status": 400, "detail": "Invalid message"}
+                )
+                continue
+            ack = {"ref": message["ref"]} if "ref" in message else {}
+            # A session per message, so that an idle connection does not
+            # hold a pooled database connection
+            db = SessionLocal()
+            try:
+                ack.update(await control_message(db, holds, message), ok=True)
+            except HTTPException as e:
+                ack.update(ok=False, status=e.status_code, detail=e.detail)
+            finally:
+                await run_in_threadpool(db.close)
+            ack["elapsed"] = (time.perf_counter() - received) * 1000
+            ack["done_at"] = time.time()
+            await websocket.send_json(ack)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for code_holds in holds.values():
+            for hold in code_holds:
+                hold.stop()
+
+
+"""
+Scene
+=====
+POST /scenes/               --> add scene
+GET  /scenes/               --> list scenes
+GET  /scenes/{scene_id}     --> show scene
+PUT  /scenes/{scene_id}     --> update scene
+DEL  /scenes/{scene_id}     --> remove scene
+POST /scenes/{scene_id}/run --> transmit the codes of the scene in order
+"""
+
+
+def check_scene_codes(db: Session, scene: schemas.SceneCreate):
+    code_ids = [step.code_id for step in scene.steps]
+    payloads = crud.get_code_payloads(db=db, code_ids=code_ids)
+    if len(payloads) != len(set(code_ids)):
+        raise HTTPException(status_code=400, detail="Code does NOT exist")
+
+
+@app.post("/scenes/", response_model=schemas.Scene)
+def create_scene(scene: schemas.SceneCreate, db: Session = Depends(get_db)):
+    """
+    Create Scene
+    """
+    check_scene_codes(db=db, scene=scene)
+    return crud.create_scene(db=db, scene=scene)
+
+
+@app.get("/scenes/", response_model=List[schemas.Scene])
+def read_scenes(
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after: Optional[int] = Depends(page_cursor),
+    db: Session = Depends(get_db),
+):
+    """
+    Get Scenes
+    """
+    db_scenes = crud.get_scenes(db=db, skip=skip, limit=limit, after=after)
+    link_next_page(request, response, db_scenes, limit)
+    return db_scenes
+
+
+@app.get("/scenes/{scene_id}", response_model=schemas.Scene)
+def read_scene(scene_id: int, db: Session = Depends(get_db)):
+    """
+    Get Scene by ID
+    """
+    db_scene = crud.get_scene(db=db, scene_id=scene_id)
+    if db_scene is None:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    return db_scene
+
+
+@app.put("/scenes/{scene_id}", response_model=schemas.Scene)
+def update_scene(
+    scene_id: int, scene: schemas.SceneUpdate, db: Session = Depends(get_db)
+):
+    """
+    Update Scene
+    """
+    db_scene = crud.get_scene(db=db, scene_id=scene_id)
+    if db_scene is None:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    check_scene_codes(db=db, scene=scene)
+    return crud.update_scene(db=db, scene_id=scene_id, scene=scene)
+
+
+@app.delete("/scenes/{scene_id}", response_model=schemas.Scene)
+def delete_scene(scene_id: int, db: Session = Depends(get_db)):
+    """
+    Delete Scene
+    """
+    db_scene = crud.get_scene(db=db, scene_id=scene_id)
+    if db_scene is None:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    return crud.delete_scene(db=db, scene_id=scene_id)
+
+
+@metrics.timed("scene")
+def hw_run_scene(board, steps, response: dict):
+    # steps: [(code_id, data, repeat, delay)]
+    for code_id, data, repeat, delay in steps:
+        for _ in range(repeat):
+            transmit_stored(board, code_id, data)
+            if delay:
+                time.sleep(delay)
+    return response
+
+
+def scene_steps(db: Session, scene_id: int):
+    """
+    Get {board: [(code_id, data, repeat, delay)]} of the scene
+    """
+    db_scene = crud.get_scene(db=db, scene_id=scene_id)
+    if db_scene is None:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    payloads = crud.get_code_payloads(
+        db=db, code_ids=[step.code_id for step in db_scene.steps]
+    )
+    board_steps = OrderedDict()
+    for step in db_scene.steps:
+        if step.code_id not in payloads:
+            raise HTTPException(
+                status_code=409, detail=f"Code {step.code_id} does NOT exist"
+            )
+        _, data, board_names = payloads[step.code_id]
+        for board in get_boards(board_names, status_code=409):
+            board_steps.setdefault(board, []).append(
+                (step.code_id, data, step.repeat, step.delay)
+            )
+    return board_steps
+
+
+@app.post("/scenes/{scene_id}/run")
+async def run_scene(scene_id: int, wait: bool = True, db: Session = Depends(get_db)):
+    """
+    Transmit the codes of the scene
+
+    The steps of each board run in order, and the boards run in parallel.
+    """
+    board_steps = await run_in_threadpool(scene_steps, db=db, scene_id=scene_id)
+    response = {
+        "scene_id": scene_id,
+        "transmits": sum(s[2] for steps in board_steps.values() for s in steps),
+        "boards": [board.name for board in board_steps],
+    }
+    calls = [
+        (board, hw_run_scene, (board, steps, response))
+        for board, steps in board_steps.items()
+    ]
+    results = await run_parallel(
+        "scene",
+        wait,
+        calls or [(boards.default, hw_run_scene, (boards.default, [], response))],
+        timeout=max(
+            [sum(r * d for _, _, r, d in steps) for steps in board_steps.values()],
+            default=0.0,
+        ),
+    )
+    return results[0] if isinstance(results, list) else results
+
+
+"""
+Hardware Jobs
+=============
+GET /boards/       --> show boards and their queues
+GET /jobs/         --> show queue depth and wait time of the default board
+GET /jobs/{job_id} --> show job status
+GET /slots/        --> show flash slots resident codes and hit rate
+POST /slots/sync   --> rewrite the flash slots which differ from the database
+                       (body {mem_id: code_id}: write those codes to those slots)
+GET /metrics       --> Prometheus metrics (ADRSIR_METRICS=1)
+"""
+
+
+@app.get("/boards/")
+def read_boards():
+    """
+    Get Boards
+    """
+    return boards.to_dict()
+
+
+@app.get("/jobs/")
+def read_jobs():
+    """
+    Get Hardware Queue Stats
+    """
+    return hardware.stats()
+
+
+@app.get("/jobs/{job_id}")
+def read_job(job_id: str):
+    """
+    Get Hardware Job
+    """
+    job = boards.find_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/slots/")
+def read_slots():
+    """
+    Get Flash Slot Stats
+    """
+    return slot_manager.stats()
+
+
+def hw_sync_slots(board, targets):
+    """
+    Write the codes [(mem_id, code_id, data)] to the flash slots which do
+    not hold them (data None: the code was deleted, release the slot)
+    """
+    results = []
+    for mem_id, code_id, data in targets:
+        result = {"mem_id": mem_id, "code_id": code_id}
+        if data is None:
+            board.slots.release(mem_id)
+            result["status"] = "released"
+        else:
+            try:
+                written = board.ctrl.sync(mem_id, data)
+            except OSError as e:
+                board.slots.release(mem_id)
+                result.update(status="failed", error=repr(e))
+            else:
+                board.slots.assign(mem_id, code_id, data)
+                result["status"] = "written" if written else "unchanged"
+        results.append(result)
+    return results
+
+
+@app.post("/slots/sync")
+async def sync_slots(
+    wait: bool = True,
+    assignments: Optional[Dict[int, int]] = Body(None),
+    db: Session = Depends(get_db),
+):
+    """
+    Sync Flash Slots with the Database
+    Without a body the slots of the slot manager are synced (none unless
+    ADRSIR_CACHE_SLOTS is set), otherwise the {mem_id: code_id} of the
+    body.
+    """
+    if assignments is None:
+        slot_rows = await run_in_threadpool(crud.get_slots, db=db)
+        assignments = {
+            row.mem_id: row.code_id
+            for row in slot_rows
+            if row.code_id is not None and row.mem_id in slot_manager.slots
+        }
+        required = False
+    else:
+        if any(not 0 <= mem_id <= 9 for mem_id in assignments):
+            raise HTTPException(status_code=422, detail="mem_id must be 0...9")
+        required = True
+    payloads = await run_in_threadpool(
+        crud.get_code_payloads, db=db, code_ids=list(assignments.values())
+    )
+    missing = [code_id for code_id in assignments.values() if code_id not in payloads]
+    if required and missing:
+        raise HTTPException(status_code=404, detail=f"Code {missing[0]} not found")
+    targets = [
+        (
+            mem_id,
+            code_id,
+            payloads[code_id][1] if code_id in payloads else None,
+        )
+        for mem_id, code_id in sorted(assignments.items())
+    ]
+    results = await run_hardware(
+        "sync", wait, hw_sync_slots, boards.default, targets, timeout=5.0
+    )
+    if not wait:
+        return results
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return {"slots": results, "counts": counts}
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    """
+    Get Prometheus Metrics
+    """
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+"""
+Cluster
+=======
+GET /cluster/          --> show this node, its peers and the routing table
+GET /cluster/devices/  --> list devices of all the nodes
+POST /cluster/{node}/devices/{device_id}/codes/{code_id}/transmit
+                       --> transmit the code of the device of the node
+
+Only on a coordinator (ADRSIR_PEERS). The peers which do not answer
+within ADRSIR_PEER_TIMEOUT seconds are listed in errors.
+"""
+
+
+@app.get("/cluster/")
+def read_cluster():
+    """
+    Get Cluster
+    """
+    if cluster is None:
+        raise HTTPException(status_code=404, detail="Not a coordinator")
+    return dict(cluster.to_dict(), node=NODE)
+
+
+@app.get("/cluster/devices/")
+async def read_cluster_devices(db: Session = Depends(get_db)):
+    """
+    Get Devices of all the nodes
+    """
+    if cluster is None:
+        raise HTTPException(status_code=404, detail="Not a coordinator")
+    local = await run_in_threadpool(crud.get_device_summaries, db=db, limit=None)
+    devices = [dict(device._asdict(), node=NODE) for device in local]
+    errors = {}
+    for name, result in (await cluster.list_devices()).items():
+        if isinstance(result, PeerError):
+            errors[name] = str(result)
+        else:
+            devices.extend(dict(device, node=name) for device in result)
+    return {"devices": devices, "errors": errors}
+
+
+@app.post("/cluster/{node}/devices/{device_id}/codes/{code_id}/transmit")
+async def transmit_node_code(
+    node: str,
+    device_id: int,
+    code_id: int,
+    request: Request,
+    repeat: int = Query(1, ge=1, le=50),
+    interval: float = Query(0.1, ge=0.0, le=10.0),
+    wait: bool = True,
+    db: Session = Depends(get_db),
+):
+    """
+    Transmit the code of the device of the node (e.g. a device ID found on
+    more than one node)
+    """
+    if cluster is None:
+        raise HTTPException(status_code=404, detail="Not a coordinator")
+    if node == NODE:
+        payload = await code_payload(db=db, code_id=code_id)
+        if payload is None or payload[0] != device_id:
+            raise HTTPException(status_code=404, detail="Code not found")
+        return await transmit_payload(code_id, payload, repeat, interval, wait)
+    peer = cluster.peers.get(node)
+    if peer is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return await forward(
+        peer, f"/devices/{device_id}/codes/{code_id}/transmit", request.url.query
+    )
@@ -0,0 +1,366 @@
+"""
+Prometheus Metrics
+==================
+
+With ADRSIR_METRICS=1 the app serves the metrics in the Prometheus text
+format at ``GET /metrics``:
+
+* ``adrsir_i2c_seconds{op,cmd}``: latency of the I2C transactions by
+  command (0x15 ... 0x59). A combined transfer (``write_batch``,
+  ``read_batch``) is one sample labelled by all its commands, e.g.
+  ``cmd="0x29+0x39+0x59"`` for an upload and trigger, since its
+  commands are not timed one by one
+* ``adrsir_i2c_bytes_total{cmd,direction}``: bytes transferred
+* ``adrsir_hardware_seconds{op}``: full read, write, transmit and scene
+  durations on the hardware worker
+* ``adrsir_db_seconds{function}``, ``adrsir_db_queries_total{function}``:
+  latency and SQL statements of the crud functions
+* ``adrsir_request_seconds{method,route,status}``: request latency by
+  route
+* ``adrsir_hardware_queue_depth{lane}``: queued hardware jobs
+
+Without it nothing is wrapped: `timed`, `instrument_transport`,
+`instrument_module` and `instrument_engine` return what they are given,
+so the hot paths run as they are.
+
+Usage
+-----
+```
+TRANSMIT = histogram("transmit_seconds", "Transmit duration", ["board"])
+
+@timed("transmit")
+def hw_transmit(...):
+    ...
+
+print(render())
+```
+
+"""
+
+import contextvars
+import functools
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("ADRSIR_METRICS", "0") == "1"
+
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # {label values: [bucket counts..., count, sum]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        labels = self.labels + ("le",)
+        with self._lock:
+            for values, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = _labels(labels, values + (bound,))
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                inf = _labels(labels, values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{inf} {counts[-2]}")
+                tags = _labels(self.labels, values)
+                lines.append(f"{self.name}_count{tags} {counts[-2]}")
+                lines.append(f"{self.name}_sum{tags} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge read at scrape time from fn() -> {label values: value}
+    """
+
+    def __init__(self, name, help, labels, fn):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for values, value in sorted(self.fn().items()):
+            lines.append(f"{self.name}{_labels(self.labels, values)} {value}")
+        return lines
+
+
+METRICS = []
+
+
+def counter(name, help, labels=()):
+    metric = Counter(name, help, labels)
+    METRICS.append(metric)
+    return metric
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    metric = Histogram(name, help, labels, buckets)
+    METRICS.append(metric)
+    return metric
+
+
+def gauge(name, help, labels, fn):
+    metric = Gauge(name, help, labels, fn)
+    METRICS.append(metric)
+    return metric
+
+
+def render():
+    """
+    All the metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+I2C_SECONDS = histogram(
+    "adrsir_i2c_seconds",
+    "I2C transaction latency (one sample per combined transfer, by its commands)",
+    ["op", "cmd"],
+)
+I2C_BYTES = counter(
+    "adrsir_i2c_bytes_total", "I2C bytes transferred", ["cmd", "direction"]
+)
+HARDWARE_SECONDS = histogram(
+    "adrsir_hardware_seconds", "Hardware operation duration", ["op"]
+)
+DB_SECONDS = histogram("adrsir_db_seconds", "crud function latency", ["function"])
+DB_QUERIES = counter(
+    "adrsir_db_queries_total", "SQL statements by crud function", ["function"]
+)
+REQUEST_SECONDS = histogram(
+    "adrsir_request_seconds", "Request latency", ["method", "route", "status"]
+)
+
+# crud function running in this context
+_function = contextvars.ContextVar("adrsir_crud_function", default="other")
+
+
+def timed(op):
+    """
+    Decorator observing the duration of the hardware operation
+    """
+
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                HARDWARE_SECONDS.observe(time.perf_counter() - started, op)
+
+        return wrapper
+
+    return decorator
+
+
+class InstrumentedTransport:
+    """
+    Transport observing the latency and bytes of every I2C transaction
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def _observe(self, op, cmd, started, nbytes, direction):
+        cmd = f"{cmd:#04x}"
+        I2C_SECONDS.observe(time.perf_counter() - started, op, cmd)
+        I2C_BYTES.inc(nbytes, cmd, direction)
+
+    def _observe_batch(self, blocks, started):
+        # The distinct commands in order, e.g. 0x29+0x39+0x59
+        commands = []
+        for cmd, data in blocks:
+            cmd = f"{cmd:#04x}"
+            if cmd not in commands:
+                commands.append(cmd)
+            I2C_BYTES.inc(len(data), cmd, "write")
+        I2C_SECONDS.observe(
+            time.perf_counter() - started, "write_batch", "+".join(commands)
+        )
+
+    def write_i2c_block_data(self, address, cmd, data):
+        started = time.perf_counter()
+        self.transport.write_i2c_block_data(address, cmd, data)
+        self._observe("write", cmd, started, len(data), "write")
+
+    def read_i2c_block_data(self, address, cmd, length):
+        started = time.perf_counter()
+        data = self.transport.read_i2c_block_data(address, cmd, length)
+        self._observe("read", cmd, started, length, "read")
+        return data
+
+    def write_i2c_block_batch(self, address, blocks):
+        if not hasattr(self.transport, "write_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        blocks = list(blocks)
+        started = time.perf_counter()
+        self.transport.write_i2c_block_batch(address, blocks)
+        if blocks:
+            self._observe_batch(blocks, started)
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        if not hasattr(self.transport, "read_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        started = time.perf_counter()
+        data = self.transport.read_i2c_block_batch(address, cmd, length, count)
+        self._observe("read_batch", cmd, started, length * count, "read")
+        return data
+
+
+class RequestMetrics:
+    """
+    ASGI middleware observing the request latency by route
+    route(scope): path template of the request
+    """
+
+    def __init__(self, app, route):
+        self.app = app
+        self.route = route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                self.route(scope),
+                status,
+            )
+
+
+def instrument_transport(transport):
+    if not ENABLED:
+        return transport
+    return InstrumentedTransport(transport)
+
+
+def _timed_function(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _function.set(name)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, name)
+            _function.reset(token)
+
+    return wrapper
+
+
+def instrument_module(module):
+    """
+    Time the public functions of the module (crud)
+    """
+    if not ENABLED:
+        return
+    for name, fn in list(vars(module).items()):
+        if (
+            callable(fn)
+            and not name.startswith("_")
+            and getattr(fn, "__module__", None) == module.__name__
+            and not isinstance(fn, type)
+        ):
+            setattr(module, name, _timed_function(name, fn))
+
+
+def instrument_engine(engine):
+    """
+    Count the SQL statements by crud function
+    """
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc(1, _function.get())
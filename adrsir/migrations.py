@@ -0,0 +1,144 @@
+"""
+Schema Migrations
+=================
+
+`migrate` creates the tables and upgrades databases created by older
+versions of the app. The schema version is kept in SQLite's
+``PRAGMA user_version``.
+
+The migrations are serialized by a lock file next to the database, so
+several processes may call `migrate` at once. gunicorn runs it once
+before starting the workers (``on_starting`` in gunicorn.conf.py) and
+it can be run by hand:
+```
+$ python -m adrsir.migrations
+```
+
+Versions
+--------
+1. ``codes.data``: decoded binary payload of ``codes.code``
+2. ``codes.data``: packed by `irpack`, ``codes.code`` is cleared
+3. ``response_cache.headers``: headers of the cached responses
+4. ``codes.code_hash``: unique hash of the code bytes (NULL for the later
+   duplicates of a code)
+5. ``devices.board``: boards of the device
+"""
+
+import contextlib
+import fcntl
+import os
+
+from sqlalchemy import inspect, text
+
+from . import crud, irpack, models
+
+
+def _columns(conn, table):
+    return [c["name"] for c in inspect(conn).get_columns(table)]
+
+
+def _add_code_data(conn):
+    if "data" not in _columns(conn, "codes"):
+        conn.execute(text("ALTER TABLE codes ADD COLUMN data BLOB"))
+    rows = conn.execute(text("SELECT id, code FROM codes WHERE data IS NULL"))
+    for code_id, code in rows.fetchall():
+        conn.execute(
+            text("UPDATE codes SET data = :data WHERE id = :id"),
+            {"data": crud.code_to_bytes(code or ""), "id": code_id},
+        )
+
+
+def _pack_code_data(conn):
+    rows = conn.execute(text("SELECT id, data FROM codes"))
+    for code_id, data in rows.fetchall():
+        conn.execute(
+            text("UPDATE codes SET data = :data, code = NULL WHERE id = :id"),
+            {"data": irpack.pack(data or b""), "id": code_id},
+        )
+
+
+def _add_cached_headers(conn):
+    if "headers" not in _columns(conn, "response_cache"):
+        conn.execute(text("ALTER TABLE response_cache ADD COLUMN headers TEXT"))
+    # Cached without their headers
+    conn.execute(text("DELETE FROM response_cache"))
+
+
+def _add_code_hash(conn):
+    if "code_hash" not in _columns(conn, "codes"):
+        conn.execute(text("ALTER TABLE codes ADD COLUMN code_hash VARCHAR"))
+    seen = set()
+    rows = conn.execute(text("SELECT id, data FROM codes ORDER BY id"))
+    for code_id, data in rows.fetchall():
+        code_hash = models.code_hash(irpack.unpack(data))
+        conn.execute(
+            text("UPDATE codes SET code_hash = :code_hash WHERE id = :id"),
+            {"code_hash": None if code_hash in seen else code_hash, "id": code_id},
+        )
+        seen.add(code_hash)
+    conn.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_codes_code_hash "
+            "ON codes (code_hash)"
+        )
+    )
+
+
+def _add_device_board(conn):
+    if "board" not in _columns(conn, "devices"):
+        conn.execute(text("ALTER TABLE devices ADD COLUMN board VARCHAR"))
+
+
+MIGRATIONS = [
+    _add_code_data,
+    _pack_code_data,
+    _add_cached_headers,
+    _add_code_hash,
+    _add_device_board,
+]
+
+
+@contextlib.contextmanager
+def _lock(engine):
+    database = engine.url.database
+    if not database or database == ":memory:":
+        yield
+        return
+    fd = os.open(f"{database}.migrate.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def migrate(engine):
+    """
+    Create the tables and apply the pending migrations
+    """
+    with _lock(engine), engine.begin() as conn:
+        new = "codes" not in inspect(conn).get_table_names()
+        models.Base.metadata.create_all(bind=conn)
+        if new:
+            # The tables are created with the latest schema
+            conn.execute(text(f"PRAGMA user_version = {len(MIGRATIONS)}"))
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+        for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(conn)
+            conn.execute(text(f"PRAGMA user_version = {i}"))
+
+
+def schema_version(engine):
+    """
+    Schema version of the database (None: not created)
+    """
+    with engine.connect() as conn:
+        if "codes" not in inspect(conn).get_table_names():
+            return None
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    migrate(engine)
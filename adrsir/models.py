@@ -1,15 +1,27 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+import hashlib
+
+from sqlalchemy import Column, Float, ForeignKey, Integer, LargeBinary, String
 from sqlalchemy.orm import relationship
 
+from . import irpack
 from .database import Base
 
 
+def code_hash(data: bytes):
+    """
+    SHA-256 of the lower-case hex of the code bytes
+    """
+    return hashlib.sha256(data.hex().encode()).hexdigest()
+
+
 class Device(Base):
     __tablename__ = "devices"
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     group = Column(String, index=True)
+    # Comma separated board names (NULL: the default board)
+    board = Column(String)
     desc = Column(String)
 
     codes = relationship("Code", back_populates="device")
@@ -21,7 +33,76 @@ class Code(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     device_id = Column(Integer, ForeignKey("devices.id"))
-    code = Column(String)
+    # Hex code string of the old versions (NULL since schema version 2)
+    legacy_code = Column("code", String)
+    # Code bytes packed by irpack
+    data = Column(LargeBinary)
+    # code_hash of the code bytes (unique)
+    code_hash = Column(String, unique=True, index=True)
     desc = Column(String)
 
     device = relationship("Device", back_populates="codes")
+
+    @property
+    def code(self):
+        return irpack.unpack(self.data).hex().upper()
+
+    @code.setter
+    def code(self, code_str):
+        data = bytes.fromhex(code_str)
+        self.data = irpack.pack(data)
+        self.code_hash = code_hash(data)
+
+
+class Scene(Base):
+    __tablename__ = "scenes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, index=True)
+    desc = Column(String)
+
+    steps = relationship(
+        "SceneStep",
+        back_populates="scene",
+        order_by="SceneStep.position",
+        cascade="all, delete-orphan",
+    )
+
+
+class SceneStep(Base):
+    __tablename__ = "scene_steps"
+
+    id = Column(Integer, primary_key=True, index=True)
+    scene_id = Column(Integer, ForeignKey("scenes.id"), index=True)
+    position = Column(Integer)
+    code_id = Column(Integer, ForeignKey("codes.id"))
+    delay = Column(Float, default=0.0)
+    repeat = Column(Integer, default=1)
+
+    scene = relationship("Scene", back_populates="steps")
+
+
+class Slot(Base):
+    __tablename__ = "slots"
+
+    mem_id = Column(Integer, primary_key=True)
+    code_id = Column(Integer, ForeignKey("codes.id"))
+    data = Column(LargeBinary)
+
+
+class Meta(Base):
+    __tablename__ = "meta"
+
+    key = Column(String, primary_key=True)
+    value = Column(Integer)
+
+
+class CachedResponse(Base):
+    __tablename__ = "response_cache"
+
+    key = Column(String, primary_key=True)
+    generation = Column(Integer, index=True)
+    body = Column(LargeBinary)
+    media_type = Column(String)
+    # JSON object of the response headers
+    headers = Column(String)
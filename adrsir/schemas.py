@@ -5,7 +5,7 @@ from pydantic import BaseModel, Field
 
 class CodeBase(BaseModel):
     name: str
-    code: str = Field(..., regex=r"^[0-9A-Fa-f]+$")
+    code: str = Field(..., regex=r"^([0-9A-Fa-f]{2})+$")
     desc: Optional[str] = None
 
 
@@ -28,6 +28,7 @@ class CodeUpdateDevice(CodeBase):
 class Code(CodeBase):
     id: int
     device_id: int
+    code_hash: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -36,6 +37,8 @@ class Code(CodeBase):
 class DeviceBase(BaseModel):
     name: str
     group: str
+    # Comma separated board names (None: the default board)
+    board: Optional[str] = None
     desc: Optional[str] = None
 
 
@@ -53,3 +56,38 @@ class Device(DeviceBase):
 
     class Config:
         orm_mode = True
+
+
+class SceneStepBase(BaseModel):
+    code_id: int
+    # Seconds to wait after each transmit
+    delay: float = Field(0.0, ge=0.0, le=60.0)
+    repeat: int = Field(1, ge=1, le=20)
+
+
+class SceneStep(SceneStepBase):
+    position: int
+
+    class Config:
+        orm_mode = True
+
+
+class SceneBase(BaseModel):
+    name: str
+    desc: Optional[str] = None
+
+
+class SceneCreate(SceneBase):
+    steps: List[SceneStepBase] = Field([], max_items=100)
+
+
+class SceneUpdate(SceneCreate):
+    pass
+
+
+class Scene(SceneBase):
+    id: int
+    steps: List[SceneStep] = []
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,190 @@
+"""
+Flash Slot Manager
+==================
+
+`SlotManager` keeps the most frequently transmitted codes resident in
+the flash slots of the ADRSIR.
+The board loads the slot selected by READ_SET_MEM_ID (0x15) into its
+buffer, so a resident code is transmitted with 0x15 and
+TRANSMIT_START (0x59) instead of streaming all the DATA bytes.
+That 0x59 transmits the buffer loaded by 0x15 is modelled by
+`SimulatedAdrsir` but NOT confirmed on the real board, which is why the
+manager is off unless ADRSIR_CACHE_SLOTS is set.
+
+A code is admitted after `admit_after` transmits, into a free slot or in
+place of the resident code with the lowest count (the least recently
+used one on ties) if it is transmitted more often.
+Counts are halved every `decay` lookups so that the ranking follows the
+recent traffic.
+Residency is checked against the payload, so an updated code is simply
+a miss and rewritten.
+
+Usage
+-----
+```
+manager = SlotManager([7, 8, 9])
+slot = manager.lookup(code_id, data)
+if slot is not None:
+    adrsir.transmit_slot(slot)
+else:
+    slot = manager.admit(code_id, data)
+    if slot is not None:
+        adrsir.write(slot, data)
+        adrsir.transmit_slot(slot)
+    else:
+        adrsir.transmit(data)
+```
+
+"""
+
+import time
+
+
+def parse_slots(spec):
+    """
+    Parse slot list like "0-3,7" into [0, 1, 2, 3, 7]
+    """
+    slots = []
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            slots.extend(range(int(start), int(end) + 1))
+        else:
+            slots.append(int(part))
+    for slot in slots:
+        if not 0 <= slot <= 9:
+            raise ValueError("mem_id must be 0...9")
+    return sorted(set(slots))
+
+
+class SlotManager:
+    """
+    Frequency based (LRU on ties) flash slot manager
+
+    slots: mem_ids managed by the manager
+    on_change: called with (mem_id, code_id, data) when a slot is
+               assigned, and with (mem_id, None, None) when it is released
+    """
+
+    def __init__(self, slots, admit_after=2, decay=1000, on_change=None):
+        self.slots = list(slots)
+        self.admit_after = admit_after
+        self.decay = decay
+        self.on_change = on_change
+        # {mem_id: (code_id, data)}
+        self.resident = {}
+        # {code_id: mem_id}
+        self.code_slots = {}
+        self.last_used = {}
+        self.counts = {}
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.admissions = 0
+        self.evictions = 0
+
+    def load(self, assignments, reset=False):
+        """
+        Restore the residents from [(mem_id, code_id, data)]
+
+        reset: forget the current residents first (e.g. the slots have
+               been written by another process)
+        """
+        if reset:
+            self.resident.clear()
+            self.code_slots.clear()
+            self.last_used.clear()
+        for mem_id, code_id, data in assignments:
+            if mem_id in self.slots and code_id is not None:
+                self._assign(mem_id, code_id, data, notify=False)
+
+    def lookup(self, code_id, data):
+        """
+        Count a transmit of the code and return its slot if resident
+        """
+        self.lookups += 1
+        self.counts[code_id] = self.counts.get(code_id, 0) + 1
+        if self.decay and self.lookups % self.decay == 0:
+            self.counts = {k: v // 2 for k, v in self.counts.items() if v > 1}
+        mem_id = self.code_slots.get(code_id)
+        if mem_id is not None and self.resident[mem_id][1] == data:
+            self.hits += 1
+            self.last_used[mem_id] = time.monotonic()
+            return mem_id
+        self.misses += 1
+        return None
+
+    def admit(self, code_id, data):
+        """
+        Return the slot the code should be written to, or None
+        """
+        if not self.slots:
+            return None
+        count = self.counts.get(code_id, 0)
+        if count < self.admit_after:
+            return None
+        mem_id = self.code_slots.get(code_id)
+        if mem_id is None:
+            free = [s for s in self.slots if s not in self.resident]
+            if free:
+                mem_id = free[0]
+            else:
+                mem_id = min(
+                    self.slots,
+                    key=lambda s: (
+                        self.counts.get(self.resident[s][0], 0),
+                        self.last_used.get(s, 0.0),
+                    ),
+                )
+                if self.counts.get(self.resident[mem_id][0], 0) >= count:
+                    return None
+                self.evictions += 1
+        self.admissions += 1
+        self._assign(mem_id, code_id, data)
+        return mem_id
+
+    def assign(self, mem_id, code_id, data):
+        """
+        Set the code resident in the slot (e.g. rewritten by a sync)
+        """
+        if mem_id in self.slots:
+            self._assign(mem_id, code_id, data)
+
+    def release(self, mem_id):
+        """
+        Forget the code in the slot (e.g. overwritten by /write/{mem_id})
+        """
+        if mem_id in self.resident:
+            code_id, _ = self.resident.pop(mem_id)
+            self.code_slots.pop(code_id, None)
+            self.last_used.pop(mem_id, None)
+            if self.on_change:
+                self.on_change(mem_id, None, None)
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "resident": {
+                mem_id: code_id for mem_id, (code_id, _) in self.resident.items()
+            },
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "admissions": self.admissions,
+            "evictions": self.evictions,
+        }
+
+    def _assign(self, mem_id, code_id, data, notify=True):
+        if mem_id in self.resident:
+            self.code_slots.pop(self.resident[mem_id][0], None)
+        old_slot = self.code_slots.pop(code_id, None)
+        if old_slot is not None and old_slot != mem_id:
+            self.resident.pop(old_slot, None)
+        self.resident[mem_id] = (code_id, data)
+        self.code_slots[code_id] = mem_id
+        self.last_used[mem_id] = time.monotonic()
+        if notify and self.on_change:
+            self.on_change(mem_id, code_id, data)
@@ -0,0 +1,342 @@
+"""
+Request Timing
+==============
+
+With ADRSIR_TIMING=1, a request with the ``X-Adrsir-Timing: 1`` header
+(or the ``timing=1`` query) is answered with a ``Server-Timing`` header
+splitting its time into:
+
+* ``db``: SQL statements (and their count)
+* ``validation``: dependencies and request validation
+* ``endpoint``: the endpoint function
+* ``serialization``: response model validation and encoding
+* ``queue``: wait for the hardware worker
+* ``upload``, ``trigger``, ``read``: I2C transfers by AdrsirCtrl phase.
+  A combined transfer which uploads the code and triggers it counts as
+  upload.
+* ``total``
+
+``X-Adrsir-Timing: profile`` (or ``timing=profile``) also dumps a
+cProfile of the request (the event loop, the endpoint and its hardware
+jobs) to ADRSIR_PROFILE_DIR, named in the ``X-Adrsir-Profile`` header.
+```
+$ python -m pstats log/profile-1700000000000-POST-transmit.prof
+```
+The times of the parallel boards are summed.
+Without ADRSIR_TIMING nothing is wrapped.
+
+Usage
+-----
+```
+app.add_middleware(ServerTiming)
+
+job = worker.submit("transmit", timing.bind(fn), *args)
+```
+
+"""
+
+import contextvars
+import cProfile
+import functools
+import os
+import pstats
+import re
+import threading
+import time
+from urllib.parse import parse_qs
+
+ENABLED = os.environ.get("ADRSIR_TIMING", "0") == "1"
+
+# Directory of the profiles
+PROFILE_DIR = os.environ.get("ADRSIR_PROFILE_DIR", "log")
+
+HEADER = "X-Adrsir-Timing"
+
+# Order of the metrics in Server-Timing
+NAMES = (
+    "db",
+    "validation",
+    "endpoint",
+    "serialization",
+    "queue",
+    "upload",
+    "trigger",
+    "read",
+)
+
+# I2C commands of the AdrsirCtrl phases
+UPLOAD_COMMANDS = {0x19, 0x29, 0x39, 0x49}
+TRIGGER_COMMAND = 0x59
+
+
+class Timings:
+    """
+    Seconds spent by a request
+    """
+
+    def __init__(self, profile=False):
+        self.durations = dict.fromkeys(NAMES, 0.0)
+        self.queries = 0
+        # cProfile.Profile of every thread the request has run on
+        self.profiles = [] if profile else None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name] += seconds
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.durations["db"] += seconds
+            self.queries += 1
+
+    def new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        return profile
+
+    def header(self, total):
+        metrics = []
+        for name in NAMES:
+            seconds = self.durations[name]
+            if not seconds and name != "db":
+                continue
+            metric = f"{name};dur={seconds * 1000:.3f}"
+            if name == "db":
+                metric += f';desc="{self.queries} queries"'
+            metrics.append(metric)
+        metrics.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(metrics)
+
+    def dump(self, path):
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+# Timings of the request running in this context (None: not timed)
+_current = contextvars.ContextVar("adrsir_timings", default=None)
+
+
+def add(name, seconds):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def bind(fn):
+    """
+    Run fn on another thread (e.g. the hardware worker) as part of the
+    current request: its queue wait, I2C transfers and profile are
+    added to the request.
+    fn is returned as it is if the request is not timed.
+    """
+    timings = _current.get()
+    if timings is None:
+        return fn
+    submitted = time.perf_counter()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        timings.add("queue", time.perf_counter() - submitted)
+        token = _current.set(timings)
+        profile = timings.new_profile() if timings.profiles is not None else None
+        try:
+            if profile is None:
+                return fn(*args, **kwargs)
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return wrapper
+
+
+class TimedTransport:
+    """
+    Transport adding the I2C transfers to the timed request
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def _call(self, commands, fn, *args):
+        timings = _current.get()
+        if timings is None:
+            return fn(*args)
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            if UPLOAD_COMMANDS.intersection(commands):
+                phase = "upload"
+            elif TRIGGER_COMMAND in commands:
+                phase = "trigger"
+            else:
+                phase = "read"
+            timings.add(phase, time.perf_counter() - started)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self._call((cmd,), self.transport.write_i2c_block_data, address, cmd, data)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        return self._call(
+            (cmd,), self.transport.read_i2c_block_data, address, cmd, length
+        )
+
+    def write_i2c_block_batch(self, address, blocks):
+        if not hasattr(self.transport, "write_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        blocks = list(blocks)
+        self._call(
+            {cmd for cmd, _ in blocks},
+            self.transport.write_i2c_block_batch,
+            address,
+            blocks,
+        )
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        if not hasattr(self.transport, "read_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        return self._call(
+            (cmd,),
+            self.transport.read_i2c_block_batch,
+            address,
+            cmd,
+            length,
+            count,
+        )
+
+
+def instrument_transport(transport):
+    if not ENABLED:
+        return transport
+    return TimedTransport(transport)
+
+
+def instrument_engine(engine):
+    """
+    Add the SQL statements to the timed request
+    """
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault("adrsir_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        timings = _current.get()
+        started = conn.info.get("adrsir_query_started")
+        if timings is not None and started:
+            timings.add_query(time.perf_counter() - started.pop())
+
+
+def _timed(name, fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return await fn(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            add(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_routing():
+    """
+    Time the validation, endpoint and serialization steps of the FastAPI
+    request handlers
+    """
+    if not ENABLED:
+        return
+    from fastapi import routing
+
+    run_endpoint_function = routing.run_endpoint_function
+
+    async def run_bound_endpoint(*, dependant, values, is_coroutine):
+        if not is_coroutine and _current.get() is not None:
+            # Profile the endpoint on the threadpool too
+            dependant = routing.Dependant(
+                call=bind(dependant.call), path=dependant.path
+            )
+        return await run_endpoint_function(
+            dependant=dependant, values=values, is_coroutine=is_coroutine
+        )
+
+    routing.solve_dependencies = _timed("validation", routing.solve_dependencies)
+    routing.run_endpoint_function = _timed("endpoint", run_bound_endpoint)
+    routing.serialize_response = _timed("serialization", routing.serialize_response)
+
+
+def _requested(scope):
+    headers = dict(scope.get("headers") or [])
+    value = headers.get(HEADER.lower().encode(), b"").decode("latin-1")
+    if not value:
+        value = parse_qs(scope.get("query_string", b"").decode("latin-1")).get(
+            "timing", [None]
+        )[0]
+    if value not in ("1", "profile"):
+        return None
+    return value
+
+
+class ServerTiming:
+    """
+    ASGI middleware timing the requests asking for it by the header or
+    the query (plain ASGI, since the call_next of the http middleware of
+    starlette 0.13 fails on Python 3.11)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        mode = _requested(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        timings = Timings(profile=mode == "profile")
+        profile = timings.new_profile() if mode == "profile" else None
+        name = None
+        if profile is not None:
+            path = scope["path"].strip("/") or "root"
+            name = "profile-{}-{}-{}.prof".format(
+                int(time.time() * 1000), scope["method"], re.sub(r"[^\w-]", "_", path)
+            )
+        started = time.perf_counter()
+
+        async def send_timing(message):
+            if message["type"] == "http.response.start":
+                header = timings.header(time.perf_counter() - started)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", header.encode("latin-1")))
+                if name is not None:
+                    headers.append((b"x-adrsir-profile", name.encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        token = _current.set(timings)
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                await self.app(scope, receive, send_timing)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            _current.reset(token)
+        if profile is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            timings.dump(os.path.join(PROFILE_DIR, name))
@@ -0,0 +1,408 @@
+"""
+I2C Transports
+==============
+
+`AdrsirCtrl` talks to the board through a transport object which provides
+the two SMBus block operations the ADRSIR protocol needs:
+
+* ``write_i2c_block_data(address, cmd, data)``
+* ``read_i2c_block_data(address, cmd, length)``
+
+Transports may also provide the batched operations
+
+* ``write_i2c_block_batch(address, blocks)``
+* ``read_i2c_block_batch(address, cmd, length, count)``
+
+which pack a sequence of block transfers into combined ``I2C_RDWR``
+messages, so that a whole DATA_NUM/DATA/TRANSMIT_START sequence costs a
+handful of ioctls instead of one syscall per 4-byte chunk.
+
+`SMBusTransport` drives the real board on a Raspberry Pi and
+`SimulatedAdrsir` is an in-process model of the board which can be used
+to run and benchmark the API on machines without an I2C bus.
+`MuxTransport` reaches a board behind a PCA9548-style I2C multiplexer.
+`LazyTransport` opens its transport on first use, and again in a forked
+process, so that importing the app does not touch the bus.
+
+Usage
+-----
+```
+# Real board on /dev/i2c-1
+adrsir = AdrsirCtrl(SMBusTransport(1))
+
+# Simulated board (100kHz bus timing)
+board = SimulatedAdrsir()
+adrsir = AdrsirCtrl(board)
+adrsir.transmit(code)
+print(board.transmitted)
+
+# Board on channel 2 of the multiplexer at 0x70
+mux = Mux(SMBusTransport(1), 0x70)
+adrsir = AdrsirCtrl(MuxTransport(mux, 2))
+
+# /dev/i2c-1 is opened by the first transfer
+adrsir = AdrsirCtrl(LazyTransport(lambda: open_transport(1)))
+```
+
+"""
+
+import errno
+import os
+import threading
+import time
+
+MEM_SLOTS = 10
+
+# Max number of messages in one I2C_RDWR ioctl (I2C_RDWR_IOCTL_MAX_MSGS)
+MAX_MSGS = 42
+
+# errno raised when the adapter can NOT do combined transfers
+UNSUPPORTED_ERRNO = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+
+def batch_unsupported(err):
+    """
+    True if `err` means the combined transfer itself is not supported
+    """
+    return isinstance(err, NotImplementedError) or (
+        isinstance(err, OSError) and err.errno in UNSUPPORTED_ERRNO
+    )
+
+
+class SMBusTransport:
+    """
+    Transport backed by the smbus module
+
+    Combined transfers need smbus2 (``i2c_rdwr``).
+    With the plain smbus module only the per-chunk path is available.
+    """
+
+    def __init__(self, bus=1, batch=True):
+        try:
+            import smbus2 as smbus
+
+            self.i2c_msg = smbus.i2c_msg
+        except ImportError:
+            import smbus
+
+            self.i2c_msg = None
+
+        self.bus_id = bus
+        self.bus = smbus.SMBus(bus)
+        self.batch = batch and self.i2c_msg is not None
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self.bus.write_i2c_block_data(address, cmd, data)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        return self.bus.read_i2c_block_data(address, cmd, length)
+
+    def write_byte(self, address, value):
+        self.bus.write_byte(address, value)
+
+    def write_i2c_block_batch(self, address, blocks):
+        if not self.batch:
+            raise NotImplementedError("combined transfers are disabled")
+        msgs = [self.i2c_msg.write(address, [cmd] + list(data)) for cmd, data in blocks]
+        for i in range(0, len(msgs), MAX_MSGS):
+            self.bus.i2c_rdwr(*msgs[i : i + MAX_MSGS])
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        if not self.batch:
+            raise NotImplementedError("combined transfers are disabled")
+        data = []
+        pairs = MAX_MSGS // 2
+        for i in range(0, count, pairs):
+            msgs = []
+            for _ in range(min(pairs, count - i)):
+                msgs.append(self.i2c_msg.write(address, [cmd]))
+                msgs.append(self.i2c_msg.read(address, length))
+            self.bus.i2c_rdwr(*msgs)
+            data.extend(list(msg) for msg in msgs[1::2])
+        return data
+
+    def close(self):
+        self.bus.close()
+
+
+class SimulatedAdrsir:
+    """
+    In-process model of the ADRSIR board
+
+    The board has one working buffer and 10 flash slots.
+    Read Commands
+    * 0x15 loads the slot into the buffer and rewinds the read pointer
+    * 0x25 returns [0x00, DATA_NUM_H, DATA_NUM_L] of the buffer
+    * 0x35 returns the buffer 4 bytes at a time (the first 1 byte read
+      after 0x15 is a dummy read)
+    Write Commands
+    * 0x19 selects the slot for the flash write
+    * 0x29 sets DATA_NUM and clears the buffer
+    * 0x39 appends 4 bytes to the buffer
+    * 0x49 stores the buffer to the selected slot
+    Transmit Commands
+    * 0x59 transmits the buffer
+
+    Every transaction sleeps for
+    ``latency + (2 + len(data)) * 9 / clock`` seconds
+    (address byte, command byte and the data bytes, 9 bits each),
+    flash writes additionally sleep ``flash_time`` and transmits sleep
+    ``ir_time`` per 4-byte DATA unit.
+    Combined transfers cost one ``latency`` per ioctl
+    (up to `MAX_MSGS` messages) when `batch` is True.
+    """
+
+    def __init__(
+        self,
+        clock=100000,
+        latency=0.0002,
+        flash_time=0.05,
+        ir_time=0.0,
+        address=0x52,
+        batch=True,
+    ):
+        self.batch = batch
+        self.clock = clock
+        self.latency = latency
+        self.flash_time = flash_time
+        self.ir_time = ir_time
+        self.address = address
+        self.slots = [bytes() for _ in range(MEM_SLOTS)]
+        self.buffer = bytearray()
+        self.data_num = 0
+        self.mem_id = 0
+        self.read_pos = 0
+        self.dummy_read = False
+        # Transmitted payloads
+        self.transmitted = []
+        # Number of I2C transactions per command
+        self.transactions = {}
+        # Number of ioctl/syscalls
+        self.syscalls = 0
+        self._lock = threading.Lock()
+
+    def _wait(self, length, extra=0.0, calls=1):
+        self.syscalls += calls
+        delay = calls * self.latency + length * 9 / self.clock + extra
+        if delay > 0:
+            time.sleep(delay)
+
+    def _count(self, cmd):
+        self.transactions[cmd] = self.transactions.get(cmd, 0) + 1
+
+    def _check_address(self, address):
+        if address != self.address:
+            # No ACK from the slave
+            raise OSError(121, "Remote I/O error")
+
+    def write_i2c_block_data(self, address, cmd, data):
+        data = list(data)
+        extra = self._write(address, cmd, data)
+        self._wait(2 + len(data), extra)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        data = self._read(address, cmd, length)
+        self._wait(2 + length)
+        return data
+
+    def write_i2c_block_batch(self, address, blocks):
+        if not self.batch:
+            raise NotImplementedError("combined transfers are disabled")
+        blocks = [(cmd, list(data)) for cmd, data in blocks]
+        for i in range(0, len(blocks), MAX_MSGS):
+            length = 0
+            extra = 0.0
+            for cmd, data in blocks[i : i + MAX_MSGS]:
+                extra += self._write(address, cmd, data)
+                length += 2 + len(data)
+            self._wait(length, extra)
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        if not self.batch:
+            raise NotImplementedError("combined transfers are disabled")
+        data = []
+        pairs = MAX_MSGS // 2
+        for i in range(0, count, pairs):
+            n = min(pairs, count - i)
+            for _ in range(n):
+                data.append(self._read(address, cmd, length))
+            self._wait(n * (3 + length))
+        return data
+
+    def _write(self, address, cmd, data):
+        # Apply a write transaction and return the extra busy time
+        self._check_address(address)
+        extra = 0.0
+        with self._lock:
+            self._count(cmd)
+            if cmd == 0x15:
+                self.mem_id = data[0]
+                self.buffer = bytearray(self.slots[self.mem_id])
+                self.data_num = len(self.buffer) // 4
+                self.read_pos = 0
+                self.dummy_read = True
+            elif cmd == 0x19:
+                self.mem_id = data[0]
+            elif cmd == 0x29:
+                self.data_num = data[0] * 256 + data[1]
+                self.buffer = bytearray()
+            elif cmd == 0x39:
+                self.buffer.extend(data)
+            elif cmd == 0x49:
+                self.slots[data[0]] = bytes(self.buffer[: 4 * self.data_num])
+                extra = self.flash_time
+            elif cmd == 0x59:
+                self.transmitted.append(bytes(self.buffer[: 4 * self.data_num]))
+                extra = self.ir_time * self.data_num
+            else:
+                raise OSError(5, "Input/output error")
+        return extra
+
+    def _read(self, address, cmd, length):
+        # Apply a read transaction
+        self._check_address(address)
+        with self._lock:
+            self._count(cmd)
+            if cmd == 0x25:
+                data = [0x00, self.data_num // 256, self.data_num % 256]
+            elif cmd == 0x35:
+                if self.dummy_read:
+                    self.dummy_read = False
+                    data = [0x00]
+                else:
+                    data = list(self.buffer[self.read_pos : self.read_pos + length])
+                    self.read_pos += length
+            else:
+                raise OSError(5, "Input/output error")
+        return (data + [0xFF] * length)[:length]
+
+    def close(self):
+        pass
+
+
+class Mux:
+    """
+    I2C multiplexer (PCA9548 and alike) selected by writing the channel
+    bit to its control register
+
+    The selected channel is remembered, so the boards behind the mux
+    cost an extra write only when the channel changes.
+    """
+
+    def __init__(self, transport, address=0x70):
+        self.transport = transport
+        self.address = address
+        self.channel = None
+
+    def select(self, channel):
+        if channel != self.channel:
+            self.channel = None
+            self.transport.write_byte(self.address, 1 << channel)
+            self.channel = channel
+
+    def forget(self):
+        # The channel may have been changed by another process
+        self.channel = None
+
+
+class MuxTransport:
+    """
+    Transport of a board behind a channel of the mux
+    """
+
+    def __init__(self, mux, channel):
+        self.mux = mux
+        self.channel = channel
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self.mux.select(self.channel)
+        self.mux.transport.write_i2c_block_data(address, cmd, data)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        self.mux.select(self.channel)
+        return self.mux.transport.read_i2c_block_data(address, cmd, length)
+
+    def write_i2c_block_batch(self, address, blocks):
+        if not hasattr(self.mux.transport, "write_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        self.mux.select(self.channel)
+        self.mux.transport.write_i2c_block_batch(address, blocks)
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        if not hasattr(self.mux.transport, "read_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        self.mux.select(self.channel)
+        return self.mux.transport.read_i2c_block_batch(address, cmd, length, count)
+
+
+class LazyTransport:
+    """
+    Transport opened by opener() on first use
+
+    A transport opened before fork (e.g. gunicorn preload_app) is opened
+    again in the child, so the workers never share the file descriptor.
+    """
+
+    def __init__(self, opener):
+        self.opener = opener
+        self._transport = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def opened(self):
+        return self._transport is not None and self._pid == os.getpid()
+
+    def open(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                inherited = self._transport
+                self._transport = None
+                if inherited is not None and hasattr(inherited, "close"):
+                    # Our copy of the parent's file descriptor
+                    inherited.close()
+            if self._transport is None:
+                self._transport = self.opener()
+                self._pid = os.getpid()
+            return self._transport
+
+    def __getattr__(self, name):
+        # e.g. transmitted of SimulatedAdrsir
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.open(), name)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self.open().write_i2c_block_data(address, cmd, data)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        return self.open().read_i2c_block_data(address, cmd, length)
+
+    def write_byte(self, address, value):
+        self.open().write_byte(address, value)
+
+    def write_i2c_block_batch(self, address, blocks):
+        transport = self.open()
+        if not hasattr(transport, "write_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        transport.write_i2c_block_batch(address, blocks)
+
+    def read_i2c_block_batch(self, address, cmd, length, count):
+        transport = self.open()
+        if not hasattr(transport, "read_i2c_block_batch"):
+            raise NotImplementedError("combined transfers are not supported")
+        return transport.read_i2c_block_batch(address, cmd, length, count)
+
+
+def open_transport(bus=None, address=0x52):
+    """
+    Open the transport given by `bus` or the ADRSIR_I2C_BUS environment
+    variable (default: 1). ``sim`` opens a simulated board at `address`.
+    Combined transfers are disabled with ADRSIR_I2C_BATCH=0.
+    """
+    if bus is None:
+        bus = os.environ.get("ADRSIR_I2C_BUS", "1")
+    batch = os.environ.get("ADRSIR_I2C_BATCH", "1") != "0"
+    if str(bus) == "sim":
+        return SimulatedAdrsir(address=address, batch=batch)
+    return SMBusTransport(int(bus), batch=batch)
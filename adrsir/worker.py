@@ -0,0 +1,392 @@
+"""
+Hardware Worker
+===============
+
+All bus access goes through a `HardwareWorker`: a single thread which
+runs the submitted jobs one by one from a bounded queue, so that
+concurrent requests never interleave their command sequences on the bus.
+The thread is started by the first job, in each process, so a worker
+created before fork (gunicorn preload_app) is safe to use in the child.
+
+Usage
+-----
+```
+hardware = HardwareWorker(maxsize=16)
+
+# Wait for the completion
+job = hardware.submit("transmit", adrsir.transmit, code)
+job.future.result()
+
+# Poll later
+job = hardware.submit("transmit", adrsir.transmit, code)
+hardware.get(job.id).to_dict()
+
+# Give up if the job does not start within 5 sec
+job = hardware.submit("transmit", adrsir.transmit, code, timeout=5)
+
+# Transmit every 0.1 sec until stopped (up to 10 sec)
+hold = hardware.hold("hold", adrsir.transmit, code, interval=0.1, timeout=10)
+hold.stop()
+
+# Share the bus with the other processes (e.g. gunicorn workers)
+hardware = HardwareWorker(lock=BusLock("adrsir.lock", on_foreign=forget_state))
+```
+
+"""
+
+import contextlib
+import fcntl
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class QueueFull(Exception):
+    """
+    Raised when the hardware queue is full
+    """
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a job did not start before its deadline
+    """
+
+
+class BusLock:
+    """
+    Inter-process lock of the bus (flock on path)
+
+    The lock file records the last holder, and on_foreign is called
+    under the lock when another process has used the bus since this
+    process released it, so that the state cached about the board (the
+    buffer, the flash slots) can be dropped.
+    """
+
+    def __init__(self, path, on_foreign=None):
+        self.path = path
+        self.on_foreign = on_foreign
+        self.foreign = 0
+        self._fd = None
+        self._pid = None
+        self._count = 0
+        self._token = None
+
+    def __enter__(self):
+        if self._pid != os.getpid():
+            # Not inherited across fork
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+            self._token = None
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            holder = os.pread(self._fd, 64, 0)
+            if holder != self._token:
+                self.foreign += 1
+                if self.on_foreign:
+                    self.on_foreign()
+        except BaseException:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._count += 1
+        self._token = f"{self._pid}:{self._count}".encode()
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, self._token, 0)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class Job:
+    """
+    Hardware job
+    """
+
+    def __init__(self, name, fn, args, kwargs, timeout=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.queued_at = time.time()
+        self.deadline = None if timeout is None else self.queued_at + timeout
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.future = Future()
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return time.time() - self.queued_at
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_time": self.wait_time,
+            "run_time": self.run_time,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class Hold:
+    """
+    Repeat fn(*args) on the worker every interval until stopped
+
+    Every repeat is queued as a separate job, so other jobs are not
+    blocked while the hold lasts.
+    The hold stops by itself after timeout seconds or on an error.
+    """
+
+    def __init__(self, worker, name, fn, args, interval, timeout):
+        self.id = uuid.uuid4().hex
+        self.worker = worker
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.interval = interval
+        self.timeout = timeout
+        self.count = 0
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.error = None
+        self._stop = threading.Event()
+
+    @property
+    def active(self):
+        return not self._stop.is_set()
+
+    def start(self):
+        # The first repeat raises QueueFull if the queue is full
+        self.worker.submit(self.name, self._run)
+
+    def stop(self):
+        if self.active:
+            self._stop.set()
+            self.stopped_at = time.time()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "active": self.active,
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "count": self.count,
+            "started_at": self.started_at,
+            "stopped_at": self.stopped_at,
+            "error": self.error,
+        }
+
+    def _run(self):
+        if not self.active:
+            return
+        try:
+            self.fn(*self.args)
+        except Exception as e:
+            self.error = repr(e)
+            self.stop()
+            raise
+        self.count += 1
+        self._schedule()
+
+    def _next(self):
+        if time.time() - self.started_at >= self.timeout:
+            self.stop()
+        if not self.active:
+            return
+        try:
+            self.worker.submit(self.name, self._run)
+        except QueueFull:
+            # Skip this repeat
+            self._schedule()
+
+    def _schedule(self):
+        timer = threading.Timer(self.interval, self._next)
+        timer.daemon = True
+        timer.start()
+
+
+class HardwareWorker:
+    """
+    Single-writer worker with a bounded queue
+
+    maxsize: max number of queued jobs
+    history: number of jobs kept for polling
+    lock: context manager held while a job runs (e.g. BusLock)
+    """
+
+    def __init__(self, maxsize=16, history=256, lock=None):
+        self.maxsize = maxsize
+        self.history = history
+        self.lock = lock
+        self.queue = queue.Queue(maxsize)
+        self.jobs = OrderedDict()
+        self.holds = OrderedDict()
+        self.current = None
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self._thread = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args, timeout=None, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return the Job
+
+        The job is dropped if it does not start within timeout seconds
+        or if its future is cancelled while queued.
+        """
+        self._start()
+        job = Job(name, fn, args, kwargs, timeout)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull(f"{self.maxsize} jobs are already queued")
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        return job
+
+    def hold(self, name, fn, *args, interval=0.1, timeout=10.0):
+        """
+        Start repeating fn(*args) every interval and return the Hold
+        """
+        hold = Hold(self, name, fn, args, interval, timeout)
+        hold.start()
+        with self._lock:
+            self.holds[hold.id] = hold
+            for hold_id in [k for k, v in self.holds.items() if not v.active]:
+                if len(self.holds) <= self.history:
+                    break
+                del self.holds[hold_id]
+        return hold
+
+    def get_hold(self, hold_id):
+        """
+        Get Hold by ID
+        """
+        with self._lock:
+            return self.holds.get(hold_id)
+
+    def get(self, job_id):
+        """
+        Get Job by ID
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def stats(self):
+        """
+        Queue depth and wait time
+        """
+        processed = self.processed
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.maxsize,
+            "running": self.current.id if self.current else None,
+            "running_time": self.current.run_time if self.current else None,
+            "processed": processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "mean_wait_time": self.total_wait / processed if processed else 0.0,
+            "max_wait_time": self.max_wait,
+            "mean_run_time": self.total_run / processed if processed else 0.0,
+        }
+
+    def retry_after(self):
+        """
+        Estimated seconds until the queued jobs are done
+        """
+        mean_run = self.total_run / self.processed if self.processed else 1.0
+        current = self.current.run_time if self.current else 0.0
+        return max(1, math.ceil(mean_run * (self.queue.qsize() + 1) - current))
+
+    def _start(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="adrsir-hardware", daemon=True
+                )
+                self._thread.start()
+
+    def _after_fork(self):
+        # The thread, the queued jobs and the holds of the parent are not
+        # inherited, and its lock may have been held at fork
+        self._lock = threading.Lock()
+        self.queue = queue.Queue(self.maxsize)
+        self.jobs = OrderedDict()
+        self.holds = OrderedDict()
+        self.current = None
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _drop(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+        self.dropped += 1
+        if status == "expired":
+            error = DeadlineExceeded(f"{job.name} did not start before the deadline")
+            job.error = repr(error)
+            job.future.set_exception(error)
+        self.queue.task_done()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if not job.future.set_running_or_notify_cancel():
+                self._drop(job, "cancelled")
+                continue
+            if job.deadline is not None and time.time() > job.deadline:
+                self._drop(job, "expired")
+                continue
+            self.current = job
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                with self.lock or contextlib.nullcontext():
+                    job.result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                job.status = "failed"
+                job.error = repr(e)
+                self.failed += 1
+                job.future.set_exception(e)
+            else:
+                job.status = "done"
+                job.future.set_result(job.result)
+            finally:
+                job.finished_at = time.time()
+                self.current = None
+                self.processed += 1
+                self.total_wait += job.wait_time
+                self.max_wait = max(self.max_wait, job.wait_time)
+                self.total_run += job.run_time
+                self.queue.task_done()
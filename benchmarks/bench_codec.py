@@ -0,0 +1,91 @@
+"""
+Codec Benchmark
+===============
+
+Compares `adrsir.codec` with the per-byte loops it replaced in
+`AdrsirCtrl` (``int(..., 16)`` parsing, ``sum(blocks, [])`` flattening
+and f-string formatting) on code sizes of real remotes.
+
+Usage
+-----
+```
+$ python benchmarks/bench_codec.py
+$ python benchmarks/bench_codec.py --sizes 64,1024 --number 200
+```
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from adrsir import codec  # noqa: E402
+
+
+def loop_decode(data_str):
+    data = []
+    for i in range(len(data_str) // 2):
+        data.append(int(data_str[2 * i : 2 * i + 2], 16))
+    return data
+
+
+def loop_chunks(data):
+    data_num = len(data) // 4
+    return [data[4 * i : 4 * i + 4] for i in range(data_num)]
+
+
+def loop_join(blocks):
+    return sum(blocks, [])
+
+
+def loop_encode(data):
+    return "".join([f"{x:02X}" for x in data])
+
+
+def codec_decode(data_str):
+    return codec.frame(codec.decode(data_str))
+
+
+def bench(fn, arg, number):
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        default="64,256,1024,4096",
+        help="payload sizes in bytes (e.g. a TV power code is ~250)",
+    )
+    parser.add_argument("--number", type=int, default=500, help="runs per timing")
+    args = parser.parse_args()
+
+    print(f"{'bytes':>6} {'step':<8} {'loops (us)':>11} {'codec (us)':>11} {'x':>6}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        data = bytes(i * 7 % 256 for i in range(size // 4 * 4))
+        code = data.hex().upper()
+        view = codec.frame(data)
+        blocks = loop_chunks(list(data))
+        steps = [
+            ("decode", loop_decode, codec_decode, code),
+            ("chunks", loop_chunks, codec.chunks, view),
+            ("join", loop_join, codec.join, blocks),
+            ("encode", loop_encode, codec.encode, data),
+        ]
+        assert codec.chunks(view) == blocks
+        assert codec.encode(codec.join(blocks)) == code
+        for name, old, new, arg in steps:
+            old_arg = list(data) if name == "chunks" else arg
+            old_time = bench(old, old_arg, args.number) * 1e6
+            new_time = bench(new, arg, args.number) * 1e6
+            print(
+                f"{size:>6} {name:<8} {old_time:>11.2f} {new_time:>11.2f}"
+                f" {old_time / new_time:>6.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,27 @@ errorlog = "log/error.log"
 bind = "127.0.0.1:8000"
 
 worker_class = "uvicorn.workers.UvicornWorker"
-workers = 1
+workers = int(os.environ.get("ADRSIR_WORKERS", "1"))
 
 debug = os.environ.get("DEBUG", "false") == "true"
 reload = debug
-preload_app = False
+# Import the app once and fork the workers from it (the buses are opened
+# by each worker on first use)
+preload_app = not reload
 daemon = False
+
+
+def on_starting(server):
+    # Create and migrate the database once before forking the workers
+    from adrsir import migrations
+    from adrsir.database import engine
+
+    migrations.migrate(engine)
+    engine.dispose()
+
+
+def post_fork(server, worker):
+    # Do not share the pooled connections of the parent
+    from adrsir.database import engine
+
+    engine.dispose()
@@ -0,0 +1,103 @@
+import itertools
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# The app is configured by the environment when it is imported:
+# a fresh database and the simulated board
+_db_dir = tempfile.mkdtemp(prefix="adrsir-test-")
+os.environ["ADRSIR_DB_URL"] = f"sqlite:///{_db_dir}/database.sqlite3"
+os.environ["ADRSIR_HW_LOCK"] = f"{_db_dir}/adrsir.lock"
+os.environ["ADRSIR_I2C_BUS"] = "sim"
+for name in (
+    "ADRSIR_BOARDS",
+    "ADRSIR_PEERS",
+    "ADRSIR_CACHE_SLOTS",
+    "ADRSIR_I2C_BATCH",
+    "ADRSIR_QUEUE_SIZE",
+    "ADRSIR_METRICS",
+    "ADRSIR_TIMING",
+):
+    os.environ.pop(name, None)
+
+from adrsir import cache, migrations  # noqa: E402
+
+_numbers = itertools.count(1)
+
+
+@pytest.fixture
+def make_code():
+    """
+    Factory of code strings which no other test uses (codes are unique)
+    """
+
+    def make_code(units=8):
+        return "5B002E00" + "18001800" * units + f"{next(_numbers):08X}"
+
+    return make_code
+
+
+@pytest.fixture
+def engine():
+    """
+    Fresh in-memory database
+    """
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    migrations.migrate(engine)
+    # Code ids start over in every database
+    cache.payloads.clear()
+    return engine
+
+
+@pytest.fixture
+def db(engine):
+    db = sessionmaker(bind=engine)()
+    yield db
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def main():
+    from adrsir import main
+
+    return main
+
+
+@pytest.fixture(scope="session")
+def client(main):
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def board(main):
+    """
+    The SimulatedAdrsir of the default board
+    """
+    return main.boards.default.ctrl.bus
+
+
+@pytest.fixture
+def device(client):
+    response = client.post(
+        "/devices/", json={"name": f"tv{next(_numbers)}", "group": "test"}
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.fixture
+def code(client, device, make_code):
+    response = client.post(
+        f"/devices/{device['id']}/codes", json={"name": "power", "code": make_code()}
+    )
+    assert response.status_code == 200
+    return response.json()
@@ -0,0 +1,224 @@
+import io
+import json
+
+import pytest
+
+from adrsir.adrsir import AdrsirCtrl, parse_op, run_script
+from adrsir.transport import MAX_MSGS, LazyTransport, SimulatedAdrsir, open_transport
+
+CODE = "5B002E00" + "18001800" * 4 + "18002E00" * 4 + "17004F03"
+
+
+def simulated(batch=True):
+    return SimulatedAdrsir(latency=0, flash_time=0, clock=10**9, batch=batch)
+
+
+@pytest.fixture(params=[True, False], ids=["batched", "per-chunk"])
+def sim(request):
+    return simulated(batch=request.param)
+
+
+@pytest.fixture
+def ctrl(sim):
+    return AdrsirCtrl(sim)
+
+
+def test_write_then_read(ctrl, sim):
+    ctrl.write(3, CODE)
+    assert sim.slots[3] == bytes.fromhex(CODE)
+    assert ctrl.read(3) == CODE
+
+
+def test_read_empty_slot(ctrl):
+    assert ctrl.read(0) == ""
+
+
+def test_transmit(ctrl, sim):
+    ctrl.transmit(CODE)
+    assert sim.transmitted == [bytes.fromhex(CODE)]
+    assert sim.transactions[0x39] == len(CODE) // 8
+
+
+def test_transmit_leaves_the_slots(ctrl, sim):
+    ctrl.write(1, CODE)
+    ctrl.transmit("18001800")
+    assert ctrl.read(1) == CODE
+
+
+def test_repeat_uploads_once(ctrl, sim):
+    ctrl.transmit(CODE, repeat=3)
+    assert sim.transmitted == [bytes.fromhex(CODE)] * 3
+    assert sim.transactions[0x39] == len(CODE) // 8
+    assert sim.transactions[0x59] == 3
+
+
+def test_transmit_reuses_the_buffer(ctrl, sim):
+    ctrl.transmit(CODE)
+    ctrl.transmit(bytes.fromhex(CODE))
+    assert sim.transactions[0x29] == 1
+    ctrl.transmit("18001800")
+    assert sim.transactions[0x29] == 2
+    assert sim.transmitted[-1] == bytes.fromhex("18001800")
+
+
+def test_transmit_without_reuse():
+    sim = simulated()
+    ctrl = AdrsirCtrl(sim, reuse_buffer=False)
+    ctrl.transmit(CODE)
+    ctrl.transmit(CODE)
+    assert sim.transactions[0x29] == 2
+
+
+def test_transmit_slot(ctrl, sim):
+    ctrl.write(5, CODE)
+    ctrl.transmit("18001800")
+    ctrl.transmit_slot(5, repeat=2)
+    assert sim.transmitted[-2:] == [bytes.fromhex(CODE)] * 2
+
+
+def test_only_uploads_set_the_buffer(ctrl, sim):
+    ctrl.write(3, CODE)
+    ctrl.transmit("18001800")
+    ctrl.read(3)
+    uploads = sim.transactions[0x29]
+    # The buffer still holds the other code on a board whose 0x15 does not
+    # load it, so the code is uploaded again
+    ctrl.transmit(CODE)
+    assert sim.transactions[0x29] == uploads + 1
+    ctrl.transmit_slot(3)
+    ctrl.transmit(CODE)
+    assert sim.transactions[0x29] == uploads + 2
+    # An unchanged slot is only read
+    ctrl.transmit("18001800")
+    assert not ctrl.sync(3, CODE)
+    ctrl.transmit(CODE)
+    assert sim.transactions[0x29] == uploads + 4
+
+
+def test_strict_framing(ctrl, sim):
+    with pytest.raises(ValueError):
+        ctrl.transmit(CODE + "18", strict=True)
+    with pytest.raises(ValueError):
+        ctrl.write(1, CODE + "18", strict=True)
+    assert not sim.transmitted
+    # Stored codes drop the trailing bytes
+    ctrl.transmit(CODE + "18")
+    assert sim.transmitted == [bytes.fromhex(CODE)]
+
+
+def test_combined_transfer():
+    sim = simulated()
+    AdrsirCtrl(sim).transmit(CODE)
+    # DATA_NUM, the DATA units and TRANSMIT_START in one ioctl
+    assert sim.syscalls == 1
+
+    sim = simulated()
+    AdrsirCtrl(sim).transmit(CODE * 10)
+    blocks = 2 + len(CODE) * 10 // 8
+    assert sim.syscalls == -(-blocks // MAX_MSGS)
+
+
+def test_batch_falls_back_to_per_chunk():
+    # The transport has the batched methods but the adapter refuses them
+    sim = simulated(batch=False)
+    ctrl = AdrsirCtrl(sim)
+    assert ctrl.batch
+    ctrl.transmit(CODE)
+    assert not ctrl.batch
+    assert sim.transmitted == [bytes.fromhex(CODE)]
+    sim.slots[4] = bytes.fromhex(CODE)
+    assert AdrsirCtrl(sim).read(4) == CODE
+
+
+def test_wrong_address():
+    ctrl = AdrsirCtrl(SimulatedAdrsir(latency=0, clock=10**9, address=0x53))
+    with pytest.raises(OSError):
+        ctrl.transmit(CODE)
+
+
+def test_open_the_simulated_board(monkeypatch):
+    assert isinstance(open_transport("sim"), SimulatedAdrsir)
+    monkeypatch.setenv("ADRSIR_I2C_BUS", "sim")
+    assert isinstance(AdrsirCtrl().bus, SimulatedAdrsir)
+
+
+def test_lazy_transport_is_opened_again_after_fork():
+    opened = []
+
+    def opener():
+        opened.append(simulated())
+        return opened[-1]
+
+    lazy = LazyTransport(opener)
+    assert not opened
+    AdrsirCtrl(lazy).transmit(CODE)
+    lazy.write_i2c_block_data(0x52, 0x59, [0])
+    assert len(opened) == 1
+    assert lazy.transmitted == [bytes.fromhex(CODE)] * 2
+    # As seen from a forked child
+    lazy._pid = -1
+    assert lazy.open() is opened[1]
+
+
+def test_parse_op():
+    assert parse_op("  # comment") is None
+    assert parse_op("write 3 5B00") == {"op": "write", "mem_id": "3", "code": "5B00"}
+    assert parse_op('{"op": "read", "mem_id": 1}') == {"op": "read", "mem_id": 1}
+    for line in ("erase 1", "read 1 2", '{"op": "erase"}'):
+        with pytest.raises(ValueError):
+            parse_op(line)
+
+
+def test_run_script(ctrl, sim, tmp_path):
+    out = io.StringIO()
+    script = [f"write 2 {CODE}", "transmit_slot 2", "read 12", "dump", "sleep 0"]
+    assert run_script(ctrl, script, out) == 1
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [result.get("op") for result in results] == [
+        "write",
+        "transmit_slot",
+        None,
+        "dump",
+        "sleep",
+    ]
+    assert results[2]["line"] == 3
+    assert results[3]["codes"][2] == CODE
+    assert sim.transmitted == [bytes.fromhex(CODE)]
+
+    # A dump file is restored as it is
+    dump = tmp_path / "slots.json"
+    dump.write_text(json.dumps(results[3]))
+    restored = simulated()
+    out = io.StringIO()
+    assert run_script(AdrsirCtrl(restored), [f"restore {dump}"], out) == 0
+    assert json.loads(out.getvalue())["written"] == [2]
+    assert restored.slots[2] == bytes.fromhex(CODE)
+
+
+def test_sync_writes_only_what_differs(ctrl, sim):
+    assert ctrl.sync(4, CODE)
+    assert sim.slots[4] == bytes.fromhex(CODE)
+    reads = sim.transactions.get(0x35, 0)
+    assert not ctrl.sync(4, bytes.fromhex(CODE))
+    assert sim.transactions.get(0x35, 0) > reads
+    assert sim.transactions[0x19] == 1
+    # Another length: DATA_NUM differs and the data is not read
+    reads = sim.transactions[0x35]
+    assert ctrl.sync(4, "18001800")
+    assert sim.transactions[0x35] == reads
+    assert sim.slots[4] == bytes.fromhex("18001800")
+
+
+def test_peek(ctrl):
+    ctrl.write(1, CODE)
+    data_num, prefix = ctrl.peek(1)
+    assert data_num == len(CODE) // 8
+    assert prefix == bytes.fromhex(CODE[:16])
+
+
+def test_read_fallback_keeps_the_length():
+    sim = simulated(batch=False)
+    sim.slots[4] = bytes.fromhex(CODE)
+    ctrl = AdrsirCtrl(sim)
+    assert [len(ctrl.peek(4)[1]) for _ in range(2)] == [8, 8]
+    assert ctrl.read(4) == CODE
@@ -0,0 +1,92 @@
+import pytest
+
+from adrsir.boards import BoardRegistry, parse_boards
+from adrsir.transport import Mux, MuxTransport
+
+CODE = "5B002E0018001800"
+
+
+def test_parse_boards():
+    assert parse_boards("living=1, hall=3:0x53@0x70/2") == [
+        ("living", "1", 0x52, None, None),
+        ("hall", "3", 0x53, 0x70, 2),
+    ]
+    for spec in ("living", "a=i2c", "a=1@0x70/8", "a=1,a=2", "a=1,b=1:0x52"):
+        with pytest.raises(ValueError):
+            parse_boards(spec)
+
+
+def test_boards_have_their_own_lane():
+    boards = BoardRegistry("living=sim,bedroom=sim:0x53")
+    assert boards.default.name == "living"
+    assert list(boards.lanes) == ["sim-0x52", "sim-0x53"]
+    bedroom = boards.get("bedroom")
+    job = bedroom.lane.worker.submit("transmit", bedroom.ctrl.transmit, CODE)
+    job.future.result(5)
+    assert job.status == "done"
+    assert bedroom.ctrl.bus.transmitted == [bytes.fromhex(CODE)]
+    assert boards.default.ctrl.bus.transmitted == []
+    assert boards.find_job(job.id) is job
+
+
+def test_resolve():
+    boards = BoardRegistry("living=sim,bedroom=sim:0x53")
+    assert boards.resolve(None) == [boards.default]
+    assert [board.name for board in boards.resolve("bedroom, living,bedroom")] == [
+        "bedroom",
+        "living",
+    ]
+    with pytest.raises(KeyError):
+        boards.resolve("kitchen")
+
+
+class Bus:
+    def __init__(self):
+        self.writes = []
+
+    def write_byte(self, address, value):
+        self.writes.append((address, value))
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self.writes.append((address, cmd))
+
+
+def test_mux_selects_the_channel_when_it_changes():
+    bus = Bus()
+    mux = Mux(bus, 0x70)
+    first, second = MuxTransport(mux, 0), MuxTransport(mux, 3)
+    first.write_i2c_block_data(0x52, 0x19, [0])
+    first.write_i2c_block_data(0x52, 0x59, [0])
+    second.write_i2c_block_data(0x52, 0x59, [0])
+    assert bus.writes == [
+        (0x70, 1),
+        (0x52, 0x19),
+        (0x52, 0x59),
+        (0x70, 8),
+        (0x52, 0x59),
+    ]
+    mux.forget()
+    second.write_i2c_block_data(0x52, 0x59, [0])
+    assert bus.writes[-2] == (0x70, 8)
+    with pytest.raises(NotImplementedError):
+        first.write_i2c_block_batch(0x52, [(0x59, [0])])
+
+
+def test_unknown_board(client, make_code):
+    response = client.post(
+        "/devices/", json={"name": "tv", "group": "test", "board": "kitchen"}
+    )
+    assert response.status_code == 400
+    assert (
+        client.post(f"/transmit/?code={make_code()}&board=kitchen").status_code == 404
+    )
+    assert [board["name"] for board in client.get("/boards/").json()] == ["default"]
+
+
+def test_buses_are_opened_on_first_use():
+    boards = BoardRegistry("living=sim,porch=7")
+    assert not boards.default.transport.opened
+    errors = boards.check()
+    assert errors["living"] is None
+    assert errors["porch"] is not None
+    assert boards.default.transport.opened
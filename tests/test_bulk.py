@@ -0,0 +1,97 @@
+import json
+
+from adrsir import bulk, crud
+
+
+def ndjson(*records):
+    return [json.dumps(record) for record in records]
+
+
+def test_import(db, make_code):
+    first, second = make_code(), make_code()
+    importer = bulk.Importer(db, batch_size=1)
+    importer.feed(
+        ndjson(
+            {"type": "device", "id": 7, "name": "tv", "group": "living"},
+            {"device_id": 7, "name": "power", "code": first},
+            {"device_id": 7, "name": "again", "code": first},
+            {"device_id": 7, "name": "input", "code": second},
+        )
+    )
+    importer.feed(["", "not json"])
+    importer.feed(
+        ndjson(
+            {"device_id": 8, "name": "x", "code": make_code()},
+            {"type": "scene", "name": "x"},
+            {"device_id": 7, "name": "odd", "code": "5B0"},
+        )
+    )
+    report = importer.finish()
+    assert report["lines"] == 9
+    assert (report["devices"], report["codes"], report["duplicates"]) == (1, 2, 1)
+    assert [error["line"] for error in report["errors"]] == [6, 7, 8, 9]
+    codes = crud.get_codes_of_device(db, device_id=7)
+    assert [(code.name, code.code) for code in codes] == [
+        ("power", first),
+        ("input", second),
+    ]
+
+
+def test_existing_codes_are_duplicates(db, make_code):
+    code = make_code()
+    importer = bulk.Importer(db)
+    importer.feed(
+        ndjson(
+            {"type": "device", "id": 1, "name": "tv", "group": "a"},
+            {"device_id": 1, "name": "power", "code": code},
+        )
+    )
+    importer.finish()
+    importer = bulk.Importer(db)
+    importer.feed(ndjson({"device_id": 1, "name": "power", "code": code}))
+    assert importer.finish()["duplicates"] == 1
+
+
+def test_export_round_trip(db, make_code):
+    records = [
+        {
+            "type": "device",
+            "id": 1,
+            "name": "tv",
+            "group": "a",
+            "board": "living",
+            "desc": None,
+        },
+        {
+            "type": "code",
+            "id": 1,
+            "device_id": 1,
+            "name": "power",
+            "code": make_code(),
+            "desc": None,
+        },
+    ]
+    importer = bulk.Importer(db)
+    importer.feed(ndjson(*records))
+    importer.finish()
+    assert [json.loads(line) for line in bulk.export_ndjson(db)] == records
+
+
+def test_import_and_export_api(client, make_code):
+    code = make_code()
+    body = "\n".join(
+        ndjson(
+            {"type": "device", "id": 99999, "name": "bulk", "group": "bulk"},
+            {"device_id": 99999, "name": "power", "code": code},
+        )
+    )
+    response = client.post("/import/", data=body.encode())
+    assert response.status_code == 200
+    assert (response.json()["devices"], response.json()["codes"]) == (1, 1)
+
+    response = client.get("/export/")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    exported = [r for r in records if r["type"] == "code" and r["code"] == code]
+    assert [r["device_id"] for r in exported] == [99999]
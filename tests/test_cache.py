@@ -0,0 +1,75 @@
+import pytest
+
+from adrsir import cache, crud, irpack, models, schemas
+from adrsir.cache import LRUCache
+
+
+@pytest.fixture
+def code(db, make_code):
+    device = crud.create_device(db, schemas.DeviceCreate(name="tv", group="living"))
+    return crud.create_code(
+        db, schemas.CodeCreate(name="power", code=make_code(), device_id=device.id)
+    )
+
+
+def test_lru_evicts_the_least_recently_used():
+    lru = LRUCache(maxsize=2)
+    lru.put(1, "a")
+    lru.put(2, "b")
+    assert lru.get(1) == "a"
+    lru.put(3, "c")
+    assert lru.get(2) is None
+    assert (lru.get(1), lru.get(3)) == ("a", "c")
+    assert (lru.hits, lru.misses) == (3, 1)
+
+
+def test_payload_is_decoded(db, code):
+    assert crud.get_code_payload(db, code.id) == (
+        code.device_id,
+        bytes.fromhex(code.code),
+        None,
+    )
+    assert crud.get_code_payload(db, 999999) is None
+
+
+def test_payload_is_cached(db, code):
+    crud.get_code_payload(db, code.id)
+    hits = cache.payloads.hits
+    crud.get_code_payload(db, code.id)
+    assert cache.payloads.hits == hits + 1
+
+
+def test_update_invalidates_the_payload(db, code, make_code):
+    crud.get_code_payload(db, code.id)
+    new_code = make_code()
+    crud.update_code(
+        db,
+        code.id,
+        schemas.CodeUpdate(name="power", code=new_code, device_id=code.device_id),
+    )
+    assert crud.get_code_payload(db, code.id)[1] == bytes.fromhex(new_code)
+
+
+def test_delete_invalidates_the_payload(db, code):
+    crud.get_code_payload(db, code.id)
+    crud.delete_code(db, code.id)
+    assert crud.get_code_payload(db, code.id) is None
+
+
+def test_delete_device_invalidates_the_payloads(db, code):
+    crud.get_code_payload(db, code.id)
+    crud.delete_device(db, code.device_id)
+    assert crud.get_code_payload(db, code.id) is None
+
+
+def test_write_by_another_process_clears_the_cache(db, code, make_code, monkeypatch):
+    monkeypatch.setattr(cache, "SHARED", True)
+    crud.get_code_payload(db, code.id)
+    new_code = make_code()
+    # Written by another process: the cache of this one is not invalidated
+    db.query(models.Code).filter(models.Code.id == code.id).update(
+        {"data": irpack.pack(bytes.fromhex(new_code))}
+    )
+    crud.bump_generation(db)
+    db.commit()
+    assert crud.get_code_payload(db, code.id)[1] == bytes.fromhex(new_code)
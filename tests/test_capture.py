@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def learn(board):
+    """
+    Press the learn button of the board: slot gets the code after delay
+    """
+    threads = []
+
+    def learn(mem_id, code, delay=0.3):
+        def press():
+            time.sleep(delay)
+            board.slots[mem_id] = bytes.fromhex(code)
+
+        threads.append(threading.Thread(target=press))
+        threads[-1].start()
+
+    yield learn
+    for thread in threads:
+        thread.join()
+
+
+def test_capture(client, main, learn, make_code):
+    main.adrsir.write(6, make_code())
+    code = make_code(units=12)
+    learn(6, code)
+    response = client.post("/capture/6?timeout=5&interval=0.05")
+    assert response.status_code == 200
+    assert response.json()["code"] == code
+
+    since = response.json()["fingerprint"]
+    response = client.post(f"/capture/6?timeout=0.3&interval=0.05&since={since}")
+    assert response.status_code == 204
+    assert response.headers["x-fingerprint"] == since
+
+
+def test_capture_into_a_device(client, main, device, learn, make_code):
+    code = make_code(units=20)
+    learn(7, code)
+    # Pooled connections in use while the capture waits
+    checkedout = []
+    timer = threading.Timer(
+        0.15, lambda: checkedout.append(main.engine.pool.checkedout())
+    )
+    timer.start()
+    response = client.post(
+        f"/capture/7?timeout=5&interval=0.05&device_id={device['id']}&name=learned"
+    )
+    timer.join()
+    assert checkedout == [0]
+    assert response.status_code == 200
+    code_id = response.json()["code_id"]
+    assert client.get(f"/codes/{code_id}").json()["code"] == code
+
+
+def test_capture_errors(client, device):
+    assert client.post("/capture/1?device_id=999999&name=x").status_code == 400
+    assert client.post(f"/capture/1?device_id={device['id']}").status_code == 400
+    assert client.post("/capture/1?since=xyz").status_code == 422
+
+
+def test_capture_a_code_with_the_same_prefix(client, main, learn, make_code):
+    first = make_code(units=16)
+    # The next button: same length and leader, another last unit
+    second = first[:-8] + "18002E00"
+    main.adrsir.write(6, first)
+    learn(6, second)
+    response = client.post("/capture/6?timeout=5&interval=0.05")
+    assert response.status_code == 200
+    assert response.json()["code"] == second
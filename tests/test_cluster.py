@@ -0,0 +1,220 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from adrsir.cluster import FORWARDED, Cluster, PeerError, fetch_devices, parse_peers
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    """
+    Peer node listing server.devices two by two
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, self.headers.get(FORWARDED)))
+        after = 0
+        if "after=" in self.path:
+            after = int(self.path.split("after=")[1].split("&")[0])
+        devices = [d for d in self.server.devices if d["id"] > after][:2]
+        headers = []
+        if len(devices) == 2 and devices[-1] != self.server.devices[-1]:
+            headers.append(("X-Next-Cursor", str(devices[-1]["id"])))
+        self.answer(200, devices, headers)
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path, self.headers.get(FORWARDED)))
+        self.answer(200, {"node": self.server.name, "path": self.path})
+
+
+def run(coro):
+    # Not asyncio.run, which leaves no event loop for the TestClient
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def start_peer(name, devices):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PeerHandler)
+    server.daemon_threads = True
+    server.name = name
+    server.devices = devices
+    server.requests = []
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def peers():
+    servers = [
+        start_peer("a", [{"id": 1001, "name": "tv"}, {"id": 1002, "name": "ac"}]),
+        start_peer("b", [{"id": 2001 + i, "name": f"light{i}"} for i in range(5)]),
+    ]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def cluster(peers):
+    cluster = Cluster(
+        ",".join(f"{s.name}=http://127.0.0.1:{s.server_port}" for s in peers)
+    )
+    yield cluster
+    for peer in cluster.peers.values():
+        peer.close()
+
+
+def test_parse_peers():
+    assert parse_peers("a=http://10.0.0.2:8000/, b=https://b.local") == [
+        ("a", "http://10.0.0.2:8000"),
+        ("b", "https://b.local"),
+    ]
+    for spec in ("a", "a=ftp://host", "a=http://x,a=http://y"):
+        with pytest.raises(ValueError):
+            parse_peers(spec)
+
+
+def test_connections_are_kept_alive(cluster, peers):
+    peer = cluster.peers["a"]
+    for _ in range(3):
+        status, headers, body = peer.request("POST", "/transmit/")
+        assert status == 200
+    assert peer.to_dict()["idle_connections"] == 1
+    assert peers[0].requests[-1] == ("POST", "/transmit/", "1")
+
+
+def test_fetch_devices_follows_the_pages(cluster, peers):
+    devices = fetch_devices(cluster.peers["b"], time.monotonic() + 2)
+    assert [device["id"] for device in devices] == [2001, 2002, 2003, 2004, 2005]
+    assert len(peers[1].requests) == 3
+
+
+def test_unreachable_peer(cluster, peers):
+    peers[1].shutdown()
+    peers[1].server_close()
+    results = run(cluster.list_devices())
+    assert len(results["a"]) == 2
+    assert isinstance(results["b"], PeerError)
+    assert cluster.peers["b"].errors == 1
+
+
+def test_routes(cluster):
+    run(cluster.list_devices())
+    assert run(cluster.route(1002)).name == "a"
+    assert run(cluster.route(2005)).name == "b"
+    assert run(cluster.route(3000)) is None
+
+    cluster.update_routes({"a": [{"id": 1}], "b": [{"id": 1}, {"id": 2}]})
+    assert cluster.routes == {1: "a", 2: "b"}
+    assert cluster.conflicts == {1}
+    # The routes of an unreachable peer are kept
+    cluster.update_routes({"a": [], "b": PeerError("b")})
+    assert cluster.routes == {2: "b"}
+
+
+def test_forward_the_transmit(client, main, cluster, peers, monkeypatch):
+    monkeypatch.setattr(main, "cluster", cluster)
+    response = client.post("/devices/2003/codes/7/transmit?repeat=2")
+    assert response.status_code == 200
+    assert response.headers["X-Adrsir-Node"] == "b"
+    assert response.json()["path"] == "/devices/2003/codes/7/transmit?repeat=2"
+    assert client.post("/devices/3000/codes/7/transmit").status_code == 404
+    # Never forwarded twice
+    response = client.post("/devices/2003/codes/7/transmit", headers={FORWARDED: "1"})
+    assert response.status_code == 404
+
+
+def test_cluster_devices(client, main, cluster, device, monkeypatch):
+    assert client.get("/cluster/devices/").status_code == 404
+    monkeypatch.setattr(main, "cluster", cluster)
+    devices = client.get("/cluster/devices/").json()["devices"]
+    nodes = {d["id"]: d["node"] for d in devices}
+    assert nodes[device["id"]] == main.NODE
+    assert (nodes[1001], nodes[2005]) == ("a", "b")
+    assert client.get("/cluster/").json()["routes"] == 7
+
+
+def test_transmit_group(client, main, board, cluster, peers, make_code, monkeypatch):
+    group = f"group{time.monotonic_ns()}"
+    codes = []
+    for _ in range(2):
+        device = client.post("/devices/", json={"name": "tv", "group": group}).json()
+        codes.append(
+            client.post(
+                f"/devices/{device['id']}/codes",
+                json={"name": "power", "code": make_code()},
+            ).json()
+        )
+    response = client.post(f"/groups/{group}/transmit?code_name=power")
+    assert response.status_code == 200
+    assert len(response.json()["transmits"]) == 2
+    assert board.transmitted[-2:] == [bytes.fromhex(code["code"]) for code in codes]
+    assert client.post(f"/groups/{group}/transmit?code_name=off").status_code == 404
+
+    monkeypatch.setattr(main, "cluster", cluster)
+    response = client.post(f"/groups/{group}/transmit?code_name=power")
+    nodes = response.json()["nodes"]
+    assert len(nodes[main.NODE]["transmits"]) == 2
+    assert nodes["a"]["node"] == "a"
+    assert peers[1].requests[-1][0] == "POST"
+
+
+def test_transmit_large_group(client, main, board, make_code):
+    group = f"group{time.monotonic_ns()}"
+    codes = []
+    for _ in range(main.hardware.maxsize + 4):
+        device = client.post("/devices/", json={"name": "tv", "group": group}).json()
+        codes.append(
+            client.post(
+                f"/devices/{device['id']}/codes",
+                json={"name": "power", "code": make_code()},
+            ).json()
+        )
+    jobs = main.hardware.stats()["processed"]
+    response = client.post(f"/groups/{group}/transmit?code_name=power")
+    assert response.status_code == 200
+    assert len(response.json()["transmits"]) == len(codes)
+    # All the codes of the board in one job
+    assert main.hardware.stats()["processed"] == jobs + 1
+    assert board.transmitted[-len(codes) :] == [
+        bytes.fromhex(code["code"]) for code in codes
+    ]
+
+
+def test_conflicting_device(client, main, cluster, peers, code, monkeypatch):
+    monkeypatch.setattr(main, "cluster", cluster)
+    peers[0].devices.append({"id": 2003, "name": "light2"})
+    response = client.post("/devices/2003/codes/7/transmit")
+    assert response.status_code == 409
+    assert not [r for r in peers[0].requests + peers[1].requests if r[0] == "POST"]
+
+    response = client.post("/cluster/b/devices/2003/codes/7/transmit?repeat=2")
+    assert response.headers["X-Adrsir-Node"] == "b"
+    assert response.json()["path"] == "/devices/2003/codes/7/transmit?repeat=2"
+    path = f"/cluster/{main.NODE}/devices/{code['device_id']}/codes/{code['id']}"
+    assert client.post(path + "/transmit").status_code == 200
+    path = f"/cluster/{main.NODE}/devices/999999/codes/{code['id']}/transmit"
+    assert client.post(path).status_code == 404
+    assert client.post("/cluster/c/devices/2003/codes/7/transmit").status_code == 404
@@ -0,0 +1,29 @@
+import pytest
+
+from adrsir import codec
+
+
+def test_decode_and_encode():
+    assert codec.decode("5b00ff18") == b"\x5b\x00\xff\x18"
+    assert codec.decode(bytearray(b"\x01")) == b"\x01"
+    assert codec.encode([0x5B, 0x00, 0xFF]) == "5B00FF"
+    for code in ("5B0", "zz00"):
+        with pytest.raises(ValueError):
+            codec.decode(code)
+
+
+def test_frame():
+    data = bytes(range(10))
+    view = codec.frame(data)
+    assert bytes(view) == data[:8]
+    assert codec.data_num(view) == [0, 2]
+    assert codec.data_num(codec.frame(bytes(4 * 300))) == [1, 44]
+    with pytest.raises(ValueError):
+        codec.frame(data, strict=True)
+
+
+def test_chunks_and_join():
+    view = codec.frame(bytes(range(8)))
+    blocks = codec.chunks(view)
+    assert blocks == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert codec.join(blocks) == bytes(range(8))
@@ -0,0 +1,47 @@
+import hashlib
+
+from adrsir import crud, models, schemas
+
+
+def test_code_hash_ignores_the_case(code):
+    expected = hashlib.sha256(code["code"].lower().encode()).hexdigest()
+    assert code["code_hash"] == expected
+    assert models.code_hash(bytes.fromhex(code["code"])) == expected
+
+
+def test_read_code_by_hash(client, code):
+    response = client.get(f"/codes/by-hash/{code['code_hash'].upper()}")
+    assert response.status_code == 200
+    assert response.json()["id"] == code["id"]
+    assert client.get("/codes/by-hash/" + "0" * 64).status_code == 404
+    assert client.get("/codes/by-hash/xyz").status_code == 422
+
+
+def test_register_a_code_once(client, device, code, make_code):
+    path = f"/devices/{device['id']}/codes"
+    response = client.post(path, json={"name": "again", "code": code["code"].lower()})
+    assert response.status_code == 400
+    other = client.post(path, json={"name": "other", "code": make_code()}).json()
+    response = client.put(
+        f"/codes/{other['id']}",
+        json={"name": "other", "device_id": device["id"], "code": code["code"]},
+    )
+    assert response.status_code == 400
+
+
+def test_concurrent_insert(client, main, device, code, monkeypatch):
+    # Registered by another request after the duplicate check
+    monkeypatch.setattr(main.crud, "get_code_by_code_str", lambda db, code_str: None)
+    response = client.post(
+        f"/devices/{device['id']}/codes", json={"name": "again", "code": code["code"]}
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Code already registered"
+
+
+def test_get_code_by_hash(db, make_code):
+    device = crud.create_device(db, schemas.DeviceCreate(name="tv", group="living"))
+    created = crud.create_code(
+        db, schemas.CodeCreate(name="power", device_id=device.id, code=make_code())
+    )
+    assert crud.get_code_by_hash(db, created.code_hash).id == created.id
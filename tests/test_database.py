@@ -0,0 +1,28 @@
+import pytest
+from sqlalchemy import text
+
+from adrsir import database
+
+
+def test_profiles(monkeypatch):
+    monkeypatch.delenv("ADRSIR_DB_PROFILE", raising=False)
+    monkeypatch.delenv("ADRSIR_DB_BUSY_TIMEOUT", raising=False)
+    assert database.get_pragmas()["journal_mode"] == "WAL"
+    assert "journal_mode" not in database.get_pragmas("compat")
+    monkeypatch.setenv("ADRSIR_DB_BUSY_TIMEOUT", "100")
+    assert database.get_pragmas()["busy_timeout"] == "100"
+    with pytest.raises(ValueError):
+        database.get_pragmas("fast")
+
+
+def test_pragmas_are_set(tmp_path, monkeypatch):
+    monkeypatch.setenv("ADRSIR_DB_SYNCHRONOUS", "FULL")
+    engine = database.make_engine(f"sqlite:///{tmp_path}/test.sqlite3", "wal")
+    try:
+        with engine.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            # FULL
+            assert conn.execute(text("PRAGMA synchronous")).scalar() == 2
+            assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    finally:
+        engine.dispose()
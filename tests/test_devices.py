@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def group(client, make_code):
+    """
+    A group of 3 devices with 2 codes each
+    """
+    name = make_code()
+    for i in range(3):
+        device = client.post("/devices/", json={"name": f"d{i}", "group": name}).json()
+        for _ in range(2):
+            client.post(
+                f"/devices/{device['id']}/codes",
+                json={"name": "c", "code": make_code()},
+            )
+    return name
+
+
+@pytest.fixture
+def statements(main):
+    """
+    SQL statements run by the app
+    """
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(main.engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(main.engine, "before_cursor_execute", count)
+
+
+def test_codes_are_loaded_at_once(client, group, statements):
+    devices = client.get(f"/devices/?group={group}").json()
+    assert [len(device["codes"]) for device in devices] == [2, 2, 2]
+    # One query for the codes of all the devices
+    assert len([s for s in statements if "FROM codes" in s]) == 1
+
+
+def test_select_fields(client, group, statements):
+    response = client.get(f"/devices/?group={group}&fields=id,name")
+    assert response.status_code == 200
+    devices = response.json()
+    assert [sorted(device) for device in devices] == [["id", "name"]] * 3
+    assert not [s for s in statements if "FROM codes" in s]
+
+    response = client.get(f"/devices/{devices[0]['id']}?fields=name,codes")
+    assert sorted(response.json()) == ["codes", "name"]
+    assert len(response.json()["codes"]) == 2
+
+
+@pytest.mark.parametrize("fields", ["id,secret", ","])
+def test_unknown_fields(client, fields):
+    assert client.get(f"/devices/?fields={fields}").status_code == 422
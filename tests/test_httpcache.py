@@ -0,0 +1,68 @@
+from sqlalchemy import text
+
+from adrsir import crud
+
+
+def test_conditional_get(client, device):
+    response = client.get("/devices/")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    cached = client.get("/devices/")
+    assert cached.headers["etag"] == etag
+    assert cached.json() == response.json()
+    assert client.get("/devices/", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put(f"/devices/{device['id']}", json={"name": "renamed", "group": "test"})
+    response = client.get("/devices/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "renamed" in [d["name"] for d in response.json()]
+
+
+def test_write_by_another_worker(client, main, device):
+    etag = client.get("/groups/").headers["etag"]
+    # Another worker adds a group
+    with main.engine.begin() as conn:
+        conn.execute(
+            text('INSERT INTO devices (name, "group") VALUES (:name, :group)'),
+            {"name": "x", "group": "other worker"},
+        )
+        conn.execute(text("UPDATE meta SET value = value + 1 WHERE key = 'generation'"))
+    response = client.get("/groups/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "other worker" in response.json()
+
+
+def test_error_responses_are_not_cached(client, main):
+    assert client.get("/devices/999999").status_code == 404
+    assert client.get("/devices/?limit=abc").status_code == 422
+    with main.engine.connect() as conn:
+        keys = [row[0] for row in conn.execute(text("SELECT key FROM response_cache"))]
+    assert not [key for key in keys if "999999" in key or "abc" in key]
+
+
+def test_other_paths_are_not_cached(client):
+    assert "etag" not in client.get("/scenes/").headers
+
+
+def test_cache_ignores_unknown_query_params(client, main, device):
+    for i in range(3):
+        assert client.get(f"/devices/?limit=50&_={i}").status_code == 200
+    with main.engine.connect() as conn:
+        keys = [row[0] for row in conn.execute(text("SELECT key FROM response_cache"))]
+    assert keys.count("/devices/?limit=50") == 1
+    assert not [key for key in keys if "_=" in key]
+
+
+def test_store_the_same_key_twice(main):
+    # Two workers which missed the same key
+    first, second = main.SessionLocal(), main.SessionLocal()
+    try:
+        generation = crud.get_generation(first)
+        crud.set_cached_response(first, "/test?", generation, b"1", "text/plain")
+        crud.set_cached_response(second, "/test?", generation, b"2", "text/plain")
+        cached = crud.get_cached_response(first, "/test?", generation)
+        assert cached.body == b"2"
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,58 @@
+import random
+import struct
+
+import pytest
+
+from adrsir import irpack
+
+LEADER = struct.pack("<2H", 0x5B, 0x2E)
+ZERO = struct.pack("<2H", 0x18, 0x18)
+ONE = struct.pack("<2H", 0x18, 0x2E)
+FRAME = LEADER + (ZERO + ONE) * 16 + struct.pack("<2H", 0x17, 0x34F)
+
+
+def timings(count, seed=0):
+    rng = random.Random(seed)
+    return struct.pack(f"<{count}H", *(rng.randrange(0x10000) for _ in range(count)))
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x5b",
+        b"\x5b\x00\x18",
+        FRAME,
+        FRAME * 3,
+        LEADER + ZERO * 300,
+        timings(600),
+        timings(30, seed=1),
+    ],
+    ids=["empty", "1 byte", "3 bytes", "frame", "repeated", "long run", "noise", "few"],
+)
+def test_round_trip(data):
+    assert irpack.unpack(irpack.pack(data)) == data
+
+
+def test_frame_is_packed_as_pairs():
+    blob = irpack.pack(FRAME)
+    assert blob[0] in (irpack.PAIRS, irpack.PAIRS_ZLIB)
+    assert len(blob) < len(FRAME)
+
+
+def test_repeated_frames_are_compressed():
+    assert irpack.pack(FRAME * 3)[0] == irpack.PAIRS_ZLIB
+
+
+def test_odd_length_is_raw():
+    assert irpack.pack(FRAME + b"\x00")[0] == irpack.RAW
+
+
+def test_too_many_timings_is_raw():
+    data = struct.pack("<300H", *range(300))
+    assert irpack.pack(data)[0] == irpack.RAW
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        irpack.unpack(b"\x7f\x00")
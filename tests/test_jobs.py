@@ -0,0 +1,230 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import event, text
+
+from adrsir import cache, irpack, worker
+
+
+@pytest.fixture
+def blocked(main):
+    """
+    Hold the hardware worker until the test is over
+    """
+    release = threading.Event()
+    main.hardware.submit("block", release.wait, 10)
+    # Wait until the worker has taken the blocking job
+    while main.hardware.queue.qsize():
+        time.sleep(0.01)
+    yield release
+    release.set()
+    main.hardware.queue.join()
+
+
+def test_transmit_code(client, board, code):
+    response = client.post(f"/codes/{code['id']}/transmit")
+    assert response.status_code == 200
+    assert response.json() == {"device_id": code["device_id"], "code_id": code["id"]}
+    assert board.transmitted[-1] == bytes.fromhex(code["code"])
+
+
+def test_transmit_missing_code(client):
+    assert client.post("/codes/999999/transmit").status_code == 404
+
+
+def test_write_and_read(client, make_code):
+    code = make_code()
+    assert client.post(f"/write/2?code={code}").status_code == 200
+    assert client.get("/read/2").json() == {"mem_id": 2, "code": code}
+
+
+def test_job_is_polled(client, board, make_code):
+    code = make_code()
+    response = client.post(f"/transmit/?code={code}&wait=false")
+    assert response.status_code == 202
+    job = response.json()
+    assert response.headers["location"] == f"/jobs/{job['id']}"
+    for _ in range(100):
+        job = client.get(f"/jobs/{job['id']}").json()
+        if job["status"] == "done":
+            break
+        time.sleep(0.01)
+    assert job["status"] == "done"
+    assert job["result"] == {"code": code}
+    assert board.transmitted[-1] == bytes.fromhex(code)
+
+
+def test_transmit_repeat(client, board, code):
+    count = len(board.transmitted)
+    response = client.post(f"/codes/{code['id']}/transmit?repeat=3&interval=0")
+    assert response.status_code == 200
+    assert board.transmitted[count:] == [bytes.fromhex(code["code"])] * 3
+
+
+def test_hold(client, board, code):
+    count = len(board.transmitted)
+    response = client.post(f"/codes/{code['id']}/hold?interval=0.02&timeout=5")
+    assert response.status_code == 200
+    hold = response.json()
+    time.sleep(0.2)
+    hold = client.delete(f"/holds/{hold['id']}").json()
+    assert not hold["active"]
+    assert hold["count"] >= 2
+    time.sleep(0.1)
+    # No more transmits after the stop
+    assert (
+        len(board.transmitted) - count
+        == client.get(f"/holds/{hold['id']}").json()["count"]
+    )
+    assert set(board.transmitted[count:]) == {bytes.fromhex(code["code"])}
+
+
+def test_hold_times_out(main):
+    calls = []
+    hold = main.hardware.hold("hold", calls.append, 1, interval=0.01, timeout=0.1)
+    time.sleep(0.3)
+    assert not hold.active
+    assert hold.count == len(calls) > 0
+
+
+def test_unknown_job(client):
+    assert client.get("/jobs/0").status_code == 404
+
+
+def test_full_queue(client, main, blocked, make_code):
+    code = make_code()
+    for _ in range(main.hardware.maxsize):
+        assert client.post(f"/transmit/?code={code}&wait=false").status_code == 202
+    response = client.post(f"/transmit/?code={code}")
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    stats = client.get("/jobs/").json()
+    assert stats["depth"] == main.hardware.maxsize
+    assert stats["running"] is not None
+
+
+def test_jobs_run_one_at_a_time():
+    hardware = worker.HardwareWorker(maxsize=8)
+    running = []
+    overlaps = []
+
+    def job(i):
+        running.append(i)
+        overlaps.append(len(running))
+        time.sleep(0.01)
+        running.remove(i)
+        return i
+
+    jobs = [hardware.submit("job", job, i) for i in range(5)]
+    assert [job.future.result(timeout=5) for job in jobs] == list(range(5))
+    assert max(overlaps) == 1
+    assert hardware.stats()["processed"] == 5
+
+
+def test_deadline(client, main, blocked, make_code, monkeypatch):
+    monkeypatch.setattr(main, "HW_TIMEOUT", 0.1)
+    response = client.post(f"/transmit/?code={make_code()}&wait=false")
+    job_id = response.json()["id"]
+    assert client.post(f"/transmit/?code={make_code()}").status_code == 504
+    # Still queued when the deadline passes: dropped, never sent
+    dropped = main.hardware.stats()["dropped"]
+    blocked.set()
+    main.hardware.queue.join()
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "expired"
+    assert main.hardware.stats()["dropped"] == dropped + 2
+
+
+def test_bus_lock_detects_other_processes(tmp_path):
+    path = tmp_path / "adrsir.lock"
+    forgotten = []
+    lock = worker.BusLock(str(path), on_foreign=lambda: forgotten.append(1))
+    with lock:
+        pass
+    with lock:
+        pass
+    # Nobody had used the bus before the first job
+    assert len(forgotten) == 1
+    path.write_bytes(b"1:1")
+    with lock:
+        pass
+    assert len(forgotten) == lock.foreign == 2
+
+
+def test_worker_starts_over_after_fork():
+    hardware = worker.HardwareWorker()
+    assert hardware.submit("first", lambda: 1).future.result(5) == 1
+    # As seen from a forked child: the thread of the parent is gone
+    hardware._pid = -1
+    job = hardware.submit("second", lambda: 2)
+    assert job.future.result(5) == 2
+    assert list(hardware.jobs) == [job.id]
+
+
+def test_health(client, main, monkeypatch):
+    assert client.get("/healthz").json()["status"] == "ok"
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json()["boards"] == {"default": "ok"}
+    monkeypatch.setattr(main.migrations, "schema_version", lambda engine: 1)
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["database"].startswith("schema 1 of")
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    # Several gunicorn workers
+    monkeypatch.setattr(cache, "SHARED", True)
+
+
+def other_process(main, statement, **params):
+    """
+    Write to the database as another gunicorn worker would: the change
+    and a bump of the write generation, without touching our caches
+    """
+    with main.engine.begin() as conn:
+        conn.execute(text(statement), params)
+        conn.execute(text("UPDATE meta SET value = value + 1 WHERE key = 'generation'"))
+
+
+def test_payload_follows_other_process_update(
+    client, main, board, code, make_code, shared
+):
+    client.post(f"/codes/{code['id']}/transmit")
+    new_code = make_code()
+    other_process(
+        main,
+        "UPDATE codes SET data = :data WHERE id = :id",
+        data=irpack.pack(bytes.fromhex(new_code)),
+        id=code["id"],
+    )
+    assert client.post(f"/codes/{code['id']}/transmit").status_code == 200
+    assert board.transmitted[-1] == bytes.fromhex(new_code)
+
+
+def test_payload_follows_other_process_delete(client, main, code, shared):
+    assert client.post(f"/codes/{code['id']}/transmit").status_code == 200
+    other_process(main, "DELETE FROM codes WHERE id = :id", id=code["id"])
+    assert client.post(f"/codes/{code['id']}/transmit").status_code == 404
+
+
+def test_single_worker_hit_reads_nothing(client, main, code):
+    client.post(f"/codes/{code['id']}/transmit")
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(main.engine, "before_cursor_execute", count)
+    try:
+        assert client.post(f"/codes/{code['id']}/transmit").status_code == 200
+    finally:
+        event.remove(main.engine, "before_cursor_execute", count)
+    assert not [s for s in executed if "FROM meta" in s]
+
+
+@pytest.mark.parametrize("code", ["5B0018002E0", "zz00", "5B0018002E00"])
+@pytest.mark.parametrize("path", ["/transmit/", "/write/1"])
+def test_malformed_code(client, path, code):
+    assert client.post(f"{path}?code={code}").status_code == 422
@@ -0,0 +1,58 @@
+from fastapi.testclient import TestClient
+
+from adrsir import metrics
+from adrsir.adrsir import AdrsirCtrl
+from adrsir.transport import SimulatedAdrsir
+
+
+def samples(name):
+    return [line for line in metrics.render().splitlines() if line.startswith(name)]
+
+
+def test_combined_transfer_is_labelled_by_its_commands():
+    sim = SimulatedAdrsir(latency=0, flash_time=0, clock=10**9)
+    ctrl = AdrsirCtrl(metrics.InstrumentedTransport(sim))
+    ctrl.transmit("5B002E0018001800")
+    assert (
+        'adrsir_i2c_seconds_count{op="write_batch",cmd="0x29+0x39+0x59"} 1'
+        in samples("adrsir_i2c_seconds_count")
+    )
+    assert 'adrsir_i2c_bytes_total{cmd="0x39",direction="write"} 8' in samples(
+        "adrsir_i2c_bytes_total"
+    )
+
+
+def test_cache_hits_are_labelled_by_route(main, client, device):
+    with TestClient(metrics.RequestMetrics(main.app, route=main.route_path)) as app:
+        response = app.get("/groups/")
+        app.get("/groups/")
+        app.get("/groups/", headers={"If-None-Match": response.headers["etag"]})
+    lines = samples("adrsir_request_seconds_count")
+    assert (
+        'adrsir_request_seconds_count{method="GET",route="/groups/",status="200"} 2'
+        in lines
+    )
+    assert (
+        'adrsir_request_seconds_count{method="GET",route="/groups/",status="304"} 1'
+        in lines
+    )
+
+
+def test_histogram_buckets():
+    histogram = metrics.Histogram("t_seconds", "Test", ["op"], buckets=(0.1, 1))
+    histogram.observe(0.05, "read")
+    histogram.observe(0.5, "read")
+    assert histogram.collect()[2:] == [
+        't_seconds_bucket{op="read",le="0.1"} 1',
+        't_seconds_bucket{op="read",le="1"} 2',
+        't_seconds_bucket{op="read",le="+Inf"} 2',
+        't_seconds_count{op="read"} 2',
+        't_seconds_sum{op="read"} 0.55',
+    ]
+
+
+def test_disabled(client):
+    # Nothing is wrapped without ADRSIR_METRICS=1
+    assert not metrics.ENABLED
+    assert metrics.instrument_transport(client) is client
+    assert client.get("/metrics").status_code == 404
@@ -0,0 +1,90 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from adrsir import cache, crud, irpack, migrations
+
+# The schema of the first version of the app
+BASELINE = [
+    'CREATE TABLE devices (id INTEGER PRIMARY KEY, name VARCHAR, "group" VARCHAR, '
+    '"desc" VARCHAR)',
+    "CREATE TABLE codes (id INTEGER PRIMARY KEY, name VARCHAR, "
+    'device_id INTEGER REFERENCES devices (id), code VARCHAR, "desc" VARCHAR)',
+]
+
+
+@pytest.fixture
+def baseline(make_code):
+    """
+    (engine, code) of a database created by the first version
+    """
+    code = make_code()
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    with engine.begin() as conn:
+        for statement in BASELINE:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO devices (id, name) VALUES (1, 'tv')"))
+        conn.execute(
+            text(
+                "INSERT INTO codes (id, name, device_id, code) VALUES (1, 'p', 1, :c)"
+            ),
+            {"c": code},
+        )
+    cache.payloads.clear()
+    return engine, code
+
+
+def test_migrate_the_baseline(baseline):
+    engine, code = baseline
+    migrations.migrate(engine)
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+        legacy, data = conn.execute(
+            text("SELECT code, data FROM codes WHERE id = 1")
+        ).one()
+    assert version == len(migrations.MIGRATIONS)
+    assert legacy is None
+    assert irpack.unpack(data) == bytes.fromhex(code)
+
+    db = sessionmaker(bind=engine)()
+    try:
+        assert crud.get_code(db, 1).code == code
+        assert crud.get_code_payload(db, 1) == (1, bytes.fromhex(code), None)
+    finally:
+        db.close()
+
+
+def test_migrate_twice(baseline):
+    engine, code = baseline
+    migrations.migrate(engine)
+    migrations.migrate(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        assert crud.get_code(db, 1).code == code
+    finally:
+        db.close()
+
+
+def test_new_database_starts_at_the_latest_version(engine):
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+    assert version == len(migrations.MIGRATIONS)
+
+
+def test_later_duplicates_get_no_hash(baseline):
+    engine, code = baseline
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO codes (id, name, device_id, code) VALUES (2, 'q', 1, :c)"
+            ),
+            {"c": code.lower()},
+        )
+    migrations.migrate(engine)
+    with engine.connect() as conn:
+        hashes = conn.execute(text("SELECT code_hash FROM codes ORDER BY id")).all()
+    assert hashes[0][0] is not None
+    assert hashes[1][0] is None
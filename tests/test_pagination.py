@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def codes(client, device, make_code):
+    return [
+        client.post(
+            f"/devices/{device['id']}/codes", json={"name": "c", "code": make_code()}
+        ).json()
+        for _ in range(5)
+    ]
+
+
+def walk(client, url):
+    """
+    ([ids of each page], number of requests) following the Link headers
+    """
+    pages = []
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([item["id"] for item in response.json()])
+        link = response.headers.get("link")
+        if link is None:
+            break
+        assert response.headers["x-next-cursor"] in link
+        url = link[link.index("<") + 1 : link.index(">")]
+    return pages
+
+
+def test_pages(client, device, codes):
+    ids = [code["id"] for code in codes]
+    pages = walk(client, f"/devices/{device['id']}/codes?limit=2")
+    assert pages == [ids[0:2], ids[2:4], ids[4:]]
+    # The cached pages keep their Link header
+    assert walk(client, f"/codes/?device_id={device['id']}&limit=2") == pages
+    assert walk(client, f"/codes/?device_id={device['id']}&limit=2") == pages
+
+
+def test_exact_last_page(client, device, codes):
+    pages = walk(client, f"/devices/{device['id']}/codes?limit=5")
+    # A full page links to an empty one
+    assert pages == [[code["id"] for code in codes], []]
+
+
+def test_device_pages(client, device, codes):
+    pages = walk(client, "/devices/?limit=1&fields=id")
+    assert pages == [[d["id"]] for d in client.get("/devices/").json()] + [[]]
+
+
+@pytest.mark.parametrize("after", ["abc", "bmFtZTox"])
+def test_invalid_cursor(client, after):
+    assert client.get(f"/codes/?after={after}").status_code == 422
@@ -0,0 +1,64 @@
+import pytest
+
+
+@pytest.fixture
+def codes(client, device, make_code):
+    codes = []
+    for name in ("power", "input"):
+        response = client.post(
+            f"/devices/{device['id']}/codes", json={"name": name, "code": make_code()}
+        )
+        codes.append(response.json())
+    return codes
+
+
+@pytest.fixture
+def scene(client, codes):
+    steps = [{"code_id": codes[0]["id"]}, {"code_id": codes[1]["id"], "repeat": 2}]
+    response = client.post("/scenes/", json={"name": "movie", "steps": steps})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_create_scene(client, scene, codes):
+    assert [step["position"] for step in scene["steps"]] == [0, 1]
+    assert client.get(f"/scenes/{scene['id']}").json() == scene
+    assert scene["id"] in [s["id"] for s in client.get("/scenes/").json()]
+
+
+def test_scene_with_unknown_code(client):
+    response = client.post("/scenes/", json={"name": "x", "steps": [{"code_id": 0}]})
+    assert response.status_code == 400
+
+
+def test_run_scene(client, board, scene, codes):
+    count = len(board.transmitted)
+    response = client.post(f"/scenes/{scene['id']}/run")
+    assert response.status_code == 200
+    assert response.json() == {
+        "scene_id": scene["id"],
+        "transmits": 3,
+        "boards": ["default"],
+    }
+    first, second = (bytes.fromhex(code["code"]) for code in codes)
+    assert board.transmitted[count:] == [first, second, second]
+
+
+def test_update_scene(client, board, scene, codes):
+    steps = [{"code_id": codes[1]["id"]}]
+    response = client.put(f"/scenes/{scene['id']}", json={"name": "tv", "steps": steps})
+    assert response.status_code == 200
+    assert response.json()["name"] == "tv"
+    assert client.post(f"/scenes/{scene['id']}/run").json()["transmits"] == 1
+    assert board.transmitted[-1] == bytes.fromhex(codes[1]["code"])
+
+
+def test_run_scene_with_a_deleted_code(client, scene, codes):
+    client.delete(f"/codes/{codes[0]['id']}")
+    assert client.post(f"/scenes/{scene['id']}/run").status_code == 409
+
+
+def test_delete_scene(client, scene):
+    assert client.delete(f"/scenes/{scene['id']}").status_code == 200
+    assert client.get(f"/scenes/{scene['id']}").status_code == 404
+    assert client.post(f"/scenes/{scene['id']}/run").status_code == 404
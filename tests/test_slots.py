@@ -0,0 +1,128 @@
+import pytest
+
+from adrsir.slots import SlotManager, parse_slots
+
+A, B, C = b"a" * 8, b"b" * 8, b"c" * 8
+
+
+def test_parse_slots():
+    assert parse_slots("0-3, 7,3") == [0, 1, 2, 3, 7]
+    assert parse_slots("") == []
+    with pytest.raises(ValueError):
+        parse_slots("8-10")
+
+
+def test_admit_after_repeated_transmits():
+    manager = SlotManager([8, 9], admit_after=2)
+    assert manager.lookup(1, A) is None
+    assert manager.admit(1, A) is None
+    assert manager.lookup(1, A) is None
+    assert manager.admit(1, A) == 8
+    assert manager.lookup(1, A) == 8
+    assert manager.stats()["hits"] == 1
+
+
+def test_updated_code_is_a_miss():
+    manager = SlotManager([9], admit_after=1)
+    manager.lookup(1, A)
+    manager.admit(1, A)
+    assert manager.lookup(1, B) is None
+    assert manager.admit(1, B) == 9
+    assert manager.lookup(1, B) == 9
+
+
+def test_evict_the_least_transmitted():
+    manager = SlotManager([9], admit_after=1)
+    manager.lookup(1, A)
+    assert manager.admit(1, A) == 9
+    manager.lookup(2, B)
+    # As often as the resident code: stays out
+    assert manager.admit(2, B) is None
+    manager.lookup(2, B)
+    assert manager.admit(2, B) == 9
+    assert manager.stats()["resident"] == {9: 2}
+    assert manager.stats()["evictions"] == 1
+
+
+def test_counts_decay():
+    manager = SlotManager([9], admit_after=2, decay=2)
+    manager.lookup(1, A)
+    manager.lookup(1, A)
+    # Halved on the second lookup
+    assert manager.admit(1, A) is None
+
+
+def test_release_and_persist():
+    changes = []
+    manager = SlotManager([9], admit_after=1, on_change=lambda *c: changes.append(c))
+    manager.lookup(1, A)
+    manager.admit(1, A)
+    manager.release(9)
+    assert manager.lookup(1, A) is None
+    assert changes == [(9, 1, A), (9, None, None)]
+
+    restored = SlotManager([9])
+    restored.load([(9, 1, A), (5, 2, B)])
+    assert restored.stats()["resident"] == {9: 1}
+
+
+def test_transmit_from_the_slot(client, main, board, code, make_code, monkeypatch):
+    manager = SlotManager([9], admit_after=2)
+    monkeypatch.setattr(main, "slot_manager", manager)
+    monkeypatch.setattr(main.boards.default, "slots", manager)
+    data = bytes.fromhex(code["code"])
+    other = make_code()
+    loads = board.transactions.get(0x15, 0)
+    for _ in range(3):
+        assert client.post(f"/codes/{code['id']}/transmit").status_code == 200
+        assert board.transmitted[-1] == data
+        # Another code takes the board buffer
+        client.post(f"/transmit/?code={other}")
+    assert board.slots[9] == data
+    # Admitted by the second transmit, sent from the slot by the third
+    assert board.transactions[0x15] == loads + 1
+    assert client.get("/slots/").json()["resident"] == {"9": code["id"]}
+
+
+@pytest.fixture
+def managed(main, monkeypatch):
+    """
+    Slot 9 of the app managed, and recorded in the database
+    """
+    manager = SlotManager([9], admit_after=1, on_change=main.save_slot)
+    monkeypatch.setattr(main, "slot_manager", manager)
+    monkeypatch.setattr(main.boards.default, "slots", manager)
+    yield manager
+    manager.release(9)
+
+
+def test_sync_slots(client, board, code, managed):
+    data = bytes.fromhex(code["code"])
+    client.post(f"/codes/{code['id']}/transmit")
+    assert board.slots[9] == data
+    # Overwritten behind the app
+    board.slots[9] = data[:-4]
+    response = client.post("/slots/sync").json()
+    assert response["slots"] == [
+        {"mem_id": 9, "code_id": code["id"], "status": "written"}
+    ]
+    assert board.slots[9] == data
+    assert client.post("/slots/sync").json()["counts"] == {"unchanged": 1}
+
+    client.delete(f"/codes/{code['id']}")
+    assert client.post("/slots/sync").json()["counts"] == {"released": 1}
+    assert managed.stats()["resident"] == {}
+
+
+def test_sync_given_slots(client, main, board, code, make_code):
+    assert client.post("/slots/sync").json()["slots"] == []
+    data = bytes.fromhex(code["code"])
+    response = client.post("/slots/sync", json={"4": code["id"]}).json()
+    assert response["counts"] == {"written": 1}
+    assert board.slots[4] == data
+    response = client.post("/slots/sync", json={"4": code["id"]}).json()
+    assert response["counts"] == {"unchanged": 1}
+    # Unmanaged slots are not recorded
+    assert main.slot_manager.stats()["resident"] == {}
+    assert client.post("/slots/sync", json={"4": 999999}).status_code == 404
+    assert client.post("/slots/sync", json={"10": code["id"]}).status_code == 422
@@ -0,0 +1,68 @@
+import threading
+
+from fastapi.testclient import TestClient
+from starlette.responses import PlainTextResponse
+
+from adrsir import timing
+from adrsir.adrsir import AdrsirCtrl
+from adrsir.transport import SimulatedAdrsir
+
+CODE = "5B002E0018001800"
+
+
+def board_app(ctrl):
+    """
+    ASGI app transmitting the code on another thread, like the hardware
+    worker
+    """
+
+    async def app(scope, receive, send):
+        thread = threading.Thread(target=timing.bind(ctrl.transmit), args=(CODE,))
+        thread.start()
+        thread.join()
+        await PlainTextResponse("ok")(scope, receive, send)
+
+    return app
+
+
+def parse(header):
+    metrics = {}
+    for metric in header.split(", "):
+        name, _, rest = metric.partition(";dur=")
+        metrics[name] = float(rest.split(";")[0])
+    return metrics
+
+
+def test_header():
+    timings = timing.Timings()
+    timings.add("endpoint", 0.002)
+    timings.add_query(0.001)
+    assert timings.header(0.005) == (
+        'db;dur=1.000;desc="1 queries", endpoint;dur=2.000, total;dur=5.000'
+    )
+
+
+def test_server_timing():
+    sim = SimulatedAdrsir(latency=0.001, flash_time=0, clock=10**9)
+    ctrl = AdrsirCtrl(timing.TimedTransport(sim))
+    client = TestClient(timing.ServerTiming(board_app(ctrl)))
+    response = client.get("/", headers={timing.HEADER: "1"})
+    metrics = parse(response.headers["server-timing"])
+    # Uploaded and triggered by one combined transfer
+    assert set(metrics) == {"db", "queue", "upload", "total"}
+    assert metrics["upload"] > 0
+    assert "server-timing" not in client.get("/").headers
+    # Triggered from the board buffer
+    metrics = parse(client.get("/?timing=1").headers["server-timing"])
+    assert set(metrics) == {"db", "queue", "trigger", "total"}
+    assert sim.transmitted == [bytes.fromhex(CODE)] * 3
+
+
+def test_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(timing, "PROFILE_DIR", str(tmp_path))
+    ctrl = AdrsirCtrl(SimulatedAdrsir(latency=0, flash_time=0, clock=10**9))
+    client = TestClient(timing.ServerTiming(board_app(ctrl)))
+    response = client.get("/transmit", headers={timing.HEADER: "profile"})
+    name = response.headers["x-adrsir-profile"]
+    assert name.endswith("-GET-transmit.prof")
+    assert (tmp_path / name).exists()
@@ -0,0 +1,57 @@
+import time
+
+
+def test_transmit(client, board, code):
+    with client.websocket_connect("/ws/") as websocket:
+        websocket.send_json({"ref": 1, "code_id": code["id"], "repeat": 2})
+        ack = websocket.receive_json()
+    assert ack["ok"] and ack["ref"] == 1
+    assert (ack["device_id"], ack["code_id"]) == (code["device_id"], code["id"])
+    assert ack["elapsed"] > 0
+    assert board.transmitted[-2:] == [bytes.fromhex(code["code"])] * 2
+
+
+def test_hold_and_stop(client, board, code):
+    with client.websocket_connect("/ws/") as websocket:
+        websocket.send_json({"hold": code["id"], "interval": 0.02, "timeout": 5})
+        ack = websocket.receive_json()
+        assert ack["ok"] and len(ack["holds"]) == 1
+        hold_id = ack["holds"][0]
+        time.sleep(0.1)
+        websocket.send_json({"stop": code["id"]})
+        assert websocket.receive_json()["count"] >= 1
+    assert not client.get(f"/holds/{hold_id}").json()["active"]
+
+
+def test_holds_stop_when_the_connection_closes(client, main, code):
+    with client.websocket_connect("/ws/") as websocket:
+        websocket.send_json({"hold": code["id"], "timeout": 5})
+        hold_id = websocket.receive_json()["holds"][0]
+    assert not main.boards.find_hold(hold_id).active
+
+
+def test_websocket_errors(client):
+    with client.websocket_connect("/ws/") as websocket:
+        websocket.send_json({"ref": 1, "code_id": 999999})
+        assert websocket.receive_json()["status"] == 404
+        websocket.send_text("not json")
+        assert websocket.receive_json()["status"] == 400
+        websocket.send_json({"code_id": 1, "repeat": 0})
+        assert websocket.receive_json()["status"] == 422
+        websocket.send_json({"press": 1})
+        assert websocket.receive_json()["detail"] == "Unknown message"
+
+
+def test_websocket_does_not_hold_connections(client, main, code):
+    sockets = []
+    try:
+        for ref in range(3):
+            websocket = client.websocket_connect("/ws/").__enter__()
+            sockets.append(websocket)
+            websocket.send_json({"ref": ref, "code_id": code["id"]})
+            ack = websocket.receive_json()
+            assert ack["ok"] and ack["ref"] == ref
+        assert main.engine.pool.checkedout() == 0
+    finally:
+        for websocket in sockets:
+            websocket.close()